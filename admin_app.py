@@ -1,14 +1,45 @@
+import asyncio
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import math
 import os
+import secrets
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import closing
+from datetime import datetime, timedelta
 from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+import click
+from flask import (Flask, Response, abort, g, make_response, render_template, request, redirect, send_file, url_for,
+                   session, flash)
 from dotenv import load_dotenv
+from markupsafe import Markup
+import broadcast_service
 import db_service
+import job_worker
+import metrics
+import storage_service
+import thumbnail_service
+from werkzeug.http import http_date
 from werkzeug.security import generate_password_hash
 
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "change-me")
+# browsers leave the session cookie off cross-site POSTs
+app.config.setdefault("SESSION_COOKIE_SAMESITE", "Lax")
 
 # Simple login_required decorator for admin routes
 def login_required(f):
@@ -19,6 +50,197 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# State-changing routes also take csrf_protected: their forms must post back the
+# session's token ({{ csrf_field() }}), which another site cannot read.
+def _csrf_token():
+    token = session.get("csrf_token")
+    if token is None:
+        token = session["csrf_token"] = secrets.token_urlsafe(32)
+    return token
+
+@app.template_global()
+def csrf_field():
+    return Markup(f'<input type="hidden" name="csrf_token" value="{_csrf_token()}">')
+
+def csrf_protected(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = session.get("csrf_token")
+        if request.method == "POST" and not (
+                token and hmac.compare_digest(request.form.get("csrf_token", ""), token)):
+            abort(400, "Missing or invalid CSRF token; reload the page and try again.")
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Per-route timings, measured until the view returns its response (streamed
+# bodies such as exports are still being sent after that).
+ROUTE_SECONDS = metrics.Histogram(
+    "admin_request_duration_seconds", "Time spent handling each admin route.", ("route", "method", "status")
+)
+# /metrics needs an admin session or "Authorization: Bearer <METRICS_TOKEN>",
+# unless METRICS_PUBLIC=1 opens it to anyone who can reach the app
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_PUBLIC = os.getenv("METRICS_PUBLIC", "0").strip().lower() in ("1", "true", "yes", "on")
+
+@app.before_request
+def start_request_timer():
+    if metrics.enabled():
+        g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request_time(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        ROUTE_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method,
+                              status=response.status_code)
+    return response
+
+# HTTP caching and compression
+# List pages carry a weak ETag and Last-Modified derived from the versions of
+# the tables they show (db_service.get_table_versions), so an unchanged page is
+# answered with 304 before any rendering. Only a matching ETag gets a 304;
+# If-Modified-Since alone is not trusted. Rendered pages are also kept for
+# RENDER_CACHE_SECONDS keyed by that ETag, together with their compressed forms.
+# Responses of at least COMPRESS_MIN_BYTES are sent with brotli (when installed)
+# or gzip according to Accept-Encoding.
+COMPRESS_MIN_BYTES = int(os.getenv("ADMIN_COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL_GZIP = int(os.getenv("ADMIN_COMPRESS_LEVEL_GZIP", "6"))
+COMPRESS_LEVEL_BROTLI = int(os.getenv("ADMIN_COMPRESS_LEVEL_BROTLI", "5"))
+RENDER_CACHE_SECONDS = float(os.getenv("ADMIN_RENDER_CACHE_SECONDS", "30"))
+RENDER_CACHE_SIZE = int(os.getenv("ADMIN_RENDER_CACHE_SIZE", "256"))
+COMPRESSIBLE_MIMETYPES = ("text/html", "text/plain", "text/css", "text/csv", "application/json",
+                          "application/javascript")
+
+_render_cache = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+def _template_fingerprint():
+    # changes when the app or a template is redeployed, so old ETags stop matching
+    folder = os.path.join(app.root_path, app.template_folder)
+    paths = [__file__] + [os.path.join(folder, name) for name in sorted(os.listdir(folder))]
+    return ",".join(f"{os.path.basename(p)}:{os.stat(p).st_mtime_ns}" for p in paths)
+
+_TEMPLATE_FINGERPRINT = _template_fingerprint()
+
+def _negotiate_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted.quality("br") > 0:
+        return "br"
+    if accepted.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+def _compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=COMPRESS_LEVEL_BROTLI)
+    return gzip.compress(data, COMPRESS_LEVEL_GZIP, mtime=0)
+
+def _encoded_body(variants, encoding):
+    """The body for `encoding`, compressing and memoizing it in `variants` ({encoding: bytes}) on first use."""
+    data = variants["identity"]
+    if encoding is None or len(data) < COMPRESS_MIN_BYTES:
+        return data, None
+    body = variants.get(encoding)
+    if body is None:
+        body = variants[encoding] = _compress(data, encoding)
+    return body, encoding
+
+def _render_cache_get(key):
+    with _render_cache_lock:
+        entry = _render_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del _render_cache[key]
+            return None
+        _render_cache.move_to_end(key)
+        return entry[1]
+
+def _render_cache_put(key, variants):
+    with _render_cache_lock:
+        _render_cache[key] = (time.monotonic() + RENDER_CACHE_SECONDS, variants)
+        _render_cache.move_to_end(key)
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+
+def clear_render_cache():
+    with _render_cache_lock:
+        _render_cache.clear()
+
+def cached_page(*tables):
+    """Serve the view with conditional-request support and a render cache, invalidated by `tables` changing.
+
+    The view must only depend on the URL, the logged-in admin and those tables.
+    Requests with pending flash messages bypass the cache.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if session.get("_flashes"):
+                return view(*args, **kwargs)
+            versions = db_service.get_table_versions(tables)
+            modified = max(ts for _, ts in versions.values())
+            etag = hashlib.sha1(repr((
+                # the page embeds the session's CSRF token
+                _TEMPLATE_FINGERPRINT, request.full_path, session.get("admin_username"), _csrf_token(),
+                sorted(versions.items())
+            )).encode("utf-8")).hexdigest()
+            headers = {
+                "ETag": f'W/"{etag}"',
+                "Last-Modified": http_date(modified),
+                # browsers keep the page but revalidate it on every use
+                "Cache-Control": "private, no-cache",
+                "Vary": "Cookie, Accept-Encoding",
+            }
+            # only the ETag decides: Last-Modified has 1-second resolution, so a write in
+            # the same second as the cached copy would still look unmodified
+            if request.if_none_match and request.if_none_match.contains_weak(etag):
+                response = make_response("", 304)
+                response.headers.update(headers)
+                return response
+
+            variants = _render_cache_get(etag) if RENDER_CACHE_SECONDS > 0 else None
+            if variants is None:
+                result = make_response(view(*args, **kwargs))
+                if result.status_code != 200:
+                    return result
+                variants = {"identity": result.get_data(), "mimetype": result.mimetype}
+                if RENDER_CACHE_SECONDS > 0:
+                    _render_cache_put(etag, variants)
+            body, encoding = _encoded_body(variants, _negotiate_encoding())
+            response = Response(body, mimetype=variants["mimetype"])
+            response.headers.update(headers)
+            if encoding:
+                response.headers["Content-Encoding"] = encoding
+            return response
+        return wrapper
+    return decorator
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = _negotiate_encoding()
+    if encoding:
+        response.set_data(_compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+@app.route("/metrics")
+def metrics_endpoint():
+    authorized = (METRICS_PUBLIC or session.get("admin_logged_in")
+                  or METRICS_TOKEN and hmac.compare_digest(request.headers.get("Authorization", ""),
+                                                           f"Bearer {METRICS_TOKEN}"))
+    if not authorized:
+        return "Unauthorized", 401
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 @app.route("/admin/login", methods=["GET", "POST"])
 def admin_login():
     if request.method == "POST":
@@ -41,27 +263,328 @@ def admin_logout():
     flash("Logged out.", "info")
     return redirect(url_for("admin_login"))
 
+# Days of receipt activity charted on the dashboard
+DASHBOARD_DAYS = 30
+
 @app.route("/admin/dashboard")
 @login_required
 def admin_dashboard():
-    users_count = db_service.count_users()
-    receipts_count = db_service.count_receipts()
-    recent_users = db_service.get_users(limit=10)
-    recent_receipts = db_service.get_receipts(limit=10)
-    return render_template("dashboard.html", users_count=users_count, receipts_count=receipts_count,
-                           recent_users=recent_users, recent_receipts=recent_receipts)
+    snapshot = db_service.dashboard_snapshot(recent=10, days=DASHBOARD_DAYS)
+    today = datetime.utcnow().date()
+    week_start = today - timedelta(days=today.weekday())
+    week_totals = db_service.get_rollup_totals(week_start, week_start + timedelta(days=7))
+    return render_template("dashboard.html", metrics_enabled=metrics.enabled(), week_totals=week_totals,
+                           max_daily_count=max((d["count"] for d in snapshot["daily"]), default=0), **snapshot)
+
+@app.route("/admin/api/receipts/daily")
+@login_required
+def admin_receipts_daily():
+    """Per-day receipt counts and amounts from the rollups, e.g. ?start=2024-01-01&end=2025-01-01&status=approved.
+
+    Defaults to the last 30 days; `end` is exclusive.
+    """
+    default_start, default_end = db_service.day_window(30)
+    start = request.args.get("start") or default_start
+    end = request.args.get("end") or default_end
+    status = request.args.get("status") or None
+    if status is not None and status not in db_service.RECEIPT_STATUSES:
+        return {"error": f"status must be one of {', '.join(db_service.RECEIPT_STATUSES)}"}, 400
+    try:
+        days = db_service.get_daily_rollups(start, end, status=status)
+        totals = db_service.get_rollup_totals(start, end)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    return {"start": start, "end": end, "status": status, "days": days, "totals": totals}
+
+@app.route("/admin/metrics", methods=["POST"])
+@login_required
+@csrf_protected
+def admin_metrics_toggle():
+    metrics.set_enabled(request.form.get("enabled") == "1")
+    flash(f"Metrics and query tracing {'enabled' if metrics.enabled() else 'disabled'}.", "info")
+    return redirect(url_for("admin_dashboard"))
 
 @app.route("/admin/users")
 @login_required
+@cached_page("users")
 def admin_users():
-    users = db_service.get_users()
-    return render_template("users.html", users=users)
+    page = db_service.get_users_page(
+        limit=request.args.get("limit", db_service.PAGE_SIZE, type=int),
+        before=request.args.get("before", type=int),
+        after=request.args.get("after", type=int),
+    )
+    return render_template("users.html", users=page["items"], page=page)
 
 @app.route("/admin/receipts")
 @login_required
+@cached_page("receipts")
 def admin_receipts():
-    receipts = db_service.get_receipts()
-    return render_template("receipts.html", receipts=receipts)
+    filters = {
+        "status": request.args.get("status") or None,
+        "user_id": request.args.get("user_id", type=int),
+    }
+    page = db_service.get_receipts_page(
+        limit=request.args.get("limit", db_service.PAGE_SIZE, type=int),
+        before=request.args.get("before", type=int),
+        after=request.args.get("after", type=int),
+        **filters,
+    )
+    return render_template("receipts.html", receipts=page["items"], page=page, filters=filters)
+
+@app.route("/admin/receipts/bulk", methods=["POST"])
+@login_required
+@csrf_protected
+def admin_receipts_bulk():
+    """Queue a status change for the selected receipts, or all matching the filter, for job_worker."""
+    status = request.form.get("status")
+    filters = {
+        "status": request.form.get("filter_status") or None,
+        "user_id": request.form.get("filter_user_id", type=int),
+    }
+    back = redirect(url_for("admin_receipts", **{k: v for k, v in filters.items() if v is not None}))
+    if status not in db_service.RECEIPT_STATUSES:
+        flash("Choose approve or reject.", "danger")
+        return back
+    if request.form.get("all_matching"):
+        if all(v is None for v in filters.values()):
+            flash("Filter by status or user before acting on all matching receipts.", "danger")
+            return back
+        # freeze the set now: receipts arriving before the job runs were never seen by the admin
+        max_id = db_service.max_receipt_id(**filters)
+        if max_id is None:
+            flash("No receipts match the filter.", "warning")
+            return back
+        payload = {"status": status, "filter": {**filters, "max_id": max_id}}
+        what = f"every receipt matching the filter (up to #{max_id})"
+    else:
+        ids = request.form.getlist("ids", type=int)
+        if not ids:
+            flash("No receipts selected.", "warning")
+            return back
+        payload = {"status": status, "ids": ids}
+        what = f"{len(ids)} receipt(s)"
+    job_id = db_service.enqueue_job(job_worker.SET_RECEIPT_STATUSES, payload)
+    flash(f"Queued job {job_id} to mark {what} as {status}.", "info")
+    return back
+
+@app.route("/admin/receipts/<int:receipt_id>/amount", methods=["POST"])
+@login_required
+@csrf_protected
+def admin_receipt_amount(receipt_id):
+    """Set the amount of a receipt under review (the bot records new receipts with amount 0)."""
+    back = redirect(url_for("admin_receipts", status=request.form.get("filter_status") or None,
+                            user_id=request.form.get("filter_user_id", type=int)))
+    amount = request.form.get("amount", type=float)
+    # float() also takes "nan", "inf" and "1e308"
+    if amount is None or not math.isfinite(amount) or not 0 <= amount < 10 ** 12:
+        flash("Enter a valid amount of 0 or more.", "danger")
+        return back
+    amount = round(amount, 2)
+    if db_service.set_receipt_amount(receipt_id, amount) is None:
+        flash(f"Receipt {receipt_id} not found.", "danger")
+    else:
+        flash(f"Receipt {receipt_id} amount set to {amount:.2f}.", "success")
+    return back
+
+@app.route("/admin/jobs")
+@login_required
+def admin_jobs():
+    status = request.args.get("status") or None
+    return render_template("jobs.html", jobs=db_service.get_jobs(limit=100, status=status), status=status)
+
+@app.route("/admin/search")
+@login_required
+def admin_search():
+    query = request.args.get("q", "").strip()
+    kind = request.args.get("kind", "receipts")
+    if kind not in db_service.SEARCH_KINDS:
+        kind = "receipts"
+    status = request.args.get("status") or None
+    results = db_service.search(query, kind=kind, page=request.args.get("page", 1, type=int), status=status)
+    return render_template("search.html", query=query, kind=kind, status=status, results=results)
+
+# Broadcasts are sent by broadcast_service on a background thread of the
+# process that starts them; progress is read back from the database, so any
+# admin worker can show it, and the page polls the JSON endpoint below.
+# action -> (status it sets, past tense)
+BROADCAST_ACTIONS = {"pause": ("paused", "paused"), "resume": ("pending", "resumed"),
+                     "cancel": ("cancelled", "cancelled")}
+
+def _broadcast_progress(broadcast):
+    done = broadcast["sent"] + broadcast["failed"] + broadcast["blocked"]
+    progress = {key: broadcast[key] for key in ("id", "status", "total", "sent", "failed", "blocked")}
+    progress.update(done=done, percent=round(100 * done / broadcast["total"], 1) if broadcast["total"] else 100.0,
+                    rate=0.0, average_rate=0.0, eta_seconds=None)
+    if broadcast["started_at"]:
+        if broadcast["finished_at"]:
+            until = datetime.fromisoformat(broadcast["finished_at"])
+        elif broadcast["status"] == "running":
+            until = datetime.utcnow()
+        else:  # paused: until the runner's last write
+            until = datetime.utcfromtimestamp(broadcast["heartbeat_ts"])
+        elapsed = (until - datetime.fromisoformat(broadcast["started_at"])).total_seconds()
+        progress["average_rate"] = round(done / elapsed, 2) if elapsed > 0 else 0.0
+    if broadcast["status"] == "running":
+        progress["rate"] = round(broadcast["rate"], 2)
+        if broadcast["rate"] > 0:
+            progress["eta_seconds"] = int(max(broadcast["total"] - done, 0) / broadcast["rate"])
+    return progress
+
+@app.route("/admin/broadcasts", methods=["GET", "POST"])
+@login_required
+@csrf_protected
+def admin_broadcasts():
+    if request.method == "POST":
+        try:
+            broadcast_id = db_service.create_broadcast(request.form.get("text", ""))
+        except ValueError as e:
+            flash(str(e), "danger")
+            return redirect(url_for("admin_broadcasts"))
+        broadcast_service.start(broadcast_id)
+        flash("Broadcast started.", "success")
+        return redirect(url_for("admin_broadcast", broadcast_id=broadcast_id))
+    broadcasts = [dict(b, **_broadcast_progress(b)) for b in db_service.get_broadcasts()]
+    return render_template("broadcasts.html", broadcasts=broadcasts, users_count=db_service.count_users())
+
+@app.route("/admin/broadcasts/<int:broadcast_id>")
+@login_required
+def admin_broadcast(broadcast_id):
+    broadcast = db_service.get_broadcast(broadcast_id)
+    if broadcast is None:
+        abort(404)
+    return render_template("broadcast.html", broadcast=broadcast, progress=_broadcast_progress(broadcast),
+                           failures=db_service.get_broadcast_failures(broadcast_id))
+
+@app.route("/admin/api/broadcasts/<int:broadcast_id>")
+@login_required
+def admin_broadcast_progress(broadcast_id):
+    broadcast = db_service.get_broadcast(broadcast_id)
+    if broadcast is None:
+        return {"error": "no such broadcast"}, 404
+    return _broadcast_progress(broadcast)
+
+@app.route("/admin/broadcasts/<int:broadcast_id>/<action>", methods=["POST"])
+@login_required
+@csrf_protected
+def admin_broadcast_action(broadcast_id, action):
+    if action not in BROADCAST_ACTIONS:
+        abort(404)
+    broadcast = db_service.get_broadcast(broadcast_id)
+    if broadcast is None:
+        abort(404)
+    status, done = BROADCAST_ACTIONS[action]
+    changed = db_service.set_broadcast_status(broadcast_id, status)
+    # a running broadcast whose runner died is resumed by claiming it again
+    stale = (action == "resume" and broadcast["status"] == "running"
+             and broadcast["heartbeat_ts"] < time.time() - broadcast_service.STALE_AFTER)
+    if action == "resume" and (changed or stale):
+        broadcast_service.start(broadcast_id)
+    if changed or stale:
+        flash(f"Broadcast {done}.", "info")
+    else:
+        flash(f"Broadcast is {broadcast['status']} and cannot be {done}.", "warning")
+    return redirect(url_for("admin_broadcast", broadcast_id=broadcast_id))
+
+# Thumbnails are addressed by content digest, so a URL never changes meaning and
+# browsers may keep them for a year without revalidating.
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600
+
+@app.context_processor
+def thumbnail_helpers():
+    def thumbnail_urls(file_ref, size=thumbnail_service.SIZES[0]):
+        """{format: url} for a stored image, or {} when there is nothing to show."""
+        digest = storage_service.parse_ref(file_ref) if file_ref else None
+        if digest is None or not thumbnail_service.available():
+            return {}
+        return {fmt: url_for("admin_thumbnail", size=size, digest=digest, fmt=fmt)
+                for fmt in thumbnail_service.formats()}
+    return {"thumbnail_urls": thumbnail_urls, "thumbnail_sizes": thumbnail_service.SIZES}
+
+@app.route("/admin/thumbnails/<int:size>/<digest>.<fmt>")
+@login_required
+def admin_thumbnail(size, digest, fmt):
+    if (not thumbnail_service.available() or size not in thumbnail_service.SIZES
+            or fmt not in thumbnail_service.formats() or db_service.get_blob(digest) is None):
+        abort(404)
+    try:
+        key = thumbnail_service.ensure_thumbnail(digest, size, fmt)
+    except FileNotFoundError:
+        abort(404)
+    mimetype = thumbnail_service.FORMATS[fmt][1]
+    backend = storage_service.get_backend()
+    path = backend.local_path(key)
+    if path is not None:
+        response = send_file(path, mimetype=mimetype, max_age=THUMBNAIL_MAX_AGE)
+    else:
+        with closing(backend.open(key)) as fh:
+            response = Response(fh.read(), mimetype=mimetype)
+    # behind the admin login, so only the browser may keep a copy
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = THUMBNAIL_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+EXPORT_COLUMNS = ["id", "user_id", "amount", "status", "description", "created_at", "external_ref", "file_ref"]
+# Rows encoded per yielded chunk of an export response
+EXPORT_BATCH_SIZE = 1000
+
+def _encode_export(rows, fmt):
+    """Encode receipt dicts as CSV or NDJSON, yielding one text chunk per EXPORT_BATCH_SIZE rows."""
+    buf = io.StringIO()
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+    pending = 0
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            buf.write(json.dumps(row, ensure_ascii=False))
+            buf.write("\n")
+        pending += 1
+        if pending >= EXPORT_BATCH_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            pending = 0
+    if buf.tell():
+        yield buf.getvalue()
+
+def _gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route("/admin/receipts/export")
+@login_required
+def admin_receipts_export():
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "ndjson"):
+        return "Unsupported format; use csv or ndjson.", 400
+    try:
+        # checks status and dates now, so bad input is a 400 rather than a truncated download
+        rows = db_service.iter_receipts(
+            status=request.args.get("status") or None,
+            start=request.args.get("start") or None,
+            end=request.args.get("end") or None,
+            batch_size=EXPORT_BATCH_SIZE,
+        )
+    except ValueError as e:
+        return f"Bad export parameters: {e}", 400
+    body = _encode_export(rows, fmt)
+    filename = f"receipts.{fmt}"
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    if request.args.get("gzip") == "1":
+        body = _gzip_stream(body)
+        filename += ".gz"
+        mimetype = "application/gzip"
+    return Response(body, mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 # CLI helpers to initialize DB and create admin from environment variables
 @app.cli.command("init-db")
@@ -70,6 +593,144 @@ def init_db_command():
     db_service.init_db()
     print("Initialized the database.")
 
+@app.cli.command("migrate-db")
+@click.option("--target", type=int, default=None, help="Stop after this schema version.")
+def migrate_db_command(target):
+    """Apply pending schema migrations."""
+    applied = db_service.migrate(target=target)
+    for version, description in applied:
+        print(f"Applied migration {version}: {description}")
+    print(f"Schema is at version {db_service.get_schema_version()}.")
+
+@app.cli.command("explain-queries")
+def explain_queries_command():
+    """Print the query plan for each hot query; fails if a SQLite plan scans a table or sorts without an index."""
+    for name, (sql, params) in db_service.HOT_QUERIES.items():
+        print(f"{name}:")
+        for detail in db_service.explain_query_plan(sql, params):
+            print(f"  {detail}")
+    problems = db_service.hot_query_problems()
+    if problems:
+        lines = [f"  {name}: {problem} ({detail})" for name, found in problems.items() for detail, problem in found]
+        raise click.ClickException("Hot queries not served by an index:\n" + "\n".join(lines))
+
+@app.cli.command("reconcile-balances")
+def reconcile_balances_command():
+    """Rebuild the per-user balances ledger from receipts."""
+    count = db_service.reconcile_balances()
+    print(f"Reconciled balances for {count} user(s).")
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recompute the daily receipt rollups from receipts."""
+    count = db_service.rebuild_daily_rollups()
+    print(f"Rebuilt {count} daily rollup row(s).")
+
+@app.cli.command("run-broadcast")
+@click.argument("broadcast_id", type=int)
+def run_broadcast_command(broadcast_id):
+    """Send (or resume) a broadcast in the foreground."""
+    broadcast = asyncio.run(broadcast_service.run_broadcast(broadcast_id))
+    if broadcast is None:
+        print(f"Broadcast {broadcast_id} does not exist, is finished or paused, or is being sent elsewhere.")
+        return
+    print(f"Broadcast {broadcast_id} is {broadcast['status']}: {broadcast['sent']} sent, "
+          f"{broadcast['failed']} failed, {broadcast['blocked']} blocked of {broadcast['total']}.")
+
+@app.cli.command("archive-receipts")
+@click.option("--older-than-days", type=int, default=db_service.ARCHIVE_AFTER_DAYS, show_default=True)
+@click.option("--batch-size", type=int, default=db_service.ARCHIVE_BATCH_SIZE, show_default=True)
+@click.option("--limit", type=int, default=None, help="Stop after this many receipts.")
+def archive_receipts_command(older_than_days, batch_size, limit):
+    """Move old approved/rejected receipts to the archive table in short batches."""
+    before = datetime.utcnow() - timedelta(days=older_than_days)
+    moved = db_service.archive_receipts(before=before, batch_size=batch_size, limit=limit)
+    print(f"Archived {moved} receipt(s) created before {before.date().isoformat()}.")
+
+@app.cli.command("generate-thumbnails")
+@click.option("--workers", type=int, default=thumbnail_service.WORKERS, show_default=True,
+              help="Pillow processes.")
+@click.option("--size", "sizes", type=int, multiple=True, help="Only this size (repeatable).")
+def generate_thumbnails_command(workers, sizes):
+    """Render missing thumbnails of every stored image on a process pool."""
+    if not thumbnail_service.available():
+        print("Thumbnails need Pillow (pip install Pillow).")
+        return
+    stats = thumbnail_service.pregenerate(sizes=sizes or None, workers=workers)
+    print(f"Generated {stats['generated']} thumbnail(s); {stats['skipped']} already present, "
+          f"{stats['failed']} failed.")
+
+@app.cli.command("collect-blobs")
+@click.option("--grace-seconds", type=int, default=storage_service.BLOB_GC_GRACE, show_default=True,
+              help="Only delete files released at least this long ago.")
+def collect_blobs_command(grace_seconds):
+    """Delete stored files (and their thumbnails) that no receipt references any more."""
+    stats = storage_service.collect_garbage(grace=grace_seconds)
+    print(f"Deleted {stats['deleted']} unreferenced file(s); {stats['failed']} failed and will be retried.")
+
+def _read_records(path, fmt):
+    """Yield (line number, record) for each record of a CSV (with header row) or NDJSON file, streaming.
+
+    A line that is not valid JSON yields a ValueError in place of its record.
+    """
+    with open(path, newline="", encoding="utf-8") as fh:
+        if fmt == "csv":
+            reader = csv.DictReader(fh)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for number, line in enumerate(fh, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield number, json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield number, ValueError(f"invalid JSON ({e.msg})")
+
+@app.cli.command("import-receipts")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), default=None,
+              help="File format; inferred from the extension when omitted.")
+@click.option("--chunk-size", type=int, default=db_service.BULK_CHUNK_SIZE, show_default=True)
+@click.option("--show-duplicates", is_flag=True, help="Print each duplicate row.")
+@click.option("--skip-invalid", is_flag=True, help="Report and skip malformed rows instead of stopping at the first.")
+def import_receipts_command(path, fmt, chunk_size, show_duplicates, skip_invalid):
+    """Stream receipts from a CSV or NDJSON file into the database."""
+    if fmt is None:
+        fmt = "csv" if path.lower().endswith(".csv") else "ndjson"
+    on_duplicate = (lambda row: print("Duplicate:", row)) if show_duplicates else None
+    line = 0
+    invalid = 0
+    totals = {"inserted": 0, "duplicates": 0}
+
+    def on_invalid(row, error):
+        nonlocal invalid
+        invalid += 1
+        print(f"Skipped line {line}: {error}")
+
+    def records():
+        nonlocal line
+        for line, record in _read_records(path, fmt):
+            if not isinstance(record, ValueError):
+                yield record
+            elif skip_invalid:
+                on_invalid(None, record)
+            else:
+                raise record
+
+    try:
+        result = db_service.create_receipts_many(records(), chunk_size=chunk_size, on_duplicate=on_duplicate,
+                                                 on_invalid=on_invalid if skip_invalid else None,
+                                                 progress=totals.update)
+    except ValueError as e:
+        # the chunk holding the bad row was not written; rows with an external_ref are skipped on a re-run
+        raise click.ClickException(
+            f"Line {line}: {e}. Imported {totals['inserted']} receipt(s) before the chunk containing it "
+            f"(skipped {totals['duplicates']} duplicate(s)); fix the row and run the import again, "
+            f"or pass --skip-invalid.") from None
+    print(f"Imported {result['inserted']} receipt(s), skipped {result['duplicates']} duplicate(s)"
+          + (f" and {invalid} invalid row(s)." if invalid else "."))
+
 @app.cli.command("create-admin-from-env")
 def create_admin_from_env():
     """Create an admin user using ADMIN_USERNAME and ADMIN_PASSWORD from environment."""
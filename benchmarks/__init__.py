@@ -0,0 +1,14 @@
+"""Performance benchmarks for the Zero bot and admin panel.
+
+Run a benchmark as a module from the repository root, e.g.:
+
+    python -m benchmarks.connections
+"""
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
@@ -0,0 +1,368 @@
+"""
+Conformance checks and write throughput for each database backend.
+
+Runs the same db_service checks against SQLite and, when --postgres-url is
+given, PostgreSQL, then measures concurrent write throughput on each:
+
+    python -m benchmarks.backends
+    python -m benchmarks.backends --postgres-url postgresql://postgres@localhost/zero --writers 16
+
+PostgreSQL runs inside a throwaway schema that is dropped afterwards, so any
+database the user may create tables in will do. Exits 1 if a check fails.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from urllib.parse import quote
+
+import db_service
+
+
+def _expect(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def check_schema():
+    db_service.init_db()
+    db_service.init_db()  # idempotent
+    latest = db_service._schema(db_service.get_backend())[1][-1][0]
+    _expect(db_service.get_schema_version() == latest, f"schema version {db_service.get_schema_version()}")
+    _expect(db_service.explain_query_plan(*db_service.HOT_QUERIES["receipts by user"]), "empty query plan")
+    problems = db_service.hot_query_problems()
+    _expect(not problems, f"hot queries not served by an index: {problems}")
+
+
+def check_users():
+    uid = db_service.create_user("Layla Haddad", "layla@example.com")
+    _expect(uid and db_service.get_user_by_id(uid)["email"] == "layla@example.com", "created user not found")
+    _expect(db_service.create_user("Dup", "layla@example.com") is None, "duplicate email accepted")
+    _expect(db_service.count_users() == len(db_service.get_users()), "users counter out of step")
+
+
+def check_receipts_and_balances():
+    uid = db_service.create_user("Omar Nasser", "omar@example.com")
+    first = db_service.create_receipt(uid, 100.0, "approved", "kuraimi transfer")
+    second = db_service.create_receipt(uid, 50.0)
+    _expect(db_service.get_receipt_by_id(first)["amount"] == 100.0, "receipt not stored")
+    _expect(db_service.get_balance(uid) == 100.0, "approved receipt not credited")
+    _expect(db_service.set_receipt_status(second, "approved") == "pending", "wrong previous status")
+    _expect(db_service.get_balance(uid) == 150.0, "status change not credited")
+    _expect(db_service.set_receipt_statuses([(first, "rejected"), (second, "approved")]) == 1, "bulk status")
+    _expect(db_service.get_balance(uid) == 50.0, "bulk status change not debited")
+    # the admin rejected `first` while it was being verified: the worker's approval must not apply
+    _expect(db_service.set_receipt_statuses([(first, "approved")], expected="pending") == 0, "expected status")
+    _expect(db_service.get_balance(uid) == 50.0, "superseded change credited")
+    _expect([r["id"] for r in db_service.get_receipts_by_user(uid)] == [second, first], "receipts by user order")
+    db_service.reconcile_balances()
+    _expect(db_service.get_balance(uid) == 50.0, "reconcile disagrees with the ledger")
+    by_status = db_service.count_receipts_by_status()
+    _expect(sum(by_status.values()) == db_service.count_receipts(), f"status counters {by_status}")
+
+
+def check_bulk_and_paging():
+    uid = db_service.create_user("Sara Qasim", "sara@example.com")
+    rows = [{"user_id": uid, "amount": i, "external_ref": f"bulk-{i}"} for i in range(1, 121)]
+    _expect(db_service.create_receipts_many(rows, chunk_size=50) == {"inserted": 120, "duplicates": 0}, "bulk insert")
+    _expect(db_service.create_receipts_many(rows[:10])["duplicates"] == 10, "duplicates not detected")
+    seen, cursor = [], None
+    while True:
+        page = db_service.get_receipts_page(limit=25, before=cursor, user_id=uid)
+        seen.extend(r["id"] for r in page["items"])
+        cursor = page["next"]
+        if cursor is None:
+            break
+    _expect(len(seen) == 120 and seen == sorted(seen, reverse=True), "keyset pages incomplete")
+    streamed = [r["id"] for r in db_service.iter_receipts(batch_size=7) if r["user_id"] == uid]
+    _expect(streamed == sorted(seen), "iter_receipts incomplete")
+    max_id = db_service.max_receipt_id(user_id=uid)
+    _expect(max_id == max(seen), f"max receipt id {max_id}")
+    db_service.create_receipt(uid, 1.0)
+    _expect(db_service.get_receipt_ids(user_id=uid, max_id=max_id) == sorted(seen), "max_id does not freeze the set")
+
+
+def check_transactions():
+    uid = db_service.create_user("Tariq Saleh", "tariq@example.com")
+    try:
+        with db_service.transaction():
+            db_service.create_receipt(uid, 1.0)
+            raise RuntimeError("rollback")
+    except RuntimeError:
+        pass
+    _expect(db_service.get_receipts_by_user(uid) == [], "rolled back insert is visible")
+    with db_service.transaction():
+        db_service.create_receipt(uid, 2.0)
+        try:
+            with db_service.transaction():
+                db_service.create_receipt(uid, 3.0)
+                raise RuntimeError("inner")
+        except RuntimeError:
+            pass
+    _expect([r["amount"] for r in db_service.get_receipts_by_user(uid)] == [2.0], "savepoint not rolled back")
+
+
+def check_blobs_and_search():
+    digest = uuid.uuid4().hex * 2
+    _expect(db_service.retain_blob(digest, 10, create=False) is None, "retain without a stored copy")
+    _expect(db_service.retain_blob(digest, 10) == 1, "first retain")
+    _expect(db_service.retain_blob(digest, 10, create=False) == 2, "second retain")
+    _expect(db_service.release_blob(digest) == 1, "release")
+    _expect(db_service.release_blob(digest) == 0, "last release")
+    _expect(db_service.get_blob(digest)["released_ts"], "released blob kept for the sweep")
+    _expect(db_service.retain_blob(digest, 10) == 1 and db_service.release_blob(digest) == 0, "re-reference")
+    _expect(digest in db_service.claim_released_blobs(grace=0, limit=1000), "claim released blob")
+    _expect(db_service.retain_blob(digest, 10) is None, "claimed blob retained")
+    db_service.drop_blob(digest)
+    _expect(db_service.get_blob(digest) is None, "dropped blob")
+    found = db_service.search("kuraimi")["items"]
+    _expect(any(r["description"] == "kuraimi transfer" for r in found), "receipt search")
+    _expect(db_service.search("omar", kind="users")["items"], "user search")
+    _expect(db_service.search('"unbalanced (*')["items"] == [], "search syntax not escaped")
+    snapshot = db_service.dashboard_snapshot()
+    _expect(snapshot["users_count"] == db_service.count_users(), "dashboard counters")
+
+
+def check_daily_rollups():
+    uid = db_service.create_user("Huda Mansour", "huda@example.com")
+    rows = [{"user_id": uid, "amount": 10.0, "status": "approved", "created_at": "2020-03-01T10:00:00"},
+            {"user_id": uid, "amount": 5.0, "created_at": "2020-03-01T23:59:59.5"},
+            {"user_id": uid, "amount": 7.0, "created_at": "2020-03-03T00:00:00"}]
+    db_service.create_receipts_many(rows)
+    ids = [r["id"] for r in db_service.get_receipts_by_user(uid)]
+    db_service.set_receipt_status(ids[0], "rejected")
+    days = db_service.get_daily_rollups("2020-03-01", "2020-03-04")
+    _expect([d["count"] for d in days] == [2, 0, 1], f"daily counts {days}")
+    _expect(days[0]["by_status"]["approved"] == {"count": 1, "amount": 10.0}, "daily status split")
+    _expect(days[2]["by_status"]["rejected"]["amount"] == 7.0, "status change not rolled up")
+    totals = db_service.get_rollup_totals("2020-03-01", "2020-03-04")
+    _expect(totals["pending"] == {"count": 1, "amount": 5.0}, f"rollup totals {totals}")
+    in_range = [r["id"] for r in db_service.iter_receipts(start="2020-03-01", end="2020-03-02")]
+    _expect(sorted(in_range) == sorted(ids[1:]), "created_ts range")
+    before = db_service.get_daily_rollups("2020-03-01", "2020-03-04")
+    db_service.rebuild_daily_rollups()
+    _expect(db_service.get_daily_rollups("2020-03-01", "2020-03-04") == before, "rebuild disagrees with triggers")
+
+
+def check_table_versions():
+    before = db_service.get_table_versions(["users", "receipts"])
+    uid = db_service.create_user("Reem Zaid", "reem@example.com")
+    after_user = db_service.get_table_versions(["users", "receipts"])
+    _expect(after_user["users"][0] > before["users"][0], "user insert did not bump the version")
+    _expect(after_user["receipts"] == before["receipts"], "receipts version bumped by a user insert")
+    db_service.set_receipt_status(db_service.create_receipt(uid, 1.0), "approved")
+    _expect(db_service.get_table_versions(["receipts"])["receipts"][0] > after_user["receipts"][0],
+            "receipt writes did not bump the version")
+
+
+def check_thumbnail_index():
+    digest = uuid.uuid4().hex * 2
+    before = db_service.get_counter("thumbnails:bytes")
+    for size in (100, 200, 300):
+        db_service.record_thumbnail(f"{digest}.thumb{size}", digest, size)
+    db_service.record_thumbnail(f"{digest}.thumb300", digest, 400)
+    _expect(db_service.get_counter("thumbnails:bytes") == before + 700, "thumbnail bytes counter")
+    evicted = db_service.evict_thumbnails(before + 500, low_water=1.0)
+    _expect(evicted and db_service.get_counter("thumbnails:bytes") <= before + 500, f"evicted {evicted}")
+    remaining = db_service.forget_thumbnails(digest)
+    _expect(sorted(evicted + remaining) == [f"{digest}.thumb{size}" for size in (100, 200, 300)],
+            "forget thumbnails")
+    _expect(db_service.get_counter("thumbnails:bytes") == before, "thumbnail bytes after delete")
+
+
+def check_broadcasts():
+    broadcast_id = db_service.create_broadcast("Hello")
+    _expect(db_service.claim_broadcast(broadcast_id, "a"), "claim pending broadcast")
+    _expect(not db_service.claim_broadcast(broadcast_id, "b"), "claim of a live broadcast refused")
+    first = db_service.get_broadcast_recipients(broadcast_id, 0, 3)
+    _expect(len(first) == 3 and first == sorted(first), f"recipients {first}")
+    results = [(first[0], "sent", 1, None), (first[1], "blocked", 1, "Forbidden"), (first[2], "sent", 2, None)]
+    _expect(db_service.record_broadcast_deliveries(broadcast_id, "a", results, cursor=first[1], rate=5.0)
+            == "running", "record deliveries")
+    # a repeated outcome is not stored or counted twice
+    db_service.record_broadcast_deliveries(broadcast_id, "a", results[:1])
+    broadcast = db_service.get_broadcast(broadcast_id)
+    _expect((broadcast["sent"], broadcast["blocked"], broadcast["cursor"]) == (2, 1, first[1]),
+            f"totals {broadcast}")
+    _expect(first[2] not in db_service.get_broadcast_recipients(broadcast_id, first[1], 3),
+            "delivered recipient skipped on resume")
+    _expect(db_service.set_broadcast_status(broadcast_id, "paused"), "pause")
+    _expect(db_service.record_broadcast_deliveries(broadcast_id, "a", []) == "paused", "runner sees pause")
+    _expect(db_service.set_broadcast_status(broadcast_id, "pending"), "resume")
+    _expect(db_service.claim_broadcast(broadcast_id, "b"), "claim resumed broadcast")
+    _expect(db_service.record_broadcast_deliveries(broadcast_id, "a", []) is None, "old runner taken over")
+    _expect(not db_service.finish_broadcast(broadcast_id, "a") and db_service.finish_broadcast(broadcast_id, "b"),
+            "finish by owner")
+    _expect(db_service.get_broadcast_failures(broadcast_id)[0]["user_id"] == first[1], "failures")
+
+
+def check_archive():
+    uid = db_service.create_user("Sami Haddad", f"sami-{uuid.uuid4().hex[:8]}@example.com")
+    ref = f"archive-{uuid.uuid4().hex}"
+    rows = [{"user_id": uid, "amount": 10.0, "status": "approved", "created_at": "2000-01-01T10:00:00",
+             "external_ref": ref},
+            {"user_id": uid, "amount": 4.0, "status": "rejected", "created_at": "2000-01-02T10:00:00"},
+            {"user_id": uid, "amount": 3.0, "created_at": "2000-01-02T11:00:00"},
+            {"user_id": uid, "amount": 2.0, "status": "approved", "created_at": "2000-02-01T10:00:00"}]
+    db_service.create_receipts_many(rows)
+    ids = [r["id"] for r in db_service.get_receipts_by_user(uid)]
+    counters = db_service.get_counters()
+    days = db_service.get_daily_rollups("2000-01-01", "2000-01-03")
+    _expect(db_service.archive_receipts(before="2000-01-31", batch_size=1, pause=0) == 2, "archived count")
+    live = [r["id"] for r in db_service.get_receipts_by_user(uid)]
+    _expect(live == [ids[0], ids[1]], f"live receipts {live}")
+    everything = db_service.get_receipts_by_user(uid, include_archived=True)
+    _expect([r["id"] for r in everything] == ids, "receipts by user with archive")
+    _expect(db_service.get_receipt_by_id(ids[3]) is None, "archived receipt still live")
+    archived = db_service.get_receipt_by_id(ids[3], include_archived=True)
+    _expect(archived and archived["amount"] == 10.0 and archived["archived_at"], "archived receipt lookup")
+    after = db_service.get_counters()
+    _expect(after["receipts"] == counters["receipts"] and after["receipts:approved"] == counters["receipts:approved"]
+            and after["receipts:archived"] == counters.get("receipts:archived", 0) + 2, "counters after archiving")
+    _expect(db_service.get_daily_rollups("2000-01-01", "2000-01-03") == days, "rollups after archiving")
+    db_service.rebuild_daily_rollups()
+    _expect(db_service.get_daily_rollups("2000-01-01", "2000-01-03") == days, "rollup rebuild with archive")
+    db_service.reconcile_balances()
+    _expect(db_service.get_balance(uid) == 12.0, "balance with archive")
+    result = db_service.create_receipts_many([{"user_id": uid, "amount": 1.0, "external_ref": ref}])
+    _expect(result["duplicates"] == 1, "archived external_ref is a duplicate")
+
+
+def check_job_queue():
+    kind = f"check.{uuid.uuid4().hex[:8]}"
+    first = db_service.enqueue_job(kind, {"n": 1})
+    second = db_service.enqueue_job(kind, {"n": 2}, max_attempts=1)
+    later = db_service.enqueue_job(kind, {"n": 3}, delay=3600)
+    claimed = [j for j in db_service.claim_jobs("worker-a", limit=100, lease=60) if j["kind"] == kind]
+    _expect([j["id"] for j in claimed] == [first, second], f"claimed {[j['id'] for j in claimed]}")
+    _expect(claimed[0]["payload"] == {"n": 1} and claimed[0]["attempts"] == 1, "claimed job")
+    _expect(not [j for j in db_service.claim_jobs("worker-b", limit=100) if j["kind"] == kind], "leased job claimed twice")
+    _expect(not db_service.complete_job(first, "worker-b"), "completed by a non-owner")
+    _expect(db_service.extend_job_lease(first, "worker-a", 60), "lease extension")
+    _expect(db_service.fail_job(first, "worker-a", "boom") == "queued", "retry with attempts left")
+    _expect(db_service.fail_job(second, "worker-a", "boom") == "failed", "failure without attempts left")
+    retried = [j for j in db_service.claim_jobs("worker-b", limit=100) if j["kind"] == kind]
+    _expect([j["id"] for j in retried] == [first] and retried[0]["attempts"] == 2, "requeued job claimed again")
+    _expect(db_service.complete_job(first, "worker-b", {"ok": True}), "completion")
+    job = db_service.get_job(first)
+    _expect(job["status"] == "done" and job["result"] == {"ok": True} and job["error"] is None, f"done job {job}")
+    _expect(db_service.get_job(second)["status"] == "failed", "failed job")
+    _expect(db_service.get_job(later)["status"] == "queued", "delayed job")
+
+
+def check_conversations():
+    user_id = random.randint(10**9, 2 * 10**9)
+    db_service.reset_conversation_cache()
+    _expect(db_service.get_conversation(user_id) is None, "no state yet")
+    db_service.set_conversation(user_id, "sick_leave", "message")
+    db_service.set_conversation(user_id, "sick_leave", "attachment", {"message": "flu"})
+    _expect(db_service.flush_conversations() == (1, 0), "one write for two steps")
+    db_service.reset_conversation_cache()
+    state = db_service.get_conversation(user_id)
+    _expect(state == {"flow": "sick_leave", "step": "attachment", "data": {"message": "flu"}}, f"read back {state}")
+    # another process moves the user on behind this one's cache
+    with db_service.transaction() as conn:
+        conn.execute("UPDATE conversation_state SET step = 'review', version = version + 1 WHERE user_id = ?",
+                     (user_id,))
+    db_service.set_conversation(user_id, "sick_leave", "message")
+    _expect(db_service.flush_conversations() == (0, 1), "stale write detected")
+    _expect(db_service.get_conversation(user_id)["step"] == "review", "other process's write kept")
+    db_service.clear_conversation(user_id)
+    _expect(db_service.close_conversations() == (1, 0), "clear written on close")
+    db_service.reset_conversation_cache()
+    _expect(db_service.get_conversation(user_id) is None, "state cleared")
+
+
+CHECKS = [check_schema, check_users, check_receipts_and_balances, check_bulk_and_paging,
+          check_transactions, check_blobs_and_search, check_daily_rollups,
+          check_table_versions, check_thumbnail_index, check_broadcasts,
+          check_archive, check_job_queue,
+          check_conversations]
+
+
+def run_checks():
+    failures = 0
+    for check in CHECKS:
+        try:
+            check()
+            print(f"  PASS {check.__name__}")
+        except Exception:
+            failures += 1
+            print(f"  FAIL {check.__name__}")
+            traceback.print_exc()
+    return failures
+
+
+def write_throughput(writers, seconds):
+    """Receipts created and approved per second by `writers` threads."""
+    users = [db_service.create_user(f"Writer {i}", f"writer{i}-{uuid.uuid4().hex[:8]}@example.com")
+             for i in range(writers)]
+    done = [0] * writers
+    stop = time.monotonic() + seconds
+
+    def worker(index):
+        rnd = random.Random(index)
+        while time.monotonic() < stop:
+            rid = db_service.create_receipt(users[index], rnd.randint(1, 500))
+            db_service.set_receipt_status(rid, "approved")
+            done[index] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(done) / seconds
+
+
+def _postgres_schema_url(url, schema):
+    separator = "&" if "?" in url else "?"
+    return f"{url}{separator}options={quote(f'-csearch_path={schema}')}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--postgres-url", default=os.getenv("BENCH_POSTGRES_URL"))
+    parser.add_argument("--writers", type=int, default=8, help="concurrent writer threads")
+    parser.add_argument("--seconds", type=float, default=5.0, help="duration of the write benchmark")
+    args = parser.parse_args()
+
+    failures = 0
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        print("sqlite")
+        db_service.DB_PATH = os.path.join(tmp, "conformance.db")
+        failures += run_checks()
+        results["sqlite"] = write_throughput(args.writers, args.seconds)
+        db_service.close_pool()
+
+    if args.postgres_url:
+        import psycopg2
+
+        schema = f"zero_conformance_{uuid.uuid4().hex[:8]}"
+        admin = psycopg2.connect(args.postgres_url)
+        admin.autocommit = True
+        admin.cursor().execute(f"CREATE SCHEMA {schema}")
+        try:
+            print("postgres")
+            db_service.DATABASE_URL = _postgres_schema_url(args.postgres_url, schema)
+            failures += run_checks()
+            results["postgres"] = write_throughput(args.writers, args.seconds)
+        finally:
+            db_service.close_pool()
+            db_service.DATABASE_URL = ""
+            admin.cursor().execute(f"DROP SCHEMA {schema} CASCADE")
+            admin.close()
+
+    for name, per_sec in results.items():
+        print(f"{name:>10}: {per_sec:9.1f} receipt writes/sec with {args.writers} writers")
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Load test for the async bot: feeds synthetic or recorded updates through the
+real handlers and update processor against FakeTelegramRequest, and reports
+updates/sec, p50/p99 handler latency, and the Bot API calls and database
+statements (including trigger bodies) per update. No network is used: Bot
+API calls and file downloads are answered locally after --api-latency.
+
+"sequential" processes one update at a time, as the old synchronous
+dispatcher did; "per-user concurrent" uses main.PerUserUpdateProcessor.
+By default all updates arrive at once and latency includes queueing behind
+the burst; --rate spreads arrivals out to measure latency at a steady load.
+
+    python -m benchmarks.bot_updates --updates 2000 --api-latency 0.05
+    python -m benchmarks.bot_updates --save-updates mix.ndjson
+    python -m benchmarks.bot_updates --updates-file mix.ndjson --rate 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+
+import httpx
+
+import db_service
+import ingestion_service
+import main
+import metrics
+import storage_service
+from benchmarks import percentile
+from benchmarks.fake_telegram import FakeTelegramRequest, file_transport, load_updates, mixed_updates, save_updates
+from rate_limiter import Coalescer, RateLimiter
+
+
+def update_kind(raw):
+    """Short label for a raw update: the command, callback data, or message type."""
+    if "callback_query" in raw:
+        return f"callback {raw['callback_query'].get('data')}"
+    message = raw.get("message") or {}
+    if message.get("text", "").startswith("/"):
+        return message["text"].split()[0]
+    for field in ("photo", "document", "text"):
+        if field in message:
+            return field
+    return next((key for key in raw if key != "update_id"), "empty")
+
+
+def disable_throttling():
+    """Lift main's rate limits and callback coalescing so the handlers themselves are measured."""
+    unlimited = float("inf")
+    main.rate_limiter = RateLimiter(unlimited, unlimited, unlimited, unlimited)
+    main.callback_coalescer = Coalescer(0)
+
+
+async def _run(mode, raw_updates, api_latency, concurrency, rate=0.0, api_jitter=0.0, record=False):
+    request = FakeTelegramRequest(latency=api_latency, jitter=api_jitter, record=record)
+    builder = ApplicationBuilder().token("123456:TEST").request(request).updater(None)
+    processor = None
+    if mode == "per-user concurrent":
+        processor = main.PerUserUpdateProcessor(concurrency)
+        builder = builder.concurrent_updates(processor)
+    application = builder.build()
+    main.register_handlers(application)
+    ingestion_service.set_http_client(httpx.AsyncClient(transport=file_transport(latency=api_latency)))
+    await application.initialize()
+    await application.start()
+    # getMe from initialize()
+    request.counts.clear()
+    request.calls.clear()
+
+    updates = [Update.de_json(raw, application.bot) for raw in raw_updates]
+    latencies = []
+    tasks = []
+
+    async def timed(update, arrived_at):
+        await application.process_update(update)
+        latencies.append(time.perf_counter() - arrived_at)
+
+    statements = db_service.statements_executed()
+    started = time.perf_counter()
+    for index, update in enumerate(updates):
+        arrived_at = started + index / rate if rate else started
+        await asyncio.sleep(max(0.0, arrived_at - time.perf_counter()))
+        if processor is None:
+            await timed(update, arrived_at)
+        else:
+            tasks.append(asyncio.create_task(processor.process_update(update, timed(update, arrived_at))))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    # wait for background receipt ingestion before shutting down
+    await application.stop()
+    await application.shutdown()
+    return {
+        "updates_per_sec": len(updates) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "api_calls": dict(request.counts),
+        "calls": request.calls,
+        "statements_per_update": (db_service.statements_executed() - statements) / len(updates),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates-file", help="NDJSON file of recorded updates")
+    parser.add_argument("--updates", type=int, default=2000, help="synthetic updates when no file is given")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-updates", metavar="PATH", help="also write the updates used as NDJSON")
+    parser.add_argument("--save-calls", metavar="PATH",
+                        help="write the Bot API calls of the last mode as NDJSON (method, parameters)")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="simulated Bot API latency (s)")
+    parser.add_argument("--api-jitter", type=float, default=0.0, help="extra random Bot API latency, up to (s)")
+    parser.add_argument("--rate", type=float, default=0.0, help="arrivals per second (0: all at once)")
+    parser.add_argument("--concurrency", type=int, default=main.MAX_CONCURRENT_UPDATES)
+    parser.add_argument("--modes", default="sequential,per-user concurrent")
+    parser.add_argument("--with-rate-limits", action="store_true", help="keep main's throttling enabled")
+    args = parser.parse_args()
+    if not args.with_rate_limits:
+        disable_throttling()
+    # statement counts come from the SQLite trace callback, which only runs while metrics are on
+    metrics.set_enabled(True)
+
+    if args.updates_file:
+        raw_updates = load_updates(args.updates_file)
+    else:
+        raw_updates = list(mixed_updates(args.updates, users=args.users, seed=args.seed))
+    if args.save_updates:
+        save_updates(args.save_updates, raw_updates)
+    kinds = Counter(update_kind(raw) for raw in raw_updates)
+    print(f"{len(raw_updates)} updates: " + ", ".join(f"{n} {kind}" for kind, n in kinds.most_common()))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_service.DB_PATH = os.path.join(tmp, "bench.db")
+        storage_service.UPLOADS_DIR = Path(tmp) / "uploads"
+        db_service.init_db()
+        for mode in args.modes.split(","):
+            result = asyncio.run(_run(mode, raw_updates, args.api_latency, args.concurrency,
+                                      rate=args.rate, api_jitter=args.api_jitter, record=bool(args.save_calls)))
+            calls = result["api_calls"]
+            print(f"{mode:>22}: {result['updates_per_sec']:9.1f} updates/sec  "
+                  f"p50 {result['p50_ms']:8.1f} ms  p99 {result['p99_ms']:8.1f} ms  "
+                  f"{result['statements_per_update']:5.1f} DB statements/update  "
+                  f"{sum(calls.values()) / len(raw_updates):4.2f} API calls/update")
+            print(" " * 24 + ", ".join(f"{method} {n}" for method, n in sorted(calls.items())))
+        if args.save_calls:
+            with open(args.save_calls, "w", encoding="utf-8") as fh:
+                for method, params in result["calls"]:
+                    fh.write(json.dumps({"method": method, "parameters": params}, default=str) + "\n")
+        db_service.close_pool()
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,91 @@
+"""
+Broadcast throughput and flood-wait handling against a local fake Bot API.
+
+Sends a broadcast to --users users through benchmarks.fake_telegram's
+FakeBotAPIServer, which refuses messages beyond --server-rate per second with
+429 (and injects random 429s at --flood-probability). The run is interrupted
+after --interrupt seconds, as if the process died, and then resumed, so the
+report also shows how many messages the resume sent twice and whether anyone
+was missed.
+
+    python -m benchmarks.broadcast --users 2000 --rate 25 --flood-probability 0.01
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from telegram import Bot
+
+import broadcast_service
+import db_service
+from benchmarks.fake_telegram import FakeBotAPIServer
+
+
+async def send(server, broadcast_id, args, interrupt=None):
+    bot = Bot("123456:fake", base_url=f"{server.url}/bot")
+    limiter = broadcast_service.new_limiter(args.rate, args.burst)
+    async with bot:
+        run = asyncio.ensure_future(broadcast_service.run_broadcast(
+            broadcast_id, bot=bot, limiter=limiter, concurrency=args.concurrency, batch_size=args.batch_size))
+        if interrupt is None:
+            return await run
+        await asyncio.sleep(interrupt)
+        run.cancel()
+        try:
+            await run
+        except asyncio.CancelledError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=25, help="messages/sec the sender aims for")
+    parser.add_argument("--burst", type=float, default=5)
+    parser.add_argument("--server-rate", type=int, default=30, help="messages/sec the fake server accepts")
+    parser.add_argument("--flood-probability", type=float, default=0.01)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--blocked", type=float, default=0.02, help="share of users who blocked the bot")
+    parser.add_argument("--concurrency", type=int, default=broadcast_service.CONCURRENCY)
+    parser.add_argument("--batch-size", type=int, default=broadcast_service.BATCH_SIZE)
+    parser.add_argument("--interrupt", type=float, default=5.0, help="seconds before the first run is killed (0: never)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.WARNING)
+    blocked = {user_id for user_id in range(1, args.users + 1) if args.blocked and user_id % round(1 / args.blocked) == 0}
+    server = FakeBotAPIServer(global_rate=args.server_rate, flood_probability=args.flood_probability,
+                              retry_after=args.retry_after, latency=args.latency, blocked=blocked)
+    with tempfile.TemporaryDirectory() as tmp, server:
+        db_service.DB_PATH = os.path.join(tmp, "broadcast.db")
+        db_service.init_db()
+        db_service.create_users_many({"name": f"User {i}", "email": f"user{i}@example.com"}
+                                     for i in range(1, args.users + 1))
+        broadcast_id = db_service.create_broadcast("Benchmark broadcast")
+        started = time.perf_counter()
+        if args.interrupt:
+            asyncio.run(send(server, broadcast_id, args, interrupt=args.interrupt))
+            interrupted = db_service.get_broadcast(broadcast_id)
+            print(f"interrupted after {args.interrupt:.1f}s: {interrupted['sent']} sent recorded, "
+                  f"cursor at user {interrupted['cursor']}, {sum(server.delivered.values())} delivered")
+            # the killed runner's heartbeat has to go stale before another may take over
+            broadcast_service.STALE_AFTER = 0
+            time.sleep(1.1)
+        broadcast = asyncio.run(send(server, broadcast_id, args))
+        elapsed = time.perf_counter() - started
+        db_service.close_pool()
+
+    delivered = sum(server.delivered.values())
+    duplicates = sum(count - 1 for count in server.delivered.values() if count > 1)
+    missed = args.users - len(blocked) - len(server.delivered)
+    print(f"broadcast {broadcast['status']}: {broadcast['sent']} sent, {broadcast['failed']} failed, "
+          f"{broadcast['blocked']} blocked of {broadcast['total']} in {elapsed:.1f}s "
+          f"({delivered / elapsed:.1f} msg/s)")
+    print(f"{server.floods} 429s answered, {duplicates} sent twice after the interruption, {missed} missed")
+
+
+if __name__ == "__main__":
+    main()
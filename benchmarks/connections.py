@@ -0,0 +1,115 @@
+"""
+Compare db_service throughput with a connection opened per call (the old
+behaviour) against the pooled WAL connections.
+
+    python -m benchmarks.connections --threads 8 --ops 2000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import db_service
+
+
+def _legacy_read(path, user_id):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+    row = cur.fetchone()
+    conn.close()
+    return db_service.row_to_dict(row)
+
+
+def _legacy_write(path, user_id):
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO receipts (user_id, amount, status, description, created_at) VALUES (?, ?, ?, ?, ?)",
+        (user_id, 10.0, "pending", None, datetime.utcnow().isoformat()),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _pooled_read(path, user_id):
+    return db_service.get_user_by_id(user_id)
+
+
+def _pooled_write(path, user_id):
+    db_service.create_receipt(user_id, 10.0)
+
+
+def _seed(path, users):
+    db_service.DB_PATH = path
+    db_service.init_db()
+    with db_service.transaction() as conn:
+        conn.executemany(
+            "INSERT INTO users (name, email, created_at) VALUES (?, ?, ?)",
+            ((f"user{i}", f"user{i}@example.com", datetime.utcnow().isoformat()) for i in range(users)),
+        )
+
+
+def _run(read, write, path, threads, ops, write_ratio, users):
+    errors = []
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        try:
+            for _ in range(ops):
+                user_id = rnd.randint(1, users)
+                if rnd.random() < write_ratio:
+                    write(path, user_id)
+                else:
+                    read(path, user_id)
+        except sqlite3.Error as e:
+            errors.append(e)
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return threads * ops / elapsed, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=2000, help="operations per thread")
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for name, read, write in (
+            ("per-call connect", _legacy_read, _legacy_write),
+            ("pooled WAL", _pooled_read, _pooled_write),
+        ):
+            path = os.path.join(tmp, f"{name.split()[0]}.db")
+            _seed(path, args.users)
+            if name.startswith("per-call"):
+                # The legacy code ran with the default rollback journal.
+                db_service.close_pool()
+                conn = sqlite3.connect(path)
+                conn.execute("PRAGMA journal_mode=DELETE")
+                conn.close()
+            results[name] = _run(read, write, path, args.threads, args.ops, args.write_ratio, args.users)
+        db_service.close_pool()
+
+    for name, (ops_per_sec, errors) in results.items():
+        print(f"{name:>18}: {ops_per_sec:10.0f} ops/sec  ({errors} thread(s) failed)")
+    before, after = results["per-call connect"][0], results["pooled WAL"][0]
+    print(f"{'speedup':>18}: {after / before:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Synthetic dataset generator. Writes users and receipts straight into the
+schema created by db_service.init_db(), with receipts spread over users by a
+Zipf-like distribution (a few heavy users, a long tail of light ones) and over
+the last --days days.
+
+    python -m benchmarks.datagen --users 100000 --receipts 5000000 --out bench.db
+
+The triggers that maintain counters, daily rollups and the search index fire as usual;
+balances are rebuilt once at the end with reconcile_balances().
+"""
+import argparse
+import itertools
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import db_service
+
+FIRST_NAMES = ["Ahmed", "Fatima", "Mohammed", "Aisha", "Ali", "Maryam", "Omar", "Sara", "Yousef", "Huda",
+               "Khalid", "Noura", "Hassan", "Layla", "Saleh", "Amal", "Ibrahim", "Reem", "Tariq", "Mona"]
+LAST_NAMES = ["Al-Saadi", "Haddad", "Nasser", "Qasim", "Mansour", "Saleh", "Hamdan", "Yahya", "Farouk", "Zaid"]
+DESCRIPTION_WORDS = ["transfer", "deposit", "kuraimi", "payment", "invoice", "salary", "advance", "refund",
+                     "branch", "sanaa", "aden", "taiz", "monthly", "fee", "bonus", "reimbursement", "cash",
+                     "receipt", "order", "subscription"]
+# status share of generated receipts
+STATUS_WEIGHTS = {"approved": 0.7, "pending": 0.2, "rejected": 0.1}
+CHUNK_SIZE = 50000
+
+
+def zipf_weights(n, skew):
+    """Cumulative weights with P(rank k) proportional to 1 / k**skew, for random.choices(cum_weights=...)."""
+    return list(itertools.accumulate(1.0 / (k ** skew) for k in range(1, n + 1)))
+
+
+def _timestamps(rnd, count, days, now):
+    span = days * 86400
+    for _ in range(count):
+        yield now - timedelta(seconds=rnd.random() * span)
+
+
+def generate_users(conn, count, rnd, days, now, start_id=1):
+    rows = (
+        (f"{rnd.choice(FIRST_NAMES)} {rnd.choice(LAST_NAMES)}", f"user{start_id + i}@example.com",
+         created_at.isoformat())
+        for i, created_at in enumerate(_timestamps(rnd, count, days, now))
+    )
+    conn.executemany("INSERT INTO users (name, email, created_at) VALUES (?, ?, ?)", rows)
+
+
+def generate_receipts(conn, count, user_ids, cum_weights, rnd, days, now):
+    statuses = list(STATUS_WEIGHTS)
+    status_weights = list(STATUS_WEIGHTS.values())
+    owners = rnd.choices(user_ids, cum_weights=cum_weights, k=count)
+    rows = (
+        (
+            owner,
+            round(rnd.lognormvariate(8, 1.2), 2),
+            rnd.choices(statuses, status_weights)[0],
+            " ".join(rnd.sample(DESCRIPTION_WORDS, rnd.randint(1, 4))) if rnd.random() < 0.8 else None,
+            created_at.isoformat(),
+            db_service.to_epoch(created_at),
+        )
+        for owner, created_at in zip(owners, _timestamps(rnd, count, days, now))
+    )
+    conn.executemany(
+        "INSERT INTO receipts (user_id, amount, status, description, created_at, created_ts) "
+        "VALUES (?, ?, ?, ?, ?, ?)", rows
+    )
+
+
+def generate(users, receipts, skew=1.1, days=365, seed=0, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Populate db_service.DB_PATH with `users` users and `receipts` receipts, one
+    transaction per chunk_size rows. The heaviest users are shuffled over the id
+    range so skew does not correlate with id order.
+    """
+    rnd = random.Random(seed)
+    now = datetime.utcnow()
+    db_service.init_db()
+    with db_service.connection() as conn:
+        first_id = (conn.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]) + 1
+    for start in range(0, users, chunk_size):
+        with db_service.transaction() as conn:
+            generate_users(conn, min(chunk_size, users - start), rnd, days, now, first_id + start)
+        if progress:
+            progress("users", start + min(chunk_size, users - start), users)
+
+    user_ids = list(range(first_id, first_id + users))
+    rnd.shuffle(user_ids)
+    cum_weights = zipf_weights(users, skew)
+    for start in range(0, receipts, chunk_size):
+        with db_service.transaction() as conn:
+            generate_receipts(conn, min(chunk_size, receipts - start), user_ids, cum_weights, rnd, days, now)
+        if progress:
+            progress("receipts", start + min(chunk_size, receipts - start), receipts)
+    db_service.reconcile_balances()
+    with db_service.connection() as conn:
+        conn.execute("ANALYZE")
+    return {"users": users, "receipts": receipts, "skew": skew, "days": days, "seed": seed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--receipts", type=int, default=5000000)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of receipts per user")
+    parser.add_argument("--days", type=int, default=365, help="spread created_at over this many days")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench.db")
+    args = parser.parse_args()
+
+    if os.path.exists(args.out):
+        parser.error(f"{args.out} already exists")
+    db_service.DB_PATH = args.out
+    started = time.perf_counter()
+
+    def progress(kind, done, total):
+        elapsed = time.perf_counter() - started
+        print(f"\r{kind}: {done}/{total} ({elapsed:.0f}s)", end="", flush=True)
+        if done == total:
+            print()
+
+    generate(args.users, args.receipts, args.skew, args.days, args.seed, progress=progress)
+    db_service.close_pool()
+    print(f"wrote {args.out} ({os.path.getsize(args.out) / 1e6:.1f} MB) in {time.perf_counter() - started:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
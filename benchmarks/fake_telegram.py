@@ -0,0 +1,318 @@
+"""
+Offline stand-in for the Telegram Bot API and helpers to build raw updates.
+
+FakeTelegramRequest plugs into python-telegram-bot as the request backend
+(ApplicationBuilder().request(...)), answers every Bot API method locally
+with a plausible payload after a simulated latency, and counts the calls.
+FakeBotAPIServer is the same over HTTP, with Telegram's flood limits, for code
+that talks to the Bot API through its own client (TELEGRAM_BASE_URL).
+"""
+import asyncio
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import httpx
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "Zero", "username": "zero_test_bot"}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """
+    Answers Bot API requests without a network. `latency` (seconds) plus up to
+    `jitter` seconds of random delay is applied to every call. Set `record` to
+    keep every (method, parameters) pair in `calls`; `counts` is always kept.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, record: bool = False, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.record = record
+        self.calls = []
+        self.counts = Counter()
+        self._message_ids = itertools.count(1)
+        self._random = random.Random(seed)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.counts[api_method] += 1
+        if self.record:
+            self.calls.append((api_method, params))
+        delay = self.latency + (self._random.random() * self.jitter if self.jitter else 0.0)
+        if delay:
+            await asyncio.sleep(delay)
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, params)}).encode()
+
+    def _result(self, api_method, params):
+        if api_method == "getMe":
+            return BOT_USER
+        if api_method in ("sendMessage", "editMessageText", "sendDocument", "sendPhoto"):
+            chat_id = params.get("chat_id", 0)
+            return {
+                "message_id": params.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        if api_method == "getFile":
+            return {"file_id": params.get("file_id"), "file_unique_id": params.get("file_id"),
+                    "file_size": 0, "file_path": f"photos/{params.get('file_id')}.jpg"}
+        return True
+
+
+def file_transport(size=250_000, latency=0.0):
+    """
+    httpx transport that serves every file download locally with `size`
+    deterministic bytes, for ingestion_service.set_http_client().
+    """
+    async def handler(request):
+        if latency:
+            await asyncio.sleep(latency)
+        seed = request.url.path.encode()
+        body = (seed * (size // max(len(seed), 1) + 1))[:size]
+        return httpx.Response(200, content=body)
+
+    return httpx.MockTransport(handler)
+
+
+class FakeBotAPIServer:
+    """
+    Bot API over local HTTP (getMe, sendMessage and friends, as answered by
+    FakeTelegramRequest) that enforces flood limits like Telegram: a message
+    beyond `global_rate` in the last second, or to a chat that got one less
+    than `per_chat_interval` seconds ago, is answered with 429 and
+    `retry_after`. `flood_probability` adds random 429s on top. Chats in
+    `blocked` get 403. Accepted messages are counted per chat in `delivered`,
+    429s in `floods`.
+
+        with FakeBotAPIServer(flood_probability=0.01) as server:
+            os.environ["TELEGRAM_BASE_URL"] = server.url
+    """
+
+    def __init__(self, global_rate=30, per_chat_interval=1.0, flood_probability=0.0, retry_after=1,
+                 latency=0.0, blocked=(), seed=0, host="127.0.0.1", port=0):
+        self.global_rate = global_rate
+        self.per_chat_interval = per_chat_interval
+        self.flood_probability = flood_probability
+        self.retry_after = retry_after
+        self.latency = latency
+        self.blocked = set(blocked)
+        self.delivered = Counter()
+        self.floods = 0
+        self._answers = FakeTelegramRequest()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent = deque()  # accept times of messages in the last second
+        self._last_by_chat = {}
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-bot-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _admit(self, chat_id):
+        """None to accept a message to chat_id, else the (status, description) to refuse it with."""
+        now = time.monotonic()
+        with self._lock:
+            if chat_id in self.blocked:
+                return 403, "Forbidden: bot was blocked by the user"
+            while self._recent and now - self._recent[0] >= 1.0:
+                self._recent.popleft()
+            last = self._last_by_chat.get(chat_id)
+            if (len(self._recent) >= self.global_rate
+                    or (last is not None and now - last < self.per_chat_interval)
+                    or self._random.random() < self.flood_probability):
+                self.floods += 1
+                return 429, f"Too Many Requests: retry after {self.retry_after}"
+            self._recent.append(now)
+            self._last_by_chat[chat_id] = now
+            self.delivered[chat_id] += 1
+        return None
+
+    def _handle(self, api_method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        if api_method == "sendMessage":
+            refused = self._admit(params.get("chat_id"))
+            if refused is not None:
+                status, description = refused
+                body = {"ok": False, "error_code": status, "description": description}
+                if status == 429:
+                    body["parameters"] = {"retry_after": self.retry_after}
+                return status, body
+        return 200, {"ok": True, "result": self._answers._result(api_method, params)}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                if str(params.get("chat_id", "")).lstrip("-").isdigit():
+                    params["chat_id"] = int(params["chat_id"])
+                status, payload = server._handle(self.path.rsplit("/", 1)[-1], params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except ConnectionError:
+                    pass  # the client gave up (e.g. a cancelled run)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "en"}
+
+
+def _message(message_id, user_id, **fields):
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+    }
+    message.update(fields)
+    return message
+
+
+def command_update(update_id, user_id, command):
+    """Raw update for a `/command` text message."""
+    text = command if command.startswith("/") else f"/{command}"
+    return {
+        "update_id": update_id,
+        "message": _message(update_id, user_id, text=text,
+                            entities=[{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]),
+    }
+
+
+def callback_update(update_id, user_id, data, message_id=1):
+    """Raw update for an inline keyboard button press on the bot's message `message_id`."""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": _message(message_id, user_id, text="Welcome", **{"from": BOT_USER}),
+        },
+    }
+
+
+def photo_update(update_id, user_id, file_size=250_000):
+    """Raw update for a photo message (one size variant)."""
+    file_id = f"photo-{update_id}"
+    return {
+        "update_id": update_id,
+        "message": _message(update_id, user_id, photo=[{
+            "file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960, "file_size": file_size,
+        }]),
+    }
+
+
+def document_update(update_id, user_id, file_name="receipt.pdf", file_size=400_000):
+    """Raw update for a document message."""
+    file_id = f"doc-{update_id}"
+    return {
+        "update_id": update_id,
+        "message": _message(update_id, user_id, document={
+            "file_id": file_id, "file_unique_id": file_id, "file_name": file_name,
+            "mime_type": "application/pdf", "file_size": file_size,
+        }),
+    }
+
+
+# Relative frequency of each kind of update in `mixed_updates`.
+DEFAULT_MIX = (
+    (0.15, lambda uid, user: command_update(uid, user, "/start")),
+    (0.18, lambda uid, user: command_update(uid, user, "/balance")),
+    (0.02, lambda uid, user: command_update(uid, user, "/credit")),
+    (0.40, lambda uid, user: callback_update(uid, user, "balance")),
+    (0.04, lambda uid, user: callback_update(uid, user, "req_sick")),
+    (0.04, lambda uid, user: callback_update(uid, user, "help")),
+    (0.02, lambda uid, user: callback_update(uid, user, "charge_whatsapp")),
+    (0.05, lambda uid, user: command_update(uid, user, "/nope")),
+    (0.07, lambda uid, user: photo_update(uid, user)),
+    (0.03, lambda uid, user: document_update(uid, user)),
+)
+
+
+def mixed_updates(count, users=1000, mix=DEFAULT_MIX, seed=0, skew=1.2):
+    """
+    Yield `count` raw updates drawn from `mix`. Users are picked with a Zipf-like
+    skew so a few users send most updates, as in real traffic.
+    """
+    rnd = random.Random(seed)
+    weights = [1.0 / (rank ** skew) for rank in range(1, users + 1)]
+    user_ids = list(range(10_000, 10_000 + users))
+    kinds = [factory for _, factory in mix]
+    kind_weights = [weight for weight, _ in mix]
+    for update_id in range(1, count + 1):
+        user_id = rnd.choices(user_ids, weights)[0]
+        factory = rnd.choices(kinds, kind_weights)[0]
+        yield factory(update_id, user_id)
+
+
+def load_updates(path):
+    """Recorded raw updates, one Telegram Update JSON object per line (NDJSON)."""
+    with open(path, encoding="utf-8") as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def save_updates(path, raw_updates):
+    """Write raw updates as NDJSON, e.g. to replay the same synthetic mix later."""
+    with open(path, "w", encoding="utf-8") as fh:
+        for raw in raw_updates:
+            fh.write(json.dumps(raw) + "\n")
@@ -0,0 +1,101 @@
+"""
+Bytes and CPU per request for the cached admin list pages.
+
+Requests /admin/users and /admin/receipts pages through the Flask test client
+in four modes and reports response bytes and CPU time per request:
+
+    plain          render cache off, no Accept-Encoding
+    gzip           render cache off, Accept-Encoding: gzip (br too when brotli is installed)
+    gzip+cache     render cache on, so repeated pages skip the query and template
+    revalidate     If-None-Match with the page's ETag, answered with 304
+
+    python -m benchmarks.http_cache --users 20000 --receipts 200000 --requests 500
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import db_service
+from benchmarks import datagen, percentile
+
+PAGES = ["/admin/users", "/admin/users?before={user}", "/admin/receipts", "/admin/receipts?before={receipt}",
+         "/admin/receipts?status=pending", "/admin/receipts?user_id={user}"]
+
+
+def run_mode(client, paths, accept_encoding, render_cache, revalidate):
+    import admin_app
+
+    admin_app.RENDER_CACHE_SECONDS = 3600 if render_cache else 0
+    admin_app.clear_render_cache()
+    headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+    etags = {}
+    if revalidate:
+        for path in set(paths):
+            etags[path] = client.get(path, headers=headers).headers["ETag"]
+    elif render_cache:
+        for path in set(paths):
+            client.get(path, headers=headers)
+    sizes, latencies = [], []
+    cpu_started = time.process_time()
+    for path in paths:
+        request_headers = dict(headers, **({"If-None-Match": etags[path]} if revalidate else {}))
+        started = time.perf_counter()
+        response = client.get(path, headers=request_headers)
+        latencies.append(time.perf_counter() - started)
+        if response.status_code not in (200, 304):
+            raise RuntimeError(f"{path} returned {response.status_code}")
+        sizes.append(len(response.data))
+    cpu = time.process_time() - cpu_started
+    return {
+        "bytes_per_request": sum(sizes) / len(sizes),
+        "cpu_ms_per_request": cpu * 1000 / len(paths),
+        "p50_ms": percentile(latencies, 50) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--receipts", type=int, default=50000)
+    parser.add_argument("--requests", type=int, default=300, help="requests per mode")
+    parser.add_argument("--distinct-pages", type=int, default=20, help="distinct URLs the requests cycle through")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_service.DB_PATH = os.path.join(tmp, "http_cache.db")
+        datagen.generate(args.users, args.receipts, seed=args.seed)
+        from admin_app import app, brotli
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["admin_logged_in"] = True
+            sess["admin_username"] = "bench-admin"
+        rnd = random.Random(args.seed)
+        distinct = [rnd.choice(PAGES).format(user=rnd.randint(1, args.users), receipt=rnd.randint(1, args.receipts))
+                    for _ in range(args.distinct_pages)]
+        paths = [rnd.choice(distinct) for _ in range(args.requests)]
+        encoding = "br, gzip" if brotli is not None else "gzip"
+        modes = {
+            "plain": run_mode(client, paths, None, render_cache=False, revalidate=False),
+            encoding.replace(", ", "+"): run_mode(client, paths, encoding, render_cache=False, revalidate=False),
+            f"{encoding.replace(', ', '+')}+cache": run_mode(client, paths, encoding, render_cache=True,
+                                                             revalidate=False),
+            "revalidate": run_mode(client, paths, encoding, render_cache=True, revalidate=True),
+        }
+        db_service.close_pool()
+
+    plain = modes["plain"]
+    print(f"{args.requests} requests over {len(set(paths))} pages; {args.users} users, {args.receipts} receipts")
+    print(f"{'mode':<16}{'bytes/req':>12}{'saved':>8}{'cpu ms/req':>12}{'saved':>8}{'p50 ms':>10}")
+    for name, result in modes.items():
+        bytes_saved = 1 - result["bytes_per_request"] / plain["bytes_per_request"]
+        cpu_saved = 1 - result["cpu_ms_per_request"] / plain["cpu_ms_per_request"]
+        print(f"{name:<16}{result['bytes_per_request']:>12.0f}{bytes_saved:>8.0%}"
+              f"{result['cpu_ms_per_request']:>12.3f}{cpu_saved:>8.0%}{result['p50_ms']:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+Benchmark suite for db_service and the admin panel routes.
+
+Runs every case against a synthetic dataset (see benchmarks.datagen) and writes
+ops/sec, p50/p99 latency and peak RSS per case as JSON, so runs can be compared:
+
+    python -m benchmarks.datagen --users 100000 --receipts 5000000 --out bench.db
+    python -m benchmarks.suite --db bench.db --output before.json
+    # ... change something ...
+    python -m benchmarks.suite --db bench.db --output after.json --compare before.json
+
+Without --db a small dataset is generated in a temp directory. A --db file is
+copied before the run, so the write cases never modify it. With --compare the
+exit status is 1 when any case got slower than --threshold (relative p50 or
+ops/sec change).
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+import db_service
+from benchmarks import datagen, percentile
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class Case:
+    def __init__(self, name, fn, iterations=None):
+        self.name = name
+        self.fn = fn
+        # cap for expensive cases (password hashing, full rebuilds)
+        self.iterations = iterations
+
+
+def measure(case, rnd, iterations, max_seconds):
+    """Call case.fn(rnd) up to `iterations` times or for about max_seconds, whichever comes first."""
+    if case.iterations is not None:
+        iterations = min(iterations, case.iterations)
+    case.fn(rnd)  # warm-up: prepared statement cache, page cache
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        case.fn(rnd)
+        latencies.append(time.perf_counter() - t0)
+        if t0 - started > max_seconds:
+            break
+    elapsed = time.perf_counter() - started
+    return {
+        "iterations": len(latencies),
+        "ops_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _dataset_info():
+    with db_service.connection() as conn:
+        max_user = conn.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]
+        max_receipt = conn.execute("SELECT COALESCE(MAX(id), 0) FROM receipts").fetchone()[0]
+    return {"users": db_service.count_users(), "receipts": db_service.count_receipts(),
+            "max_user_id": max_user, "max_receipt_id": max_receipt}
+
+
+def read_cases(info):
+    max_user, max_receipt = max(info["max_user_id"], 1), max(info["max_receipt_id"], 1)
+    db_service.create_admin("bench-admin", "bench-password")
+    db_service.retain_blob("0" * 64, 1)
+
+    def user_id(rnd):
+        return rnd.randint(1, max_user)
+
+    def receipt_id(rnd):
+        return rnd.randint(1, max_receipt)
+
+    def iter_first_page(rnd):
+        rows = db_service.iter_receipts(status="approved", batch_size=db_service.MAX_PAGE_SIZE)
+        for _ in itertools.islice(rows, db_service.MAX_PAGE_SIZE):
+            pass
+        rows.close()
+
+    return [
+        Case("get_user_by_id", lambda rnd: db_service.get_user_by_id(user_id(rnd))),
+        Case("get_users(limit=50)", lambda rnd: db_service.get_users(limit=50, offset=rnd.randint(0, 1000))),
+        Case("count_users", lambda rnd: db_service.count_users()),
+        Case("get_users_page", lambda rnd: db_service.get_users_page(before=user_id(rnd))),
+        Case("get_receipt_by_id", lambda rnd: db_service.get_receipt_by_id(receipt_id(rnd))),
+        Case("get_receipts(limit=50)", lambda rnd: db_service.get_receipts(limit=50, offset=rnd.randint(0, 1000))),
+        Case("get_receipts_by_user", lambda rnd: db_service.get_receipts_by_user(user_id(rnd))),
+        Case("get_receipts_page", lambda rnd: db_service.get_receipts_page(before=receipt_id(rnd))),
+        Case("get_receipts_page(status)", lambda rnd: db_service.get_receipts_page(
+            before=receipt_id(rnd), status=rnd.choice(db_service.RECEIPT_STATUSES))),
+        Case("get_receipts_page(user_id)", lambda rnd: db_service.get_receipts_page(user_id=user_id(rnd))),
+        Case("get_pending_receipts", lambda rnd: db_service.get_pending_receipts(after_id=receipt_id(rnd))),
+        Case("iter_receipts(first 500)", iter_first_page),
+        Case("count_receipts", lambda rnd: db_service.count_receipts()),
+        Case("count_receipts_by_status", lambda rnd: db_service.count_receipts_by_status()),
+        Case("get_balance", lambda rnd: db_service.get_balance(user_id(rnd))),
+        Case("get_counter", lambda rnd: db_service.get_counter("receipts:pending")),
+        Case("get_counters", lambda rnd: db_service.get_counters()),
+        Case("dashboard_snapshot", lambda rnd: db_service.dashboard_snapshot()),
+        Case("get_daily_rollups(365 days)", lambda rnd: db_service.get_daily_rollups(*db_service.day_window(365))),
+        Case("get_rollup_totals(7 days)", lambda rnd: db_service.get_rollup_totals(*db_service.day_window(7))),
+        Case("search(receipts)", lambda rnd: db_service.search(rnd.choice(datagen.DESCRIPTION_WORDS))),
+        Case("search(users)", lambda rnd: db_service.search(rnd.choice(datagen.FIRST_NAMES), kind="users")),
+        Case("get_blob", lambda rnd: db_service.get_blob("0" * 64)),
+        Case("get_admin_by_username", lambda rnd: db_service.get_admin_by_username("bench-admin")),
+        Case("check_admin_credentials", lambda rnd: db_service.check_admin_credentials(
+            "bench-admin", "bench-password"), iterations=20),
+        Case("get_schema_version", lambda rnd: db_service.get_schema_version()),
+        Case("explain_query_plan", lambda rnd: db_service.explain_query_plan(
+            db_service.HOT_QUERIES["receipts by user"][0], db_service.HOT_QUERIES["receipts by user"][1])),
+    ]
+
+
+def write_cases(info):
+    max_user, max_receipt = max(info["max_user_id"], 1), max(info["max_receipt_id"], 1)
+    serial = itertools.count()
+
+    def user_id(rnd):
+        return rnd.randint(1, max_user)
+
+    def new_users(n):
+        now = datetime.utcnow().isoformat()
+        return [{"name": "Bench User", "email": f"bench{next(serial)}@example.com", "created_at": now}
+                for _ in range(n)]
+
+    def blob_round_trip(rnd):
+        digest = f"{next(serial):064x}"
+        db_service.retain_blob(digest, 1)
+        db_service.release_blob(digest)
+
+    return [
+        Case("create_user", lambda rnd: db_service.create_user("Bench User", f"bench{next(serial)}@example.com")),
+        Case("create_receipt", lambda rnd: db_service.create_receipt(user_id(rnd), 100.0, description="bench")),
+        Case("set_receipt_status", lambda rnd: db_service.set_receipt_status(
+            rnd.randint(1, max_receipt), rnd.choice(db_service.RECEIPT_STATUSES))),
+        Case("set_receipt_statuses(100)", lambda rnd: db_service.set_receipt_statuses(
+            (rnd.randint(1, max_receipt), rnd.choice(db_service.RECEIPT_STATUSES)) for _ in range(100))),
+        Case("create_users_many(100)", lambda rnd: db_service.create_users_many(new_users(100))),
+        Case("create_receipts_many(100)", lambda rnd: db_service.create_receipts_many(
+            {"user_id": user_id(rnd), "amount": 100.0} for _ in range(100))),
+        Case("retain_blob+release_blob", blob_round_trip),
+        Case("create_admin", lambda rnd: db_service.create_admin(f"bench-admin-{next(serial)}", "pw"),
+             iterations=20),
+        Case("init_db (up to date)", lambda rnd: db_service.init_db(), iterations=50),
+        Case("reconcile_balances", lambda rnd: db_service.reconcile_balances(), iterations=3),
+    ]
+
+
+def route_cases(info):
+    from admin_app import app
+
+    max_user, max_receipt = max(info["max_user_id"], 1), max(info["max_receipt_id"], 1)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["admin_logged_in"] = True
+        sess["admin_username"] = "bench-admin"
+
+    def get(path_fn):
+        def fn(rnd):
+            response = client.get(path_fn(rnd))
+            if response.status_code != 200:
+                raise RuntimeError(f"{response.request.path} returned {response.status_code}")
+            response.close()
+        return fn
+
+    return [
+        Case("GET /admin/dashboard", get(lambda rnd: "/admin/dashboard")),
+        Case("GET /admin/users", get(lambda rnd: "/admin/users")),
+        Case("GET /admin/users?before=", get(lambda rnd: f"/admin/users?before={rnd.randint(1, max_user)}")),
+        Case("GET /admin/receipts", get(lambda rnd: "/admin/receipts")),
+        Case("GET /admin/receipts?before=",
+             get(lambda rnd: f"/admin/receipts?before={rnd.randint(1, max_receipt)}")),
+        Case("GET /admin/receipts?status=",
+             get(lambda rnd: f"/admin/receipts?status={rnd.choice(db_service.RECEIPT_STATUSES)}")),
+        Case("GET /admin/receipts?user_id=",
+             get(lambda rnd: f"/admin/receipts?user_id={rnd.randint(1, max_user)}")),
+    ]
+
+
+def run(iterations, max_seconds, name_filter=None, seed=0, progress=None):
+    info = _dataset_info()
+    rnd = random.Random(seed)
+    results = {}
+    # reads first so they see the dataset as generated
+    for group in (read_cases, route_cases, write_cases):
+        for case in group(info):
+            if name_filter and name_filter not in case.name:
+                continue
+            results[case.name] = measure(case, rnd, iterations, max_seconds)
+            if progress:
+                progress(case.name, results[case.name])
+    return {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "dataset": info,
+            "iterations": iterations,
+            "max_seconds": max_seconds,
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """Print per-case changes against a baseline run; return the names of regressed cases."""
+    regressions = []
+    print(f"\n{'case':<32} {'ops/sec':>12} {'change':>8} {'p50 ms':>10} {'change':>8}")
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:<32} {result['ops_per_sec']:12.1f} {'new':>8}")
+            continue
+        ops_change = result["ops_per_sec"] / before["ops_per_sec"] - 1 if before["ops_per_sec"] else 0.0
+        p50_change = result["p50_ms"] / before["p50_ms"] - 1 if before["p50_ms"] else 0.0
+        regressed = ops_change < -threshold or p50_change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<32} {result['ops_per_sec']:12.1f} {ops_change:+8.1%} {result['p50_ms']:10.3f} "
+              f"{p50_change:+8.1%}{'  REGRESSED' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="dataset from benchmarks.datagen (copied, never modified)")
+    parser.add_argument("--users", type=int, default=2000, help="generated dataset size when --db is not given")
+    parser.add_argument("--receipts", type=int, default=50000)
+    parser.add_argument("--iterations", type=int, default=1000, help="maximum iterations per case")
+    parser.add_argument("--max-seconds", type=float, default=2.0, help="time budget per case")
+    parser.add_argument("--filter", help="only run cases whose name contains this text")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="baseline JSON from an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.25, help="relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+
+    def progress(name, result):
+        print(f"{name:<32} {result['ops_per_sec']:12.1f} ops/sec  p50 {result['p50_ms']:9.3f} ms  "
+              f"p99 {result['p99_ms']:9.3f} ms  ({result['iterations']} runs)", flush=True)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_service.DB_PATH = os.path.join(tmp, "bench.db")
+        if args.db:
+            source = sqlite3.connect(args.db)
+            target = sqlite3.connect(db_service.DB_PATH)
+            source.backup(target)
+            source.close()
+            target.close()
+            db_service.init_db()
+        else:
+            print(f"generating {args.users} users / {args.receipts} receipts ...", flush=True)
+            datagen.generate(args.users, args.receipts)
+        report = run(args.iterations, args.max_seconds, args.filter, progress=progress)
+        db_service.close_pool()
+
+    report["meta"]["peak_rss_mb"] = peak_rss_mb()
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+        print(f"wrote {args.output}")
+    if baseline is not None and compare(report, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
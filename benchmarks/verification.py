@@ -0,0 +1,75 @@
+"""
+Throughput benchmark for verification_worker against a local fake verifier
+with injectable latency, failure rate and rejection rate.
+
+    python -m benchmarks.verification --receipts 10000 --concurrency 200 --latency 1.0
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+
+import db_service
+from verification_worker import VerificationWorker
+
+
+class FakeVerifier:
+    """
+    Stand-in for payment_service.verify_kuraimi_payment. Each call sleeps
+    `latency` (+ up to `jitter`) seconds, raises with probability `failure_rate`
+    and otherwise rejects with probability `reject_rate`.
+    """
+
+    def __init__(self, latency=1.0, jitter=0.0, failure_rate=0.0, reject_rate=0.1, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.reject_rate = reject_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+
+    async def __call__(self, amount, receipt_file_path):
+        self.calls += 1
+        await asyncio.sleep(self.latency + self._random.random() * self.jitter)
+        if self._random.random() < self.failure_rate:
+            raise ConnectionError("simulated verifier failure")
+        return self._random.random() >= self.reject_rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--receipts", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    parser.add_argument("--reject-rate", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=5.0)
+    parser.add_argument("--retries", type=int, default=2)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_service.DB_PATH = os.path.join(tmp, "bench.db")
+        db_service.init_db()
+        db_service.create_receipts_many(
+            {"user_id": i % 1000, "amount": 100 + i % 50} for i in range(args.receipts)
+        )
+        verifier = FakeVerifier(args.latency, args.jitter, args.failure_rate, args.reject_rate)
+        worker = VerificationWorker(verifier, concurrency=args.concurrency, batch_size=args.batch_size,
+                                    timeout=args.timeout, retries=args.retries, backoff=0.1)
+        report = asyncio.run(worker.run(once=True))
+        db_service.close_pool()
+
+    serial_hours = args.receipts * args.latency / 3600
+    print(f"{report['verified']} verified ({report['approved']} approved, {report['rejected']} rejected), "
+          f"{report['failed']} failed, {verifier.calls} verifier calls")
+    print(f"{report['per_sec']:.1f} receipts/sec in {report['elapsed']:.1f}s "
+          f"(one at a time would take ~{serial_hours:.2f}h); {report['pending']} still pending")
+
+
+if __name__ == "__main__":
+    main()
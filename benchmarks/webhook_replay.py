@@ -0,0 +1,110 @@
+"""
+Offline end-to-end test of webhook mode: starts the bot's webhook server on
+localhost against FakeTelegramRequest, POSTs recorded (or synthetic) update
+JSON to it with the secret token, and reports throughput, HTTP ack latency and
+end-to-end latency (POST sent -> handler finished).
+
+    python -m benchmarks.webhook_replay --updates-file recorded.ndjson
+    python -m benchmarks.webhook_replay --updates 2000 --clients 32
+
+Recorded updates are one Telegram Update JSON object per line.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import db_service
+import ingestion_service
+import main
+import storage_service
+from benchmarks.bot_updates import disable_throttling, percentile
+from benchmarks.fake_telegram import FakeTelegramRequest, file_transport, load_updates, mixed_updates
+
+SECRET = "offline-replay-secret"
+# Runs after the real handlers (group 0) to timestamp completion.
+_DONE_GROUP = 99
+
+
+async def _replay(raw_updates, port, clients, api_latency):
+    application = main.build_application("123456:TEST", request=FakeTelegramRequest(latency=api_latency))
+    sent_at, acked, finished = {}, [], []
+    all_done = asyncio.Event()
+
+    async def mark_done(update, context):
+        finished.append(time.perf_counter() - sent_at[update.update_id])
+        if len(finished) == len(raw_updates):
+            all_done.set()
+
+    application.add_handler(TypeHandler(Update, mark_done), group=_DONE_GROUP)
+    ingestion_service.set_http_client(httpx.AsyncClient(transport=file_transport(latency=api_latency)))
+    await application.initialize()
+    await application.updater.start_webhook(listen="127.0.0.1", port=port, url_path="telegram",
+                                            secret_token=SECRET)
+    await application.start()
+
+    url = f"http://127.0.0.1:{port}/telegram"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+    async with httpx.AsyncClient(timeout=30) as client:
+        rejected = await client.post(url, json=raw_updates[0], headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        assert rejected.status_code == 403, f"bad secret token accepted ({rejected.status_code})"
+
+        pending = iter(raw_updates)
+
+        async def poster():
+            for raw in pending:
+                sent_at[raw["update_id"]] = started = time.perf_counter()
+                response = await client.post(url, json=raw, headers=headers)
+                response.raise_for_status()
+                acked.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(poster() for _ in range(clients)))
+        await asyncio.wait_for(all_done.wait(), timeout=120)
+        elapsed = time.perf_counter() - started
+
+    # Same order as run_webhook's shutdown: stop intake, drain, shut down.
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    return {
+        "updates_per_sec": len(raw_updates) / elapsed,
+        "ack_p50_ms": percentile(acked, 50) * 1000,
+        "ack_p99_ms": percentile(acked, 99) * 1000,
+        "e2e_p50_ms": percentile(finished, 50) * 1000,
+        "e2e_p99_ms": percentile(finished, 99) * 1000,
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates-file", help="NDJSON file of recorded updates")
+    parser.add_argument("--updates", type=int, default=1000, help="synthetic updates when no file is given")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent HTTP posters")
+    parser.add_argument("--port", type=int, default=18443)
+    parser.add_argument("--api-latency", type=float, default=0.02, help="simulated Bot API latency (s)")
+    parser.add_argument("--with-rate-limits", action="store_true", help="keep main's throttling enabled")
+    args = parser.parse_args()
+    if not args.with_rate_limits:
+        disable_throttling()
+
+    raw_updates = load_updates(args.updates_file) if args.updates_file else list(mixed_updates(args.updates))
+    with tempfile.TemporaryDirectory() as tmp:
+        db_service.DB_PATH = os.path.join(tmp, "bench.db")
+        storage_service.UPLOADS_DIR = Path(tmp) / "uploads"
+        db_service.init_db()
+        result = asyncio.run(_replay(raw_updates, args.port, args.clients, args.api_latency))
+        db_service.close_pool()
+    print(f"{len(raw_updates)} updates: {result['updates_per_sec']:.1f} updates/sec")
+    print(f"  webhook ack  p50 {result['ack_p50_ms']:7.1f} ms  p99 {result['ack_p99_ms']:7.1f} ms")
+    print(f"  end-to-end   p50 {result['e2e_p50_ms']:7.1f} ms  p99 {result['e2e_p99_ms']:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,228 @@
+"""
+Broadcasts: one text message to every user, started from the admin panel.
+
+Users are messaged in their private chat with the bot, whose id is the user
+id (the Telegram id, as in receipts.user_id). run_broadcast() works through a
+broadcast with three kinds of asyncio task:
+
+    fetcher   reads the next BROADCAST_BATCH_SIZE recipients after the cursor
+              (db_service.get_broadcast_recipients) into a bounded queue, so
+              memory stays flat however many users there are
+    senders   BROADCAST_CONCURRENCY tasks that take one token per message from
+              a RateLimiter (BROADCAST_RATE overall, one message per second
+              per chat) and send it; a flood wait (429 RetryAfter) pauses all
+              senders for retry_after and halves the rate, which then recovers
+    writer    every BROADCAST_FLUSH_INTERVAL seconds stores the outcomes so far,
+              the cursor and the send rate in one transaction, and stops the
+              run when the broadcast was paused or cancelled meanwhile
+
+A recipient is only skipped on a later run once its outcome is stored, so an
+interrupted broadcast resumes where it stopped; at most the messages of the
+last flush interval are sent twice. Run or resume one from the command line:
+
+    flask run-broadcast <id>
+
+Point TELEGRAM_BASE_URL at a local server, e.g. benchmarks.fake_telegram's
+FakeBotAPIServer, to try a broadcast without Telegram.
+"""
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+
+import db_service
+import metrics
+from config import BOT_TOKEN, TELEGRAM_BASE_URL
+from rate_limiter import RateLimiter, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall and one per second per chat
+RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BURST = float(os.getenv("BROADCAST_BURST", "5"))
+CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "16"))
+BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))
+FLUSH_INTERVAL = float(os.getenv("BROADCAST_FLUSH_INTERVAL", "1.0"))
+# Sends per recipient before a network error counts as a failed delivery (flood waits are not counted)
+MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "5"))
+# A running broadcast whose runner has not written for this long may be taken over
+STALE_AFTER = int(os.getenv("BROADCAST_STALE_AFTER", "60"))
+
+MESSAGES = metrics.Counter("broadcast_messages_total", "Broadcast deliveries by outcome.", ("status",))
+FLOOD_WAITS = metrics.Counter("broadcast_flood_waits_total", "429 RetryAfter answers during broadcasts.")
+
+
+def runner_id() -> str:
+    """Identifies this runner in broadcasts.owner."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def new_limiter(rate: float = RATE, burst: float = BURST) -> RateLimiter:
+    # after a flood wait halves the rate it climbs back to full speed within ~5s
+    return RateLimiter(1.0, 1.0, rate, burst, recovery_rate=rate / 10)
+
+
+def build_bot(concurrency: int = CONCURRENCY) -> Bot:
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN is not set")
+    kwargs = {"base_url": f"{TELEGRAM_BASE_URL.rstrip('/')}/bot"} if TELEGRAM_BASE_URL else {}
+    return Bot(BOT_TOKEN, request=HTTPXRequest(connection_pool_size=concurrency), **kwargs)
+
+
+class _Run:
+    def __init__(self, broadcast, bot, owner, limiter, concurrency, batch_size):
+        self.broadcast_id = broadcast["id"]
+        self.text = broadcast["text"]
+        self.cursor = broadcast["cursor"]
+        self.bot = bot
+        self.owner = owner
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue(maxsize=batch_size)
+        self.stopping = asyncio.Event()
+        # [last user id, recipients without an outcome] per fetched batch, oldest first
+        self.batches = deque()
+        self.results = []
+        self.sent_since_flush = 0
+        self.flushed_at = time.monotonic()
+
+    async def fetch(self):
+        try:
+            while not self.stopping.is_set():
+                ids = await asyncio.to_thread(db_service.get_broadcast_recipients, self.broadcast_id,
+                                              self.cursor, self.batch_size)
+                if not ids:
+                    return
+                batch = [ids[-1], len(ids)]
+                self.batches.append(batch)
+                for user_id in ids:
+                    if self.stopping.is_set():
+                        return
+                    await self.queue.put((user_id, batch))
+                self.cursor = ids[-1]
+        finally:
+            for _ in range(self.concurrency):
+                await self.queue.put(None)
+
+    async def send(self):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            if self.stopping.is_set():
+                # no outcome stored, so a resumed run sends it
+                continue
+            user_id, batch = item
+            outcome = await self.deliver(user_id)
+            if outcome is None:
+                continue
+            self.results.append((user_id, *outcome))
+            batch[1] -= 1
+            MESSAGES.inc(status=outcome[0])
+            if outcome[0] == "sent":
+                self.sent_since_flush += 1
+
+    async def deliver(self, user_id):
+        """(status, attempts, error) for one recipient, or None when the run stopped first."""
+        attempts = 0
+        while not self.stopping.is_set():
+            await self.limiter.acquire(user_id)
+            if self.stopping.is_set():
+                break
+            attempts += 1
+            try:
+                await self.bot.send_message(user_id, self.text)
+                return "sent", attempts, None
+            except RetryAfter as e:
+                FLOOD_WAITS.inc()
+                self.limiter.penalize(retry_after_seconds(e))
+                attempts -= 1
+            except Forbidden as e:
+                # blocked the bot or deactivated
+                return "blocked", attempts, str(e)
+            except BadRequest as e:
+                return "failed", attempts, str(e)
+            except NetworkError as e:
+                if attempts >= MAX_ATTEMPTS:
+                    return "failed", attempts, str(e)
+                await asyncio.sleep(min(2 ** attempts, 30))
+            except TelegramError as e:
+                return "failed", attempts, str(e)
+        return None
+
+    async def flush(self):
+        results, self.results = self.results, []
+        cursor = None
+        while self.batches and not self.batches[0][1]:
+            cursor = self.batches.popleft()[0]
+        now = time.monotonic()
+        rate = self.sent_since_flush / max(now - self.flushed_at, 1e-6)
+        self.sent_since_flush, self.flushed_at = 0, now
+        status = await asyncio.to_thread(db_service.record_broadcast_deliveries, self.broadcast_id, self.owner,
+                                         results, cursor, rate)
+        if status != "running" and not self.stopping.is_set():
+            logger.info("Broadcast %s is %s, stopping", self.broadcast_id, status or "taken over")
+            self.stopping.set()
+
+    async def run(self):
+        fetcher = asyncio.create_task(self.fetch())
+        pending = {asyncio.create_task(self.send()) for _ in range(self.concurrency)}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=FLUSH_INTERVAL)
+                await self.flush()
+                for task in done:
+                    task.result()
+            await fetcher
+        finally:
+            self.stopping.set()
+            for task in (fetcher, *pending):
+                task.cancel()
+        if await asyncio.to_thread(db_service.finish_broadcast, self.broadcast_id, self.owner):
+            logger.info("Broadcast %s completed", self.broadcast_id)
+
+
+async def run_broadcast(broadcast_id, bot=None, owner=None, limiter=None, concurrency=CONCURRENCY,
+                        batch_size=BATCH_SIZE):
+    """Claim broadcast `broadcast_id` and send it until it is done, paused or cancelled.
+
+    Returns the broadcast as it was left, or None when it could not be claimed
+    (it does not exist, is finished, paused, or another runner is active).
+    """
+    owner = owner or runner_id()
+    if not await asyncio.to_thread(db_service.claim_broadcast, broadcast_id, owner, STALE_AFTER):
+        return None
+    broadcast = await asyncio.to_thread(db_service.get_broadcast, broadcast_id)
+    own_bot = bot is None
+    if own_bot:
+        bot = build_bot(concurrency)
+    try:
+        if own_bot:
+            await bot.initialize()
+        await _Run(broadcast, bot, owner, limiter or new_limiter(), concurrency, batch_size).run()
+    finally:
+        if own_bot:
+            await bot.shutdown()
+    return await asyncio.to_thread(db_service.get_broadcast, broadcast_id)
+
+
+def start(broadcast_id) -> threading.Thread:
+    """Run a broadcast on a background thread with its own event loop (used by the admin panel)."""
+    def target():
+        try:
+            asyncio.run(run_broadcast(broadcast_id))
+        except Exception:
+            logger.exception("Broadcast %s failed", broadcast_id)
+
+    thread = threading.Thread(target=target, name=f"broadcast-{broadcast_id}", daemon=True)
+    thread.start()
+    return thread
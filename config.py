@@ -20,3 +20,33 @@ ADMIN_WHATSAPP_NUMBER = os.getenv("ADMIN_WHATSAPP_NUMBER", "")
 
 # Optional base URL for file access if you host uploads somewhere
 FILES_BASE_URL = os.getenv("FILES_BASE_URL", "")
+
+# How the main bot receives updates: "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+
+# Webhook settings (used when BOT_MODE=webhook). WEBHOOK_URL is the public HTTPS
+# base URL Telegram posts to; the bot listens locally on WEBHOOK_LISTEN:WEBHOOK_PORT.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token; requests without it are rejected
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")
+
+# Maximum number of received updates waiting to be handled. When full, the
+# webhook stops acknowledging so Telegram backs off and retries.
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+
+# Port for the bot's Prometheus /metrics endpoint (0 disables it). The admin
+# app serves its metrics on its own /metrics route.
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Address it binds to; only local scrapers by default. Set 0.0.0.0 (ideally with
+# METRICS_TOKEN) to expose it.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# When set, scrapers must send "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Bot API server for outgoing requests that are not replies, such as admin
+# broadcasts (default https://api.telegram.org). Point it at a local Bot API
+# server, or at benchmarks.fake_telegram.FakeBotAPIServer for testing.
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "")
@@ -1,80 +1,788 @@
+import functools
+import itertools
+import json
+import logging
+import math
 import os
+import queue
+import re
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
 from werkzeug.security import generate_password_hash, check_password_hash
 
+import db_backends
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# DATABASE_URL selects the backend (see db_backends). A sqlite:/// URL only sets
+# DB_PATH, so afterwards DATABASE_URL is non-empty only for PostgreSQL.
+DATABASE_URL = os.getenv("DATABASE_URL", "")
 DB_PATH = os.getenv("DATABASE_PATH", "./data.db")
+if db_backends.parse_database_url(DATABASE_URL, DB_PATH)[0] == "sqlite":
+    DB_PATH = db_backends.parse_database_url(DATABASE_URL, DB_PATH)[1]
+    DATABASE_URL = ""
 
-def get_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+# Connection pool tuning (see .env.sample)
+POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "8"))
+BUSY_TIMEOUT = float(os.getenv("DATABASE_BUSY_TIMEOUT", "5.0"))
+CACHE_SIZE_KB = int(os.getenv("DATABASE_CACHE_SIZE_KB", "20000"))
+MMAP_SIZE = int(os.getenv("DATABASE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SYNCHRONOUS = os.getenv("DATABASE_SYNCHRONOUS", "NORMAL")
+# Prepared statements: compiled statements cached per SQLite connection, and on
+# PostgreSQL the number of runs after which a statement is PREPAREd (0 = never).
+STATEMENT_CACHE_SIZE = int(os.getenv("DATABASE_STATEMENT_CACHE_SIZE", "256"))
+PREPARE_THRESHOLD = int(os.getenv("DATABASE_PREPARE_THRESHOLD", "5"))
+
+# Statement tracing
+# While metrics are enabled, every execute()/executemany() is timed per
+# statement shape and statements slower than SLOW_QUERY_MS are logged (0 turns
+# the slow-query log off). SQLite's trace callback additionally counts every
+# statement the engine runs, including trigger bodies, which execute() never
+# sees. metrics.set_enabled(False) switches all of it off at runtime.
+SLOW_QUERY_MS = float(os.getenv("DATABASE_SLOW_QUERY_MS", "250"))
+
+STATEMENT_SECONDS = metrics.Histogram(
+    "db_statement_duration_seconds", "Time spent in execute()/executemany() per statement.", ("statement",)
+)
+STATEMENTS_EXECUTED = metrics.Counter(
+    "db_statements_executed_total", "Statements run by SQLite, including those fired by triggers."
+)
+_PLACEHOLDER_LIST_RE = re.compile(r"\(\?(?:\s*,\s*\?)+\)")
+
+
+@functools.lru_cache(maxsize=1024)
+def _statement_label(sql):
+    """Collapse whitespace and variable-length IN (?, ?, ...) lists so the label set stays small."""
+    return _PLACEHOLDER_LIST_RE.sub("(?, ...)", " ".join(sql.split()))[:200]
+
+
+def _count_statement(sql):
+    STATEMENTS_EXECUTED.inc()
+
+
+def _observe_statement(sql, params, elapsed):
+    STATEMENT_SECONDS.observe(elapsed, statement=_statement_label(sql))
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        if isinstance(params, (list, tuple, dict)):
+            shown = repr(params)[:200]
+        else:
+            shown = "<iterable>"
+        logger.warning("Slow query (%.1f ms): %s params=%s", elapsed * 1000, _statement_label(sql), shown)
+
+
+class _TracedConnection(sqlite3.Connection):
+    traced = False
+
+    def execute(self, sql, parameters=(), /):
+        if not metrics.enabled():
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe_statement(sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        if not metrics.enabled():
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe_statement(sql, seq_of_parameters, time.perf_counter() - started)
+
+
+def _sync_trace_callback(conn):
+    # The trace callback costs a Python call per statement, so it is only
+    # installed while metrics are on; checked whenever a connection is handed out.
+    enabled = metrics.enabled()
+    if conn.traced != enabled:
+        conn.set_trace_callback(_count_statement if enabled else None)
+        conn.traced = enabled
+
+
+def _observe_postgres_statement(sql, params, elapsed):
+    # PostgreSQL has no trace callback; count statements as they are sent instead
+    if metrics.enabled():
+        STATEMENTS_EXECUTED.inc()
+        _observe_statement(sql, params, elapsed)
+
+
+def statements_executed():
+    """Statements SQLite has run in this process while metrics were enabled."""
+    return STATEMENTS_EXECUTED.total()
+
+# One backend and one LIFO queue of idle connections per database (DB_PATH or
+# DATABASE_URL), so changing DB_PATH at runtime (tests, benchmarks) never hands
+# out a connection to the old file.
+_backends = {}
+_pools = {}
+_pools_lock = threading.Lock()
+# The connection currently checked out by this thread, so nested
+# connection()/transaction() blocks share it instead of taking another one.
+_local = threading.local()
+
+
+def _create_backend(key):
+    if key == DATABASE_URL:
+        return db_backends.PostgresBackend(DATABASE_URL, connect_timeout=max(1, int(BUSY_TIMEOUT)),
+                                           prepare_threshold=PREPARE_THRESHOLD,
+                                           prepared_cache=STATEMENT_CACHE_SIZE,
+                                           observe=_observe_postgres_statement)
+    return db_backends.SQLiteBackend(key, timeout=BUSY_TIMEOUT, factory=_TracedConnection,
+                                     statement_cache=STATEMENT_CACHE_SIZE, pragmas=[
+        "PRAGMA journal_mode=WAL",
+        f"PRAGMA synchronous={SYNCHRONOUS}",
+        f"PRAGMA cache_size=-{CACHE_SIZE_KB}",
+        f"PRAGMA mmap_size={MMAP_SIZE}",
+        f"PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}",
+        "PRAGMA temp_store=MEMORY",
+    ])
+
+
+def get_backend():
+    """The backend for DATABASE_URL (PostgreSQL) or else DB_PATH (SQLite)."""
+    key = DATABASE_URL or DB_PATH
+    backend = _backends.get(key)
+    if backend is None:
+        with _pools_lock:
+            backend = _backends.get(key)
+            if backend is None:
+                backend = _backends[key] = _create_backend(key)
+    return backend
+
+
+def _get_pool(key):
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = queue.LifoQueue(maxsize=POOL_SIZE)
+        return pool
+
+
+def _acquire(backend):
+    try:
+        conn = _get_pool(backend.key).get_nowait()
+    except queue.Empty:
+        conn = backend.connect()
+    if isinstance(conn, _TracedConnection):
+        _sync_trace_callback(conn)
     return conn
 
+
+def _release(backend, conn):
+    if not backend.is_usable(conn):
+        conn.close()
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _get_pool(backend.key).put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+def get_connection():
+    """Open a standalone, tuned connection. Callers own it and must close it."""
+    return get_backend().connect()
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled connection for the duration of the block.
+
+    Re-entrant: a nested block on the same thread reuses the outer connection.
+    Safe to use from Flask request threads and bot worker threads alike.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        yield conn
+        return
+    backend = get_backend()
+    conn = _acquire(backend)
+    _local.conn = conn
+    try:
+        yield conn
+    finally:
+        _local.conn = None
+        _release(backend, conn)
+
+
+@contextmanager
+def transaction():
+    """Run the block in a single write transaction (BEGIN IMMEDIATE ... COMMIT on SQLite).
+
+    Rolls back on any exception. Nested transaction() blocks become savepoints,
+    so helpers can be composed into one atomic unit of work.
+    """
+    with connection() as conn:
+        if conn.in_transaction:
+            conn.execute("SAVEPOINT nested")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK TO nested")
+                conn.execute("RELEASE nested")
+                raise
+            conn.execute("RELEASE nested")
+            return
+        conn.execute(get_backend().begin_write)
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+def close_pool():
+    """Close every idle pooled connection (e.g. on process shutdown)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
 def row_to_dict(row):
     if row is None:
         return None
     return {k: row[k] for k in row.keys()}
 
-def init_db():
-    conn = get_connection()
-    cur = conn.cursor()
+SCHEMA = [
     # admins table
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS admins (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        )
-    ''')
+    '''
+    CREATE TABLE IF NOT EXISTS admins (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    ''',
     # users table (example)
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            created_at TEXT NOT NULL
-        )
-    ''')
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        created_at TEXT NOT NULL
+    )
+    ''',
     # receipts table (example)
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS receipts (
+    '''
+    CREATE TABLE IF NOT EXISTS receipts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        status TEXT NOT NULL,
+        description TEXT,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    )
+    ''',
+]
+
+def _schema(backend):
+    """(base schema, migrations) in the backend's SQL dialect."""
+    if backend.name == "postgres":
+        return db_backends.POSTGRES_SCHEMA, db_backends.POSTGRES_MIGRATIONS
+    return SCHEMA, MIGRATIONS
+
+def init_db():
+    with transaction() as conn:
+        for statement in _schema(get_backend())[0]:
+            conn.execute(statement)
+    migrate()
+
+# Schema migrations
+# Each entry is (version, description, statements). The applied version is
+# stored in PRAGMA user_version; append new entries, never edit applied ones.
+# db_backends.POSTGRES_MIGRATIONS holds the same versions in PostgreSQL syntax.
+MIGRATIONS = [
+    (1, "secondary indexes on receipts and users", [
+        "CREATE INDEX IF NOT EXISTS idx_receipts_user_id ON receipts (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_receipts_status ON receipts (status, id)",
+        "CREATE INDEX IF NOT EXISTS idx_receipts_created_at ON receipts (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)",
+    ]),
+    (2, "materialized per-user balances", [
+        '''
+        CREATE TABLE IF NOT EXISTS balances (
+            user_id INTEGER PRIMARY KEY,
+            balance REAL NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL
+        )
+        ''',
+        # backfill from existing receipts (same query as reconcile_balances)
+        '''
+        INSERT OR REPLACE INTO balances (user_id, balance, updated_at)
+        SELECT user_id, SUM(amount), strftime('%Y-%m-%dT%H:%M:%f', 'now')
+        FROM receipts WHERE status = 'approved' GROUP BY user_id
+        ''',
+    ]),
+    (3, "trigger-maintained row counters", [
+        '''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users BEGIN
+            INSERT INTO counters (name, value) VALUES ('users', 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'users';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_count_insert AFTER INSERT ON receipts BEGIN
+            INSERT INTO counters (name, value) VALUES ('receipts', 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+            INSERT INTO counters (name, value) VALUES ('receipts:' || new.status, 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_count_delete AFTER DELETE ON receipts BEGIN
+            UPDATE counters SET value = value - 1 WHERE name IN ('receipts', 'receipts:' || old.status);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_count_status AFTER UPDATE OF status ON receipts
+        WHEN old.status IS NOT new.status BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'receipts:' || old.status;
+            INSERT INTO counters (name, value) VALUES ('receipts:' || new.status, 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        # backfill from existing rows
+        "INSERT OR REPLACE INTO counters (name, value) SELECT 'users', COUNT(*) FROM users",
+        "INSERT OR REPLACE INTO counters (name, value) SELECT 'receipts', COUNT(*) FROM receipts",
+        '''
+        INSERT OR REPLACE INTO counters (name, value)
+        SELECT 'receipts:' || status, COUNT(*) FROM receipts GROUP BY status
+        ''',
+    ]),
+    (4, "external reference on receipts for idempotent imports", [
+        "ALTER TABLE receipts ADD COLUMN external_ref TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_receipts_external_ref ON receipts (external_ref)",
+    ]),
+    (5, "stored file reference on receipts", [
+        "ALTER TABLE receipts ADD COLUMN file_ref TEXT",
+    ]),
+    (6, "reference-counted blob index for content-addressed uploads", [
+        '''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (7, "FTS5 full-text indexes over users and receipts", [
+        # trigram tokens match any 3+ character substring of names and emails
+        "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+        "name, email, content='users', content_rowid='id', tokenize='trigram')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS receipts_fts USING fts5("
+        "description, content='receipts', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, name, email) VALUES (new.id, new.name, new.email);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, name, email) VALUES ('delete', old.id, old.name, old.email);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF name, email ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, name, email) VALUES ('delete', old.id, old.name, old.email);
+            INSERT INTO users_fts (rowid, name, email) VALUES (new.id, new.name, new.email);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_fts_insert AFTER INSERT ON receipts BEGIN
+            INSERT INTO receipts_fts (rowid, description) VALUES (new.id, new.description);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_fts_delete AFTER DELETE ON receipts BEGIN
+            INSERT INTO receipts_fts (receipts_fts, rowid, description) VALUES ('delete', old.id, old.description);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_fts_update AFTER UPDATE OF description ON receipts BEGIN
+            INSERT INTO receipts_fts (receipts_fts, rowid, description) VALUES ('delete', old.id, old.description);
+            INSERT INTO receipts_fts (rowid, description) VALUES (new.id, new.description);
+        END
+        ''',
+        "INSERT INTO users_fts (users_fts) VALUES ('rebuild')",
+        "INSERT INTO receipts_fts (receipts_fts) VALUES ('rebuild')",
+    ]),
+    (8, "epoch timestamps and trigger-maintained daily receipt rollups", [
+        "ALTER TABLE receipts ADD COLUMN created_ts INTEGER",
+        "UPDATE receipts SET created_ts = CAST(strftime('%s', created_at) AS INTEGER)",
+        "CREATE INDEX IF NOT EXISTS idx_receipts_created_ts ON receipts (created_ts)",
+        # range queries use created_ts from now on
+        "DROP INDEX IF EXISTS idx_receipts_created_at",
+        # db_service always sets created_ts; this covers rows inserted with raw SQL
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_created_ts AFTER INSERT ON receipts
+        WHEN new.created_ts IS NULL BEGIN
+            UPDATE receipts SET created_ts = CAST(strftime('%s', new.created_at) AS INTEGER) WHERE id = new.id;
+        END
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS receipt_daily (
+            day TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, status)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_daily_insert AFTER INSERT ON receipts BEGIN
+            INSERT INTO receipt_daily (day, status, count, amount) VALUES (date(new.created_at), new.status, 1, new.amount)
+                ON CONFLICT(day, status) DO UPDATE SET count = count + 1, amount = amount + excluded.amount;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_daily_delete AFTER DELETE ON receipts BEGIN
+            UPDATE receipt_daily SET count = count - 1, amount = amount - old.amount
+            WHERE day = date(old.created_at) AND status = old.status;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_daily_update AFTER UPDATE OF status, amount ON receipts
+        WHEN old.status IS NOT new.status OR old.amount IS NOT new.amount BEGIN
+            UPDATE receipt_daily SET count = count - 1, amount = amount - old.amount
+            WHERE day = date(old.created_at) AND status = old.status;
+            INSERT INTO receipt_daily (day, status, count, amount) VALUES (date(new.created_at), new.status, 1, new.amount)
+                ON CONFLICT(day, status) DO UPDATE SET count = count + 1, amount = amount + excluded.amount;
+        END
+        ''',
+        # backfill (same query as rebuild_daily_rollups)
+        '''
+        INSERT OR REPLACE INTO receipt_daily (day, status, count, amount)
+        SELECT date(created_at), status, COUNT(*), SUM(amount) FROM receipts GROUP BY 1, 2
+        ''',
+    ]),
+    (9, "change versions of users and receipts for HTTP cache validation", [
+        '''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            modified_ts INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        "INSERT OR IGNORE INTO table_versions (name, version, modified_ts) "
+        "VALUES ('users', 0, CAST(strftime('%s', 'now') AS INTEGER)), "
+        "('receipts', 0, CAST(strftime('%s', 'now') AS INTEGER))",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_version_insert AFTER INSERT ON users BEGIN
+            UPDATE table_versions SET version = version + 1, modified_ts = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE name = 'users';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_version_update AFTER UPDATE ON users BEGIN
+            UPDATE table_versions SET version = version + 1, modified_ts = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE name = 'users';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_version_delete AFTER DELETE ON users BEGIN
+            UPDATE table_versions SET version = version + 1, modified_ts = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE name = 'users';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_version_insert AFTER INSERT ON receipts BEGIN
+            UPDATE table_versions SET version = version + 1, modified_ts = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE name = 'receipts';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_version_update AFTER UPDATE ON receipts BEGIN
+            UPDATE table_versions SET version = version + 1, modified_ts = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE name = 'receipts';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_version_delete AFTER DELETE ON receipts BEGIN
+            UPDATE table_versions SET version = version + 1, modified_ts = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE name = 'receipts';
+        END
+        ''',
+    ]),
+    (10, "thumbnail index with trigger-maintained total size", [
+        '''
+        CREATE TABLE IF NOT EXISTS thumbnails (
+            key TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            accessed_ts INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_thumbnails_accessed ON thumbnails (accessed_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_thumbnails_sha256 ON thumbnails (sha256)",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_thumbnails_bytes_insert AFTER INSERT ON thumbnails BEGIN
+            INSERT INTO counters (name, value) VALUES ('thumbnails:bytes', new.bytes)
+                ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_thumbnails_bytes_delete AFTER DELETE ON thumbnails BEGIN
+            UPDATE counters SET value = value - old.bytes WHERE name = 'thumbnails:bytes';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_thumbnails_bytes_update AFTER UPDATE OF bytes ON thumbnails BEGIN
+            UPDATE counters SET value = value - old.bytes + new.bytes WHERE name = 'thumbnails:bytes';
+        END
+        ''',
+    ]),
+    (11, "broadcasts with per-recipient delivery state", [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            rate REAL NOT NULL DEFAULT 0,
+            owner TEXT,
+            heartbeat_ts INTEGER,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            error TEXT,
+            delivered_at TEXT NOT NULL,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (12, "archive table for old receipts in a final status", [
+        '''
+        CREATE TABLE IF NOT EXISTS receipts_archive (
+            id INTEGER PRIMARY KEY,
             user_id INTEGER NOT NULL,
             amount REAL NOT NULL,
             status TEXT NOT NULL,
             description TEXT,
             created_at TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES users(id)
+            external_ref TEXT,
+            file_ref TEXT,
+            created_ts INTEGER,
+            archived_at TEXT NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_receipts_archive_user_id ON receipts_archive (user_id, id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_receipts_archive_external_ref ON receipts_archive (external_ref)",
+        # a receipt moved to the archive still counts, and its day keeps it in the rollups
+        "DROP TRIGGER IF EXISTS trg_receipts_count_delete",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_count_delete AFTER DELETE ON receipts
+        WHEN NOT EXISTS (SELECT 1 FROM receipts_archive WHERE id = old.id) BEGIN
+            UPDATE counters SET value = value - 1 WHERE name IN ('receipts', 'receipts:' || old.status);
+        END
+        ''',
+        "DROP TRIGGER IF EXISTS trg_receipts_daily_delete",
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_daily_delete AFTER DELETE ON receipts
+        WHEN NOT EXISTS (SELECT 1 FROM receipts_archive WHERE id = old.id) BEGIN
+            UPDATE receipt_daily SET count = count - 1, amount = amount - old.amount
+            WHERE day = date(old.created_at) AND status = old.status;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_archive_count_insert AFTER INSERT ON receipts_archive BEGIN
+            INSERT INTO counters (name, value) VALUES ('receipts:archived', 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_receipts_archive_count_delete AFTER DELETE ON receipts_archive BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'receipts:archived';
+        END
+        ''',
+    ]),
+    (13, "job queue", [
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            visible_ts INTEGER NOT NULL,
+            owner TEXT,
+            result TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            finished_at TEXT
         )
-    ''')
-    conn.commit()
-    conn.close()
+        ''',
+        # only claimable jobs are indexed, so finished ones cost the claim nothing
+        "CREATE INDEX IF NOT EXISTS idx_jobs_visible ON jobs (visible_ts) WHERE status IN ('queued', 'running')",
+    ]),
+    (14, "conversation state per user", [
+        '''
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            user_id INTEGER PRIMARY KEY,
+            flow TEXT NOT NULL,
+            step TEXT NOT NULL,
+            data TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        ''',
+    ]),
+    (15, "index for status plus date range scans in creation order", [
+        # (status, created_ts) rows end in the rowid, so "status = ? AND created_ts range
+        # ORDER BY created_ts, id" (exports) is read in order without a temp b-tree
+        "CREATE INDEX IF NOT EXISTS idx_receipts_status_created_ts ON receipts (status, created_ts)",
+    ]),
+    (16, "released blobs wait for a garbage-collection sweep", [
+        "ALTER TABLE blobs ADD COLUMN released_ts INTEGER",
+        "CREATE INDEX IF NOT EXISTS idx_blobs_released ON blobs (released_ts) WHERE refcount = 0",
+    ]),
+]
+
+def get_schema_version():
+    with connection() as conn:
+        return get_backend().get_schema_version(conn)
+
+def migrate(target=None):
+    """Apply pending migrations in order, each in its own transaction.
+
+    Safe to run concurrently from several processes: the version is re-read
+    under the write lock, so a migration is never applied twice.
+    Returns the list of (version, description) that were applied.
+    """
+    backend = get_backend()
+    applied = []
+    for version, description, statements in _schema(backend)[1]:
+        if target is not None and version > target:
+            break
+        with transaction() as conn:
+            backend.lock_schema(conn)
+            if backend.get_schema_version(conn) >= version:
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            backend.set_schema_version(conn, version)
+        applied.append((version, description))
+    if applied:
+        with connection() as conn:
+            backend.optimize(conn)
+    return applied
+
+# Queries on the bot and admin hot paths, checked by `flask explain-queries`.
+HOT_QUERIES = {
+    "receipts by user": ("SELECT * FROM receipts WHERE user_id = ? ORDER BY id DESC", (1,)),
+    "receipts page by status": ("SELECT * FROM receipts WHERE status = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                                ("pending", 1000, 51)),
+    "receipts page by user": ("SELECT * FROM receipts WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                              (1, 1000, 51)),
+    "receipts by date range": ("SELECT * FROM receipts WHERE created_ts >= ? AND created_ts < ?",
+                               (1704067200, 1706745600)),
+    "receipts export by date range": (
+        "SELECT * FROM receipts WHERE created_ts >= ? AND created_ts < ? ORDER BY created_ts, id",
+        (1704067200, 1706745600)),
+    "receipts export by status and date range": (
+        "SELECT * FROM receipts WHERE status = ? AND created_ts >= ? AND created_ts < ? ORDER BY created_ts, id",
+        ("approved", 1704067200, 1706745600)),
+    "daily rollups by date range": ("SELECT * FROM receipt_daily WHERE day >= ? AND day < ? ORDER BY day",
+                                    ("2024-01-01", "2025-01-01")),
+    "broadcast recipients after cursor": (
+        "SELECT id FROM users WHERE id > ? AND NOT EXISTS ("
+        "SELECT 1 FROM broadcast_deliveries d WHERE d.broadcast_id = ? AND d.user_id = users.id) "
+        "ORDER BY id LIMIT ?", (1000, 1, 500)),
+    "archive candidates": ("SELECT id, created_ts FROM receipts INDEXED BY idx_receipts_created_ts "
+                           "WHERE created_ts >= ? AND created_ts < ? "
+                           "AND status IN ('approved', 'rejected') ORDER BY created_ts LIMIT ?",
+                           (0, 1704067200, 500)),
+    "archived receipts by user": ("SELECT * FROM receipts_archive WHERE user_id = ? ORDER BY id DESC", (1,)),
+    "visible jobs": ("SELECT * FROM jobs WHERE status IN ('queued', 'running') AND visible_ts <= ? "
+                     "ORDER BY visible_ts LIMIT ?", (1704067200, 1)),
+}
+
+def explain_query_plan(sql, params=()):
+    """Return the query plan lines for `sql` (EXPLAIN QUERY PLAN on SQLite, EXPLAIN on PostgreSQL)."""
+    with connection() as conn:
+        return get_backend().explain(conn, sql, params)
+
+def _plan_problem(detail):
+    if detail.startswith("SCAN ") and "USING INDEX" not in detail and "USING COVERING INDEX" not in detail:
+        return "full table scan"
+    if detail.startswith("USE TEMP B-TREE"):
+        return "sort in a temp b-tree"
+    return None
+
+def hot_query_problems():
+    """{name: [(plan line, problem), ...]} for HOT_QUERIES whose plan scans a whole table or sorts
+    in a temp b-tree; empty when every hot query is served by an index.
+
+    Only SQLite plans are checked: PostgreSQL picks plans from table statistics,
+    so a small or fresh database legitimately plans sequential scans.
+    """
+    if get_backend().name != "sqlite":
+        return {}
+    problems = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        found = [(detail, _plan_problem(detail)) for detail in explain_query_plan(sql, params)]
+        found = [(detail, problem) for detail, problem in found if problem]
+        if found:
+            problems[name] = found
+    return problems
 
 # Admin functions
 def create_admin(username, password):
     if not username or not password:
         raise ValueError("username and password are required")
-    conn = get_connection()
-    cur = conn.cursor()
     password_hash = generate_password_hash(password)
     created_at = datetime.utcnow().isoformat()
     try:
-        cur.execute("INSERT INTO admins (username, password_hash, created_at) VALUES (?, ?, ?)",
-                    (username, password_hash, created_at))
-        conn.commit()
-    except sqlite3.IntegrityError:
+        with transaction() as conn:
+            conn.execute("INSERT INTO admins (username, password_hash, created_at) VALUES (?, ?, ?)",
+                         (username, password_hash, created_at))
+    except get_backend().IntegrityError:
         # user already exists: ignore
         pass
-    finally:
-        conn.close()
 
 def get_admin_by_username(username):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM admins WHERE username = ?", (username,))
-    row = cur.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM admins WHERE username = ?", (username,)).fetchone()
     return row_to_dict(row)
 
 def check_admin_credentials(username, password):
@@ -85,91 +793,1314 @@ def check_admin_credentials(username, password):
 
 # Users functions
 def create_user(name, email):
-    conn = get_connection()
-    cur = conn.cursor()
     created_at = datetime.utcnow().isoformat()
     try:
-        cur.execute("INSERT INTO users (name, email, created_at) VALUES (?, ?, ?)",
-                    (name, email, created_at))
-        conn.commit()
-        return cur.lastrowid
-    except sqlite3.IntegrityError:
+        with transaction() as conn:
+            cur = conn.execute("INSERT INTO users (name, email, created_at) VALUES (?, ?, ?)",
+                               (name, email, created_at))
+            return cur.lastrowid
+    except get_backend().IntegrityError:
         return None
-    finally:
-        conn.close()
 
 def get_user_by_id(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
     return row_to_dict(row)
 
 def get_users(limit=None, offset=0):
-    conn = get_connection()
-    cur = conn.cursor()
-    if limit:
-        cur.execute("SELECT * FROM users ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset))
-    else:
-        cur.execute("SELECT * FROM users ORDER BY id DESC")
-    rows = cur.fetchall()
-    conn.close()
+    with connection() as conn:
+        if limit:
+            rows = conn.execute("SELECT * FROM users ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM users ORDER BY id DESC").fetchall()
     return [row_to_dict(r) for r in rows]
 
 def count_users():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) as cnt FROM users")
-    row = cur.fetchone()
-    conn.close()
-    return row["cnt"] if row else 0
+    return get_counter("users")
 
 # Receipts functions
-def create_receipt(user_id, amount, status="pending", description=None):
-    conn = get_connection()
-    cur = conn.cursor()
-    created_at = datetime.utcnow().isoformat()
-    cur.execute(
-        "INSERT INTO receipts (user_id, amount, status, description, created_at) VALUES (?, ?, ?, ?, ?)",
-        (user_id, amount, status, description, created_at)
-    )
-    conn.commit()
-    rid = cur.lastrowid
-    conn.close()
+RECEIPT_STATUSES = ("pending", "approved", "rejected")
+# Only approved receipts count towards a user's balance.
+CREDITED_STATUS = "approved"
+# Statuses a receipt is not expected to leave; only these are archived.
+FINAL_RECEIPT_STATUSES = ("approved", "rejected")
+
+def to_epoch(value):
+    """Seconds since the epoch for an ISO-8601 string or datetime; naive values are taken as UTC."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    elif isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+def create_receipt(user_id, amount, status="pending", description=None, file_ref=None):
+    now = datetime.utcnow()
+    created_at = now.isoformat()
+    with transaction() as conn:
+        cur = conn.execute(
+            "INSERT INTO receipts (user_id, amount, status, description, created_at, created_ts, file_ref) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, amount, status, description, created_at, to_epoch(now), file_ref)
+        )
+        if status == CREDITED_STATUS:
+            _apply_balance_delta(conn, user_id, amount)
+        rid = cur.lastrowid
+    if status == CREDITED_STATUS:
+        _notify_balance_change([user_id])
     return rid
 
-def get_receipt_by_id(receipt_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM receipts WHERE id = ?", (receipt_id,))
-    row = cur.fetchone()
-    conn.close()
+def set_receipt_status(receipt_id, status):
+    """Move a receipt to `status`, adjusting the owner's balance in the same transaction.
+
+    Returns the previous status, or None if the receipt does not exist.
+    """
+    if status not in RECEIPT_STATUSES:
+        raise ValueError(f"invalid receipt status: {status!r}")
+    with transaction() as conn:
+        row = conn.execute("SELECT user_id, amount, status FROM receipts WHERE id = ?" + get_backend().for_update,
+                           (receipt_id,)).fetchone()
+        if row is None:
+            return None
+        previous = row["status"]
+        if previous == status:
+            return previous
+        conn.execute("UPDATE receipts SET status = ? WHERE id = ?", (status, receipt_id))
+        delta = _credited_amount(row["amount"], status) - _credited_amount(row["amount"], previous)
+        if delta:
+            _apply_balance_delta(conn, row["user_id"], delta)
+    if delta:
+        _notify_balance_change([row["user_id"]])
+    return previous
+
+def set_receipt_amount(receipt_id, amount):
+    """Set a receipt's amount (e.g. while reviewing it); an approved receipt moves its owner's balance
+    by the difference. Returns the previous amount, or None if the receipt does not exist."""
+    amount = float(amount)
+    if not math.isfinite(amount) or amount < 0:
+        raise ValueError(f"invalid amount: {amount!r}")
+    amount = round(amount, 2)
+    with transaction() as conn:
+        row = conn.execute("SELECT user_id, amount, status FROM receipts WHERE id = ?" + get_backend().for_update,
+                           (receipt_id,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE receipts SET amount = ? WHERE id = ?", (amount, receipt_id))
+        delta = _credited_amount(amount, row["status"]) - _credited_amount(row["amount"], row["status"])
+        if delta:
+            _apply_balance_delta(conn, row["user_id"], delta)
+    if delta:
+        _notify_balance_change([row["user_id"]])
+    return row["amount"]
+
+def set_receipt_statuses(changes, chunk_size=500, expected=None):
+    """Apply many (receipt_id, status) changes in one transaction, with balances adjusted per user.
+
+    Unknown ids and no-op changes are skipped. With `expected`, only receipts
+    still in that status are changed, so e.g. the verification worker
+    (expected="pending") never overrides a decision an admin made meanwhile.
+    Each update is guarded by the status it was read with, and balances only
+    move for rows that actually changed. Returns the number of receipts changed.
+    """
+    changes = dict(changes)
+    for status in set(changes.values()):
+        if status not in RECEIPT_STATUSES:
+            raise ValueError(f"invalid receipt status: {status!r}")
+    deltas = {}
+    changed = 0
+    with transaction() as conn:
+        ids = list(changes)
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT id, user_id, amount, status FROM receipts WHERE id IN ({placeholders})"
+                + get_backend().for_update, chunk
+            ).fetchall()
+            for row in rows:
+                status = changes[row["id"]]
+                if row["status"] == status or (expected is not None and row["status"] != expected):
+                    continue
+                cur = conn.execute("UPDATE receipts SET status = ? WHERE id = ? AND status = ?",
+                                   (status, row["id"], row["status"]))
+                if cur.rowcount != 1:
+                    continue
+                changed += 1
+                delta = _credited_amount(row["amount"], status) - _credited_amount(row["amount"], row["status"])
+                if delta:
+                    deltas[row["user_id"]] = deltas.get(row["user_id"], 0) + delta
+        for user_id, delta in deltas.items():
+            _apply_balance_delta(conn, user_id, delta)
+    if deltas:
+        _notify_balance_change(list(deltas))
+    return changed
+
+def get_pending_receipts(after_id=0, limit=500):
+    """Pending receipts with id > after_id, oldest first (an index range scan on (status, id))."""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT * FROM receipts WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?", (after_id, limit)
+        ).fetchall()
+    return [row_to_dict(r) for r in rows]
+
+def get_receipt_by_id(receipt_id, include_archived=False):
+    """The receipt with id `receipt_id`; with include_archived, also looked up in receipts_archive
+    (archived rows carry `archived_at`)."""
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM receipts WHERE id = ?", (receipt_id,)).fetchone()
+        if row is None and include_archived:
+            row = conn.execute("SELECT * FROM receipts_archive WHERE id = ?", (receipt_id,)).fetchone()
     return row_to_dict(row)
 
 def get_receipts(limit=None, offset=0):
-    conn = get_connection()
-    cur = conn.cursor()
-    if limit:
-        cur.execute("SELECT * FROM receipts ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset))
-    else:
-        cur.execute("SELECT * FROM receipts ORDER BY id DESC")
-    rows = cur.fetchall()
-    conn.close()
+    with connection() as conn:
+        if limit:
+            rows = conn.execute("SELECT * FROM receipts ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM receipts ORDER BY id DESC").fetchall()
     return [row_to_dict(r) for r in rows]
 
-def get_receipts_by_user(user_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM receipts WHERE user_id = ? ORDER BY id DESC", (user_id,))
-    rows = cur.fetchall()
-    conn.close()
+def iter_receipts(status=None, start=None, end=None, batch_size=1000):
+    """Iterate over receipts (oldest first) as dicts, reading `batch_size` rows at a time
+    (fetchmany on SQLite, a server-side cursor on PostgreSQL).
+
+    `start`/`end` bound the creation time as ISO strings or datetimes (start
+    inclusive, end exclusive), matched against the indexed created_ts column;
+    a date range is read in created_ts order straight off that index, so
+    nothing is sorted in memory. Arguments are checked when this is called
+    (ValueError), before any row is read. The rows come from their own pooled
+    connection, so the iterator is safe to consume lazily (e.g. from a streamed
+    HTTP response) and memory use does not depend on the result size.
+    """
+    if status is not None and status not in RECEIPT_STATUSES:
+        raise ValueError(f"invalid receipt status: {status!r}")
+    clauses, params = [], []
+    if status is not None:
+        clauses.append("status = ?")
+        params.append(status)
+    if start is not None:
+        clauses.append("created_ts >= ?")
+        params.append(to_epoch(start))
+    if end is not None:
+        clauses.append("created_ts < ?")
+        params.append(to_epoch(end))
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    # each order is the one the index used for the filter delivers, so SQLite never sorts in a temp b-tree
+    order = "created_ts, id" if start is not None or end is not None else "id"
+    return _stream_rows(f"SELECT * FROM receipts {where} ORDER BY {order}", params, batch_size)
+
+def _stream_rows(sql, params, batch_size):
+    backend = get_backend()
+    conn = _acquire(backend)
+    try:
+        for row in backend.stream(conn, sql, params, batch_size):
+            yield row_to_dict(row)
+    finally:
+        _release(backend, conn)
+
+def _receipt_filter(status=None, user_id=None, max_id=None):
+    clauses, params = [], []
+    for clause, value in (("status = ?", status), ("user_id = ?", user_id), ("id <= ?", max_id)):
+        if value is not None:
+            clauses.append(clause)
+            params.append(value)
+    return (f"WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+def get_receipt_ids(status=None, user_id=None, max_id=None):
+    """Ids of the live receipts matching the filters, as on the admin receipts page.
+
+    `max_id` (from max_receipt_id()) leaves out receipts created after the filter was chosen.
+    """
+    where, params = _receipt_filter(status, user_id, max_id)
+    with connection() as conn:
+        return [row["id"] for row in conn.execute(f"SELECT id FROM receipts {where} ORDER BY id", params)]
+
+def max_receipt_id(status=None, user_id=None):
+    """The largest id of the live receipts matching the filters (None if there are none)."""
+    where, params = _receipt_filter(status, user_id)
+    with connection() as conn:
+        return conn.execute(f"SELECT MAX(id) AS max_id FROM receipts {where}", params).fetchone()["max_id"]
+
+def get_receipts_by_user(user_id, include_archived=False):
+    """A user's receipts, newest first; with include_archived, archived ones too (with `archived_at`,
+    which is None on live rows)."""
+    with connection() as conn:
+        if include_archived:
+            rows = conn.execute(
+                "SELECT *, NULL AS archived_at FROM receipts WHERE user_id = ? "
+                "UNION ALL SELECT * FROM receipts_archive WHERE user_id = ? ORDER BY id DESC",
+                (user_id, user_id)
+            ).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM receipts WHERE user_id = ? ORDER BY id DESC", (user_id,)).fetchall()
     return [row_to_dict(r) for r in rows]
 
 def count_receipts():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) as cnt FROM receipts")
-    row = cur.fetchone()
-    conn.close()
-    return row["cnt"] if row else 0
+    return get_counter("receipts")
+
+def count_receipts_by_status():
+    counters = get_counters()
+    return {status: counters.get(f"receipts:{status}", 0) for status in RECEIPT_STATUSES}
+
+def count_archived_receipts():
+    return get_counter("receipts:archived")
+
+# Archiving
+# Receipts in a final status older than RECEIPT_ARCHIVE_AFTER_DAYS can be moved
+# to receipts_archive (migration 12), so the live table, its indexes and every
+# list, page and per-user query stay small enough to remain in the page cache.
+# Archived receipts are still counted in the counters, rollups and balances;
+# they leave full-text search and the admin lists, and are only returned by
+# get_receipt_by_id() / get_receipts_by_user() with include_archived=True.
+ARCHIVE_AFTER_DAYS = int(os.getenv("RECEIPT_ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("RECEIPT_ARCHIVE_BATCH_SIZE", "200"))
+# Pause between archive batches, so other writers get the write lock in between
+ARCHIVE_PAUSE = float(os.getenv("RECEIPT_ARCHIVE_PAUSE", "0.05"))
+_ARCHIVE_COLUMNS = "id, user_id, amount, status, description, created_at, external_ref, file_ref, created_ts"
+
+def archive_receipts(before=None, batch_size=ARCHIVE_BATCH_SIZE, pause=ARCHIVE_PAUSE, limit=None, progress=None):
+    """Move approved and rejected receipts created before `before` (default ARCHIVE_AFTER_DAYS ago)
+    to receipts_archive, oldest first.
+
+    Each batch of `batch_size` is one short transaction, so writers wait at most
+    one batch. Stops after `limit` receipts if given; `progress(moved)` is called
+    after every batch. Returns the number of receipts moved.
+    """
+    cutoff = to_epoch(before) if before is not None else int(time.time()) - ARCHIVE_AFTER_DAYS * 86400
+    statuses = ", ".join(f"'{status}'" for status in FINAL_RECEIPT_STATUSES)
+    moved = 0
+    # older receipts left behind (pending ones) are not scanned again by later batches
+    floor = 0
+    while limit is None or moved < limit:
+        size = batch_size if limit is None else min(batch_size, limit - moved)
+        with transaction() as conn:
+            rows = conn.execute(
+                # walk created_ts in order: planned on the status index instead (as SQLite does
+                # without ANALYZE), IN over two statuses needs a temp b-tree for the ORDER BY
+                f"SELECT id, created_ts FROM receipts INDEXED BY idx_receipts_created_ts "
+                f"WHERE created_ts >= ? AND created_ts < ? "
+                f"AND status IN ({statuses}) ORDER BY created_ts LIMIT ?" + get_backend().for_update,
+                (floor, cutoff, size)
+            ).fetchall()
+            if not rows:
+                break
+            ids = [row["id"] for row in rows]
+            floor = rows[-1]["created_ts"]
+            placeholders = ", ".join("?" * len(ids))
+            conn.execute(
+                f"INSERT INTO receipts_archive ({_ARCHIVE_COLUMNS}, archived_at) "
+                f"SELECT {_ARCHIVE_COLUMNS}, ? FROM receipts WHERE id IN ({placeholders})",
+                (datetime.utcnow().isoformat(), *ids)
+            )
+            conn.execute(f"DELETE FROM receipts WHERE id IN ({placeholders})", ids)
+        moved += len(ids)
+        if progress:
+            progress(moved)
+        if len(ids) < size:
+            break
+        if pause:
+            time.sleep(pause)
+    return moved
+
+# Keyset pagination
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def _keyset_page(table, filters, limit=PAGE_SIZE, before=None, after=None):
+    """Fetch one page of `table` ordered by id DESC using keyset (cursor) pagination.
+
+    `filters` maps column -> value (None values are ignored). Pass `before` (the
+    `next` cursor of a page) to move to older rows or `after` (the `prev` cursor)
+    to move to newer rows. Every page is a single index range seek, so page N
+    costs the same as page 1. Returns {"items": [...], "next": id|None, "prev": id|None}.
+    """
+    limit = max(1, min(int(limit or PAGE_SIZE), MAX_PAGE_SIZE))
+    clauses, params = [], []
+    for column, value in filters.items():
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    backward = after is not None
+    if backward:
+        clauses.append("id > ?")
+        params.append(after)
+    elif before is not None:
+        clauses.append("id < ?")
+        params.append(before)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    order = "ASC" if backward else "DESC"
+    params.append(limit + 1)
+    with connection() as conn:
+        rows = conn.execute(f"SELECT * FROM {table} {where} ORDER BY id {order} LIMIT ?", params).fetchall()
+    has_more = len(rows) > limit
+    items = [row_to_dict(r) for r in rows[:limit]]
+    if backward:
+        items.reverse()
+        prev_cursor = items[0]["id"] if has_more else None
+        next_cursor = items[-1]["id"] if items else None
+    else:
+        prev_cursor = items[0]["id"] if items and before is not None else None
+        next_cursor = items[-1]["id"] if has_more else None
+    return {"items": items, "next": next_cursor, "prev": prev_cursor}
+
+def get_users_page(limit=PAGE_SIZE, before=None, after=None):
+    return _keyset_page("users", {}, limit=limit, before=before, after=after)
+
+def get_receipts_page(limit=PAGE_SIZE, before=None, after=None, status=None, user_id=None):
+    return _keyset_page("receipts", {"status": status, "user_id": user_id},
+                        limit=limit, before=before, after=after)
+
+# Balances ledger
+# `balances` holds one running total per user, kept in step with receipts by
+# create_receipt() and set_receipt_status(), so lookups are a primary-key read.
+_balance_listeners = []
+
+def _credited_amount(amount, status):
+    return amount if status == CREDITED_STATUS else 0
+
+def _apply_balance_delta(conn, user_id, delta):
+    conn.execute(
+        "INSERT INTO balances (user_id, balance, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET balance = balances.balance + excluded.balance, "
+        "updated_at = excluded.updated_at",
+        (user_id, delta, datetime.utcnow().isoformat())
+    )
+
+def add_balance_listener(callback):
+    """Register `callback(user_ids)` to be called after balances change in this process.
+
+    `user_ids` is a list of affected users, or None when every balance may have changed.
+    """
+    _balance_listeners.append(callback)
+
+def _notify_balance_change(user_ids):
+    for callback in _balance_listeners:
+        callback(user_ids)
+
+def get_balance(user_id):
+    with connection() as conn:
+        row = conn.execute("SELECT balance FROM balances WHERE user_id = ?", (user_id,)).fetchone()
+    return row["balance"] if row else 0.0
+
+def reconcile_balances():
+    """Rebuild every balance from receipts (archived ones included) in a single pass.
+
+    Returns the number of users with a balance.
+    """
+    with transaction() as conn:
+        conn.execute("DELETE FROM balances")
+        cur = conn.execute(
+            "INSERT INTO balances (user_id, balance, updated_at) "
+            "SELECT user_id, SUM(amount), ? FROM ("
+            "SELECT user_id, amount FROM receipts WHERE status = ? "
+            "UNION ALL SELECT user_id, amount FROM receipts_archive WHERE status = ?) AS credited GROUP BY user_id",
+            (datetime.utcnow().isoformat(), CREDITED_STATUS, CREDITED_STATUS)
+        )
+        count = cur.rowcount
+    _notify_balance_change(None)
+    return count
+
+# Counters
+# Row counts are maintained by triggers (migration 3) in the `counters` table,
+# keyed "users", "receipts" and "receipts:<status>", so reading them never scans.
+def get_counter(name):
+    with connection() as conn:
+        row = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+    return row["value"] if row else 0
+
+def get_counters():
+    with connection() as conn:
+        return {row["name"]: row["value"] for row in conn.execute("SELECT name, value FROM counters")}
+
+# Table versions
+# Triggers (migration 9) bump a per-table version and modification time on
+# every write to users or receipts, from any process, so a reader can tell
+# whether anything changed with one primary-key lookup.
+def get_table_versions(names):
+    """{name: (version, modified_ts)} for each requested table (missing ones as (0, 0))."""
+    names = list(names)
+    placeholders = ",".join("?" * len(names))
+    with connection() as conn:
+        rows = conn.execute(
+            f"SELECT name, version, modified_ts FROM table_versions WHERE name IN ({placeholders})", names
+        ).fetchall()
+    versions = {name: (0, 0) for name in names}
+    versions.update((row["name"], (row["version"], row["modified_ts"])) for row in rows)
+    return versions
+
+def dashboard_snapshot(recent=10, days=30):
+    """Return everything the admin dashboard shows, read from one connection and one snapshot."""
+    with connection() as conn:
+        # an explicit read transaction keeps counters and recent rows consistent
+        conn.execute(get_backend().begin_read)
+        try:
+            counters = {row["name"]: row["value"] for row in conn.execute("SELECT name, value FROM counters")}
+            recent_users = conn.execute("SELECT * FROM users ORDER BY id DESC LIMIT ?", (recent,)).fetchall()
+            recent_receipts = conn.execute("SELECT * FROM receipts ORDER BY id DESC LIMIT ?", (recent,)).fetchall()
+            daily = get_daily_rollups(*day_window(days))
+        finally:
+            conn.rollback()
+    return {
+        "users_count": counters.get("users", 0),
+        "receipts_count": counters.get("receipts", 0),
+        "archived_count": counters.get("receipts:archived", 0),
+        "receipts_by_status": {status: counters.get(f"receipts:{status}", 0) for status in RECEIPT_STATUSES},
+        "recent_users": [row_to_dict(r) for r in recent_users],
+        "recent_receipts": [row_to_dict(r) for r in recent_receipts],
+        "daily": daily,
+    }
+
+# Daily rollups
+# receipt_daily (migration 8) holds one row per UTC day and status with the
+# receipt count and amount, kept in step by triggers on receipts, so a time
+# range costs one row per day in it however many receipts fall inside.
+MAX_ROLLUP_DAYS = 3660
+
+def day_window(days, today=None):
+    """(start, end) day strings covering the last `days` days up to and including today (UTC)."""
+    today = today or datetime.utcnow().date()
+    return (today - timedelta(days=days - 1)).isoformat(), (today + timedelta(days=1)).isoformat()
+
+def _parse_day(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+def get_daily_rollups(start, end, status=None):
+    """Receipt count and amount per day for days in [start, end) (ISO dates or date objects).
+
+    Every day in the range is returned, oldest first, including empty ones:
+    [{"day": "YYYY-MM-DD", "count": n, "amount": x, "by_status": {status: {"count": n, "amount": x}}}].
+    `status` restricts the totals to one status. Raises ValueError on a bad or too long range.
+    """
+    first, stop = _parse_day(start), _parse_day(end)
+    span = (stop - first).days
+    if span < 0 or span > MAX_ROLLUP_DAYS:
+        raise ValueError(f"date range must cover 0 to {MAX_ROLLUP_DAYS} days")
+    days = {}
+    for offset in range(span):
+        day = (first + timedelta(days=offset)).isoformat()
+        days[day] = {"day": day, "count": 0, "amount": 0.0,
+                     "by_status": {s: {"count": 0, "amount": 0.0} for s in RECEIPT_STATUSES}}
+    sql = "SELECT day, status, count, amount FROM receipt_daily WHERE day >= ? AND day < ?"
+    params = [first.isoformat(), stop.isoformat()]
+    if status is not None:
+        sql += " AND status = ?"
+        params.append(status)
+    with connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    for row in rows:
+        entry = days[row["day"]]
+        entry["count"] += row["count"]
+        entry["amount"] += row["amount"]
+        entry["by_status"].setdefault(row["status"], {"count": 0, "amount": 0.0})
+        entry["by_status"][row["status"]]["count"] += row["count"]
+        entry["by_status"][row["status"]]["amount"] += row["amount"]
+    return list(days.values())
+
+def get_rollup_totals(start, end):
+    """Receipt count and amount per status over [start, end), summed from the daily rollups."""
+    totals = {status: {"count": 0, "amount": 0.0} for status in RECEIPT_STATUSES}
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT status, SUM(count) AS count, SUM(amount) AS amount FROM receipt_daily "
+            "WHERE day >= ? AND day < ? GROUP BY status",
+            (_parse_day(start).isoformat(), _parse_day(end).isoformat())
+        ).fetchall()
+    for row in rows:
+        totals[row["status"]] = {"count": row["count"], "amount": row["amount"]}
+    return totals
+
+def rebuild_daily_rollups():
+    """Recompute receipt_daily from receipts and the archive in a single pass. Returns the number of rollup rows."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM receipt_daily")
+        if get_backend().name == "postgres":
+            day = "created_at::timestamp::date::text"
+        else:
+            day = "date(created_at)"
+        cur = conn.execute(
+            f"INSERT INTO receipt_daily (day, status, count, amount) "
+            f"SELECT {day}, status, COUNT(*), SUM(amount) FROM ("
+            f"SELECT created_at, status, amount FROM receipts "
+            f"UNION ALL SELECT created_at, status, amount FROM receipts_archive) AS all_receipts GROUP BY 1, 2"
+        )
+        return cur.rowcount
+
+# Bulk inserts
+# Rows are consumed lazily from any iterable and written with executemany in
+# chunks of `chunk_size`, one transaction per chunk, so memory stays flat and
+# there is one fsync per chunk instead of one per row. Rows that would violate a
+# unique key are not inserted; they are counted and passed to `on_duplicate`.
+BULK_CHUNK_SIZE = 1000
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _split_duplicates(conn, chunk, key, table, column):
+    """Partition `chunk` into (new, duplicates) on `column`, checking the table and the chunk itself."""
+    keys = [row[key] for row in chunk if row[key] is not None]
+    existing = set()
+    if keys:
+        placeholders = ",".join("?" * len(keys))
+        existing = {r[0] for r in conn.execute(
+            f"SELECT {column} FROM {table} WHERE {column} IN ({placeholders})", keys)}
+    new, duplicates = [], []
+    for row in chunk:
+        value = row[key]
+        if value is not None and value in existing:
+            duplicates.append(row)
+        else:
+            if value is not None:
+                existing.add(value)
+            new.append(row)
+    return new, duplicates
+
+def create_users_many(rows, chunk_size=BULK_CHUNK_SIZE, on_duplicate=None):
+    """Insert users from an iterable of mappings with `name`, `email` and optional `created_at`.
+
+    Returns {"inserted": n, "duplicates": n}.
+    """
+    inserted = duplicated = 0
+    now = datetime.utcnow().isoformat()
+    normalized = ({"name": row["name"], "email": row["email"], "created_at": row.get("created_at") or now}
+                  for row in rows)
+    for chunk in _chunks(normalized, chunk_size):
+        with transaction() as conn:
+            new, duplicates = _split_duplicates(conn, chunk, "email", "users", "email")
+            conn.executemany("INSERT INTO users (name, email, created_at) VALUES (:name, :email, :created_at)", new)
+        inserted += len(new)
+        duplicated += len(duplicates)
+        if on_duplicate:
+            for row in duplicates:
+                on_duplicate(row)
+    return {"inserted": inserted, "duplicates": duplicated}
+
+def _normalize_receipt(row, now):
+    if not isinstance(row, dict):
+        raise ValueError(f"expected an object, got {row!r}")
+    try:
+        user_id = int(row["user_id"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"invalid user_id: {row.get('user_id')!r}") from None
+    try:
+        amount = float(row["amount"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"invalid amount: {row.get('amount')!r}") from None
+    if not math.isfinite(amount):
+        raise ValueError(f"invalid amount: {row['amount']!r}")
+    status = row.get("status") or "pending"
+    if status not in RECEIPT_STATUSES:
+        raise ValueError(f"invalid receipt status: {status!r}")
+    description = row.get("description")
+    created_at = row.get("created_at") or now
+    try:
+        created_ts = to_epoch(created_at)
+    except ValueError:
+        raise ValueError(f"invalid created_at: {created_at!r}") from None
+    return {
+        "user_id": user_id,
+        "amount": amount,
+        "status": status,
+        "description": description if description not in ("", None) else None,
+        "created_at": created_at,
+        "created_ts": created_ts,
+        "external_ref": row.get("external_ref") or None,
+        "file_ref": row.get("file_ref") or None,
+    }
+
+def _normalize_receipts(rows, now, on_invalid):
+    for row in rows:
+        try:
+            yield _normalize_receipt(row, now)
+        except ValueError as e:
+            if on_invalid is None:
+                raise
+            on_invalid(row, e)
+
+def create_receipts_many(rows, chunk_size=BULK_CHUNK_SIZE, on_duplicate=None, on_invalid=None, progress=None):
+    """Insert receipts from an iterable of mappings (`user_id`, `amount`, and optional `status`,
+    `description`, `created_at`, `external_ref`, `file_ref`). A receipt whose `external_ref` already exists is
+    a duplicate, which makes re-running an import safe. Balances are updated per chunk.
+
+    Raises ValueError on a malformed row (chunks before it stay committed), or,
+    with `on_invalid`, calls `on_invalid(row, error)` and skips the row.
+    `progress(totals)` is called after every committed chunk with the running totals.
+    Returns {"inserted": n, "duplicates": n}.
+    """
+    inserted = duplicated = 0
+    now = datetime.utcnow().isoformat()
+    normalized = _normalize_receipts(rows, now, on_invalid)
+    for chunk in _chunks(normalized, chunk_size):
+        credited = {}
+        with transaction() as conn:
+            new, duplicates = _split_duplicates(conn, chunk, "external_ref", "receipts", "external_ref")
+            new, archived = _split_duplicates(conn, new, "external_ref", "receipts_archive", "external_ref")
+            duplicates += archived
+            conn.executemany(
+                "INSERT INTO receipts (user_id, amount, status, description, created_at, created_ts, external_ref, "
+                "file_ref) VALUES (:user_id, :amount, :status, :description, :created_at, :created_ts, :external_ref, "
+                ":file_ref)",
+                new
+            )
+            for row in new:
+                if row["status"] == CREDITED_STATUS:
+                    credited[row["user_id"]] = credited.get(row["user_id"], 0) + row["amount"]
+            for user_id, delta in credited.items():
+                _apply_balance_delta(conn, user_id, delta)
+        inserted += len(new)
+        duplicated += len(duplicates)
+        if credited:
+            _notify_balance_change(list(credited))
+        if on_duplicate:
+            for row in duplicates:
+                on_duplicate(row)
+        if progress:
+            progress({"inserted": inserted, "duplicates": duplicated})
+    return {"inserted": inserted, "duplicates": duplicated}
+
+# Blob reference counts
+# storage_service keeps one copy of each distinct upload; these track how many
+# references point at it. No file I/O happens in these transactions: a new
+# blob is uploaded before retain_blob() adds its first reference, and a blob
+# whose last reference is released keeps its row (refcount 0, released_ts) and
+# its file until storage_service.collect_garbage() claims it (refcount -1),
+# deletes the file and then the row with drop_blob(). A claimed blob cannot be
+# retained, so a reference is never added to a file that is being deleted.
+BLOB_CLAIMED = -1
+
+def retain_blob(sha256, size, create=True):
+    """Add a reference to blob `sha256` and return the new count.
+
+    Returns None without adding one when the blob is claimed for deletion, or
+    when it has no row and `create` is false (its file is not stored).
+    """
+    with transaction() as conn:
+        if create:
+            # insert-first, so a concurrent first reference waits on the new key instead of racing it
+            inserted = conn.execute(
+                "INSERT INTO blobs (sha256, size, refcount, created_at) VALUES (?, ?, 1, ?) "
+                "ON CONFLICT(sha256) DO NOTHING",
+                (sha256, size, datetime.utcnow().isoformat())
+            ).rowcount
+            if inserted:
+                return 1
+        updated = conn.execute(
+            "UPDATE blobs SET refcount = refcount + 1, released_ts = NULL WHERE sha256 = ? AND refcount >= 0",
+            (sha256,)
+        ).rowcount
+        if not updated:
+            return None
+        return conn.execute("SELECT refcount FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()["refcount"]
+
+def release_blob(sha256):
+    """Drop a reference to blob `sha256`. Returns the new count; at 0 the blob awaits garbage collection."""
+    with transaction() as conn:
+        row = conn.execute("SELECT refcount FROM blobs WHERE sha256 = ?" + get_backend().for_update,
+                           (sha256,)).fetchone()
+        if row is None or row["refcount"] <= 0:
+            return 0
+        conn.execute(
+            "UPDATE blobs SET refcount = refcount - 1, released_ts = CASE WHEN refcount = 1 THEN ? END "
+            "WHERE sha256 = ?", (int(time.time()), sha256)
+        )
+        return row["refcount"] - 1
+
+def claim_released_blobs(grace=0, limit=100):
+    """Claim up to `limit` blobs released more than `grace` seconds ago for deletion. Returns their digests."""
+    with transaction() as conn:
+        rows = conn.execute(
+            "SELECT sha256 FROM blobs WHERE refcount = 0 AND released_ts <= ? ORDER BY released_ts LIMIT ?"
+            + get_backend().for_update_skip_locked, (int(time.time()) - grace, limit)
+        ).fetchall()
+        digests = [row["sha256"] for row in rows]
+        conn.executemany("UPDATE blobs SET refcount = ? WHERE sha256 = ? AND refcount = 0",
+                         [(BLOB_CLAIMED, digest) for digest in digests])
+    return digests
+
+def drop_blob(sha256):
+    """Remove a claimed blob's row once its file is deleted."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM blobs WHERE sha256 = ? AND refcount = ?", (sha256, BLOB_CLAIMED))
+
+def unclaim_blob(sha256):
+    """Give a claimed blob back (its file could not be deleted) so a later sweep retries it."""
+    with transaction() as conn:
+        conn.execute("UPDATE blobs SET refcount = 0 WHERE sha256 = ? AND refcount = ?", (sha256, BLOB_CLAIMED))
+
+def get_blob(sha256):
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+    return row_to_dict(row)
+
+def iter_blob_digests(batch_size=1000):
+    """Yield the sha256 of every referenced blob, streaming like iter_receipts()."""
+    backend = get_backend()
+    conn = _acquire(backend)
+    try:
+        for row in backend.stream(conn, "SELECT sha256 FROM blobs WHERE refcount > 0 ORDER BY sha256", (),
+                                  batch_size):
+            yield row["sha256"]
+    finally:
+        _release(backend, conn)
+
+# Thumbnail index
+# thumbnail_service stores generated thumbnails through storage_service and
+# records each one here with its size and last access time; a trigger keeps
+# their total in the "thumbnails:bytes" counter, so the size cap is checked
+# without a scan and eviction walks the accessed_ts index oldest first.
+def get_thumbnail(key):
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM thumbnails WHERE key = ?", (key,)).fetchone()
+    return row_to_dict(row)
+
+def record_thumbnail(key, sha256, size):
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO thumbnails (key, sha256, bytes, accessed_ts) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET bytes = excluded.bytes, accessed_ts = excluded.accessed_ts",
+            (key, sha256, size, int(time.time()))
+        )
+
+def touch_thumbnail(key):
+    with transaction() as conn:
+        conn.execute("UPDATE thumbnails SET accessed_ts = ? WHERE key = ?", (int(time.time()), key))
+
+def evict_thumbnails(max_bytes, low_water=0.9, batch_size=500):
+    """Forget least recently used thumbnails until their total is at most low_water * max_bytes.
+
+    Only runs when the total exceeds max_bytes. Returns the evicted keys; the
+    caller deletes the files.
+    """
+    evicted = []
+    while True:
+        with transaction() as conn:
+            row = conn.execute("SELECT value FROM counters WHERE name = 'thumbnails:bytes'").fetchone()
+            total = row["value"] if row else 0
+            if total <= (max_bytes if not evicted else max_bytes * low_water):
+                return evicted
+            excess = total - max_bytes * low_water
+            keys = []
+            for row in conn.execute("SELECT key, bytes FROM thumbnails ORDER BY accessed_ts LIMIT ?", (batch_size,)):
+                keys.append(row["key"])
+                excess -= row["bytes"]
+                if excess <= 0:
+                    break
+            if not keys:
+                return evicted
+            conn.executemany("DELETE FROM thumbnails WHERE key = ?", [(key,) for key in keys])
+        evicted.extend(keys)
+
+def forget_thumbnails(sha256):
+    """Drop the index entries of every thumbnail of blob `sha256`. Returns their keys."""
+    with transaction() as conn:
+        keys = [row["key"] for row in conn.execute("SELECT key FROM thumbnails WHERE sha256 = ?", (sha256,))]
+        conn.execute("DELETE FROM thumbnails WHERE sha256 = ?", (sha256,))
+    return keys
+
+# Broadcasts
+# A broadcast (migration 11) is one message to every user. broadcast_service
+# streams recipients in user id order and writes each one's outcome to
+# broadcast_deliveries in batches, together with the running totals and the
+# cursor: the user id up to which every recipient has an outcome. A restarted
+# run continues after the cursor and skips users that already have an outcome,
+# so an interrupted broadcast resumes where it stopped. One runner owns a
+# running broadcast at a time; it refreshes heartbeat_ts with every batch and
+# another runner may take over once that is older than `stale_after`.
+BROADCAST_STATUSES = ("pending", "running", "paused", "completed", "cancelled")
+DELIVERY_STATUSES = ("sent", "failed", "blocked")
+# status -> statuses it may be set from by set_broadcast_status()
+_BROADCAST_TRANSITIONS = {
+    "paused": ("pending", "running"),
+    "pending": ("paused",),
+    "cancelled": ("pending", "running", "paused"),
+}
+
+def create_broadcast(text):
+    if not text or not text.strip():
+        raise ValueError("broadcast text is required")
+    with transaction() as conn:
+        cur = conn.execute(
+            "INSERT INTO broadcasts (text, status, total, created_at) VALUES (?, 'pending', ?, ?)",
+            (text, get_counter("users"), datetime.utcnow().isoformat())
+        )
+        return cur.lastrowid
+
+def get_broadcast(broadcast_id):
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    return row_to_dict(row)
+
+def get_broadcasts(limit=20):
+    with connection() as conn:
+        rows = conn.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [row_to_dict(r) for r in rows]
+
+def set_broadcast_status(broadcast_id, status):
+    """Pause ("paused"), resume ("pending") or cancel ("cancelled") a broadcast.
+
+    A running broadcast's runner notices at its next batch and stops. Returns
+    False when the broadcast does not exist or cannot move to `status`.
+    """
+    if status not in _BROADCAST_TRANSITIONS:
+        raise ValueError(f"invalid broadcast status: {status!r}")
+    allowed = _BROADCAST_TRANSITIONS[status]
+    placeholders = ", ".join("?" * len(allowed))
+    with transaction() as conn:
+        cur = conn.execute(
+            f"UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status IN ({placeholders})",
+            (status, datetime.utcnow().isoformat() if status == "cancelled" else None, broadcast_id, *allowed)
+        )
+        return cur.rowcount == 1
+
+def claim_broadcast(broadcast_id, owner, stale_after=60):
+    """Make `owner` the runner of a pending broadcast, or of a running one whose runner went quiet.
+
+    Returns False when the broadcast is not claimable.
+    """
+    now = int(time.time())
+    with transaction() as conn:
+        cur = conn.execute(
+            "UPDATE broadcasts SET status = 'running', owner = ?, heartbeat_ts = ?, "
+            "started_at = COALESCE(started_at, ?) "
+            "WHERE id = ? AND (status = 'pending' OR (status = 'running' AND heartbeat_ts < ?))",
+            (owner, now, datetime.utcnow().isoformat(), broadcast_id, now - stale_after)
+        )
+        return cur.rowcount == 1
+
+def get_broadcast_recipients(broadcast_id, after=0, limit=500):
+    """The next `limit` user ids above `after` that have no delivery outcome for the broadcast yet."""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT id FROM users WHERE id > ? AND NOT EXISTS ("
+            "SELECT 1 FROM broadcast_deliveries d WHERE d.broadcast_id = ? AND d.user_id = users.id) "
+            "ORDER BY id LIMIT ?",
+            (after, broadcast_id, limit)
+        ).fetchall()
+    return [row["id"] for row in rows]
+
+def record_broadcast_deliveries(broadcast_id, owner, results, cursor=None, rate=None):
+    """Store delivery outcomes and, while `owner` still runs the broadcast, its cursor and send rate.
+
+    `results` are (user_id, status, attempts, error) tuples; a user that already
+    has an outcome keeps it. The totals grow by the outcomes actually stored, in
+    the same transaction. Returns the broadcast's status, or None when it is
+    gone or another runner has taken it over.
+    """
+    now = datetime.utcnow().isoformat()
+    with transaction() as conn:
+        row = conn.execute("SELECT status, owner FROM broadcasts WHERE id = ?" + get_backend().for_update,
+                           (broadcast_id,)).fetchone()
+        if row is None:
+            return None
+        new = {}
+        for chunk in _chunks(results, 500):
+            placeholders = ", ".join("?" * len(chunk))
+            existing = {r["user_id"] for r in conn.execute(
+                f"SELECT user_id FROM broadcast_deliveries WHERE broadcast_id = ? AND user_id IN ({placeholders})",
+                (broadcast_id, *(r[0] for r in chunk))
+            )}
+            for user_id, status, attempts, error in chunk:
+                if status not in DELIVERY_STATUSES:
+                    raise ValueError(f"invalid delivery status: {status!r}")
+                if user_id not in existing:
+                    new[user_id] = (status, attempts, error)
+        if new:
+            conn.executemany(
+                "INSERT INTO broadcast_deliveries (broadcast_id, user_id, status, attempts, error, delivered_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(broadcast_id, user_id, status, attempts, error, now)
+                 for user_id, (status, attempts, error) in new.items()]
+            )
+            totals = {status: 0 for status in DELIVERY_STATUSES}
+            for status, _, _ in new.values():
+                totals[status] += 1
+            conn.execute("UPDATE broadcasts SET sent = sent + ?, failed = failed + ?, blocked = blocked + ? "
+                         "WHERE id = ?", (totals["sent"], totals["failed"], totals["blocked"], broadcast_id))
+        if row["owner"] != owner:
+            return None
+        conn.execute(
+            "UPDATE broadcasts SET heartbeat_ts = ?, rate = COALESCE(?, rate), "
+            "cursor = CASE WHEN ? > cursor THEN ? ELSE cursor END WHERE id = ?",
+            (int(time.time()), rate, cursor or 0, cursor or 0, broadcast_id)
+        )
+        return row["status"]
+
+def finish_broadcast(broadcast_id, owner):
+    """Mark a broadcast `owner` runs as completed. Returns False if it was paused, cancelled or taken over."""
+    with transaction() as conn:
+        cur = conn.execute(
+            "UPDATE broadcasts SET status = 'completed', finished_at = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            (datetime.utcnow().isoformat(), broadcast_id, owner)
+        )
+        return cur.rowcount == 1
+
+def get_broadcast_failures(broadcast_id, limit=20):
+    """Failed or blocked deliveries of a broadcast, highest user id first, for the admin UI."""
+    with connection() as conn:
+        rows = conn.execute(
+            "SELECT * FROM broadcast_deliveries WHERE broadcast_id = ? AND status <> 'sent' "
+            "ORDER BY user_id DESC LIMIT ?",
+            (broadcast_id, limit)
+        ).fetchall()
+    return [row_to_dict(r) for r in rows]
+
+# Job queue
+# Work that should not run inside a request or a bot handler is stored as a job
+# (migration 13): a kind, a JSON payload and visible_ts, the time from which it
+# may be claimed. claim_jobs() leases visible jobs to one worker by setting them
+# "running" with visible_ts at the end of the lease; a worker that dies loses
+# its jobs when the lease runs out and they are claimed again, so every job
+# runs at least once and handlers must be idempotent. Claims are atomic under
+# BEGIN IMMEDIATE on SQLite and FOR UPDATE SKIP LOCKED on PostgreSQL, so any
+# number of job_worker.py processes can drain the same queue.
+JOB_STATUSES = ("queued", "running", "done", "failed")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+
+def _job_to_dict(row):
+    job = row_to_dict(row)
+    if job is not None:
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+    return job
+
+def enqueue_job(kind, payload=None, max_attempts=JOB_MAX_ATTEMPTS, delay=0):
+    """Queue a job of `kind` with a JSON-serializable payload, claimable after `delay` seconds. Returns its id."""
+    with transaction() as conn:
+        cur = conn.execute(
+            "INSERT INTO jobs (kind, payload, status, max_attempts, visible_ts, created_at) "
+            "VALUES (?, ?, 'queued', ?, ?, ?)",
+            (kind, json.dumps(payload or {}), max_attempts, int(time.time()) + delay, datetime.utcnow().isoformat())
+        )
+        return cur.lastrowid
+
+def claim_jobs(owner, limit=1, lease=60):
+    """Lease up to `limit` visible jobs to `owner` for `lease` seconds, oldest first.
+
+    A running job whose lease ran out on its last attempt is marked failed
+    instead of being handed out again. Returns the claimed jobs with their
+    payload decoded; `attempts` includes this one.
+    """
+    now = int(time.time())
+    with transaction() as conn:
+        rows = conn.execute(
+            "SELECT * FROM jobs WHERE status IN ('queued', 'running') AND visible_ts <= ? "
+            "ORDER BY visible_ts LIMIT ?" + get_backend().for_update_skip_locked,
+            (now, limit)
+        ).fetchall()
+        exhausted = [(datetime.utcnow().isoformat(), row["id"]) for row in rows
+                     if row["attempts"] >= row["max_attempts"]]
+        if exhausted:
+            conn.executemany("UPDATE jobs SET status = 'failed', owner = NULL, finished_at = ?, "
+                             "error = COALESCE(error, 'lease expired') WHERE id = ?", exhausted)
+        ids = [row["id"] for row in rows if row["attempts"] < row["max_attempts"]]
+        if not ids:
+            return []
+        placeholders = ", ".join("?" * len(ids))
+        conn.execute(
+            f"UPDATE jobs SET status = 'running', owner = ?, attempts = attempts + 1, visible_ts = ? "
+            f"WHERE id IN ({placeholders})",
+            (owner, now + lease, *ids)
+        )
+        rows = conn.execute(f"SELECT * FROM jobs WHERE id IN ({placeholders}) ORDER BY id", ids).fetchall()
+    return [_job_to_dict(row) for row in rows]
+
+def extend_job_lease(job_id, owner, lease=60):
+    """Push the lease of a job `owner` is running `lease` seconds ahead. False if the lease was lost."""
+    with transaction() as conn:
+        cur = conn.execute("UPDATE jobs SET visible_ts = ? WHERE id = ? AND owner = ? AND status = 'running'",
+                           (int(time.time()) + lease, job_id, owner))
+        return cur.rowcount == 1
+
+def complete_job(job_id, owner, result=None):
+    """Mark a job `owner` is running as done. False if its lease was lost meanwhile."""
+    with transaction() as conn:
+        cur = conn.execute(
+            "UPDATE jobs SET status = 'done', owner = NULL, result = ?, error = NULL, finished_at = ? "
+            "WHERE id = ? AND owner = ? AND status = 'running'",
+            (json.dumps(result), datetime.utcnow().isoformat(), job_id, owner)
+        )
+        return cur.rowcount == 1
+
+def fail_job(job_id, owner, error, retry_delay=0, retry=True):
+    """Record a failed attempt: requeue the job after `retry_delay` seconds while it has attempts
+    left (and `retry`), else mark it failed. Returns the new status, or None if the lease was lost."""
+    with transaction() as conn:
+        row = conn.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND owner = ? AND status = 'running'"
+                           + get_backend().for_update, (job_id, owner)).fetchone()
+        if row is None:
+            return None
+        if retry and row["attempts"] < row["max_attempts"]:
+            conn.execute("UPDATE jobs SET status = 'queued', owner = NULL, error = ?, visible_ts = ? WHERE id = ?",
+                         (str(error)[:1000], int(time.time() + retry_delay), job_id))
+            return "queued"
+        conn.execute("UPDATE jobs SET status = 'failed', owner = NULL, error = ?, finished_at = ? WHERE id = ?",
+                     (str(error)[:1000], datetime.utcnow().isoformat(), job_id))
+        return "failed"
+
+def get_job(job_id):
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _job_to_dict(row)
+
+def get_jobs(limit=50, status=None):
+    with connection() as conn:
+        if status:
+            rows = conn.execute("SELECT * FROM jobs WHERE status = ? ORDER BY id DESC LIMIT ?",
+                                (status, limit)).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [_job_to_dict(r) for r in rows]
+
+# Conversation state
+# Where each user is in a multi-step bot flow (e.g. the sick leave request),
+# as {"flow", "step", "data"}; migration 14. Reads go through an in-process LRU
+# cache and writes only change the cache; a background thread writes the
+# changed states back in one transaction every CONVERSATION_FLUSH_INTERVAL
+# seconds, and close_conversations() writes the rest on shutdown. Rows carry a
+# version and a write-back only applies if the row still has the version this
+# process read, so when several bot processes handle the same user the first
+# write wins and the other process drops its copy and re-reads, rather than
+# overwriting it. Cached states expire after CONVERSATION_CACHE_TTL seconds so
+# changes made elsewhere are picked up.
+CONVERSATION_FLUSH_INTERVAL = float(os.getenv("CONVERSATION_FLUSH_INTERVAL", "0.5"))
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "10000"))
+CONVERSATION_CACHE_TTL = float(os.getenv("CONVERSATION_CACHE_TTL", "10"))
+
+CONVERSATION_WRITES = metrics.Counter(
+    "conversation_state_writes_total", "Conversation states written back, by outcome.", ("outcome",)
+)
+
+# user_id -> {"state", "version" (of the row it is based on, 0: none), "expires", "dirty" (write count, 0: clean)}
+_conversations = OrderedDict()
+_conversations_lock = threading.Lock()
+_conversation_flusher = None
+_conversation_stop = threading.Event()
+
+def _load_conversation(user_id):
+    with connection() as conn:
+        row = conn.execute("SELECT * FROM conversation_state WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None:
+        return None, 0
+    return {"flow": row["flow"], "step": row["step"], "data": json.loads(row["data"])}, row["version"]
+
+def _trim_conversations():
+    # only clean entries may go; changed ones stay until they are written back
+    excess = len(_conversations) - CONVERSATION_CACHE_SIZE
+    for user_id in [u for u, entry in _conversations.items() if not entry["dirty"]][:max(excess, 0)]:
+        del _conversations[user_id]
+
+def _copy_state(state):
+    return None if state is None else {**state, "data": dict(state["data"])}
+
+def get_conversation(user_id):
+    """The user's conversation state {"flow", "step", "data"}, or None when they are in no flow."""
+    now = time.monotonic()
+    with _conversations_lock:
+        entry = _conversations.get(user_id)
+        if entry is not None and (entry["dirty"] or entry["expires"] > now):
+            _conversations.move_to_end(user_id)
+            return _copy_state(entry["state"])
+    state, version = _load_conversation(user_id)
+    with _conversations_lock:
+        entry = _conversations.get(user_id)
+        if entry is not None and entry["dirty"]:
+            # changed by this process while we read
+            return _copy_state(entry["state"])
+        _conversations[user_id] = {"state": state, "version": version,
+                                   "expires": now + CONVERSATION_CACHE_TTL, "dirty": 0}
+        _trim_conversations()
+    return _copy_state(state)
+
+def _put_conversation(user_id, state):
+    with _conversations_lock:
+        cached = user_id in _conversations
+    if not cached:
+        # the write needs the version it replaces
+        get_conversation(user_id)
+    with _conversations_lock:
+        entry = _conversations.get(user_id)
+        if entry is None:
+            entry = _conversations[user_id] = {"state": None, "version": 0, "expires": 0, "dirty": 0}
+        entry["state"] = state
+        entry["dirty"] += 1
+        _conversations.move_to_end(user_id)
+    _start_conversation_flusher()
+
+def set_conversation(user_id, flow, step, data=None):
+    """Move the user to `step` of `flow` with JSON-serializable `data`; written back in the background."""
+    json.dumps(data or {})  # fail here rather than in the flusher
+    _put_conversation(user_id, {"flow": flow, "step": step, "data": dict(data or {})})
+
+def clear_conversation(user_id):
+    """End the user's flow; written back in the background."""
+    _put_conversation(user_id, None)
+
+def _write_conversation(conn, user_id, state, version, now):
+    if state is None:
+        return conn.execute("DELETE FROM conversation_state WHERE user_id = ? AND version = ?",
+                            (user_id, version)).rowcount == 1 or version == 0
+    values = (state["flow"], state["step"], json.dumps(state["data"]), version + 1, now)
+    if version == 0:
+        cur = conn.execute(
+            "INSERT INTO conversation_state (flow, step, data, version, updated_at, user_id) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (user_id) DO NOTHING", (*values, user_id))
+    else:
+        cur = conn.execute(
+            "UPDATE conversation_state SET flow = ?, step = ?, data = ?, version = ?, updated_at = ? "
+            "WHERE user_id = ? AND version = ?", (*values, user_id, version))
+    return cur.rowcount == 1
+
+def flush_conversations():
+    """Write back every changed conversation state in one transaction. Returns (written, conflicts)."""
+    with _conversations_lock:
+        pending = [(user_id, entry["state"], entry["version"], entry["dirty"])
+                   for user_id, entry in _conversations.items() if entry["dirty"]]
+    if not pending:
+        return 0, 0
+    now = datetime.utcnow().isoformat()
+    outcomes = []
+    with transaction() as conn:
+        for user_id, state, version, _ in pending:
+            outcomes.append(_write_conversation(conn, user_id, state, version, now))
+    # what the other process stored, for users who moved on here meanwhile (rare: read outside the lock)
+    stored = {user_id: _load_conversation(user_id)[1]
+              for (user_id, _, _, _), written in zip(pending, outcomes) if not written}
+    conflicts = 0
+    expires = time.monotonic() + CONVERSATION_CACHE_TTL
+    with _conversations_lock:
+        for (user_id, state, version, dirty), written in zip(pending, outcomes):
+            entry = _conversations.get(user_id)
+            if entry is None:
+                continue
+            if not written:
+                conflicts += 1
+                if entry["dirty"] == dirty:
+                    # another process changed this user's state first; its write stands
+                    logger.warning("Conversation state of user %s was changed elsewhere; dropping ours", user_id)
+                    _conversations.pop(user_id, None)
+                else:
+                    # the user moved on here while we were flushing: that newer step is
+                    # written again on top of the other process's version
+                    logger.warning("Conversation state of user %s was changed elsewhere; "
+                                   "retrying our newer step against it", user_id)
+                    entry["dirty"] -= dirty
+                    entry["version"] = stored[user_id]
+                continue
+            entry["version"] = 0 if state is None else version + 1
+            entry["expires"] = expires
+            # written again while we were flushing: stays dirty, now based on the new version
+            entry["dirty"] -= dirty
+        _trim_conversations()
+    CONVERSATION_WRITES.inc(len(pending) - conflicts, outcome="written")
+    if conflicts:
+        CONVERSATION_WRITES.inc(conflicts, outcome="conflict")
+    return len(pending) - conflicts, conflicts
+
+def _run_conversation_flusher():
+    while not _conversation_stop.wait(CONVERSATION_FLUSH_INTERVAL):
+        try:
+            flush_conversations()
+        except Exception:
+            # states stay dirty and are retried on the next tick
+            logger.exception("Writing back conversation states failed")
+
+def _start_conversation_flusher():
+    global _conversation_flusher
+    if _conversation_flusher is not None:
+        return
+    with _conversations_lock:
+        if _conversation_flusher is None:
+            _conversation_stop.clear()
+            _conversation_flusher = threading.Thread(target=_run_conversation_flusher,
+                                                     name="conversation-flusher", daemon=True)
+            _conversation_flusher.start()
+
+def close_conversations():
+    """Stop the background writer and write back what is left (call on shutdown, before close_pool)."""
+    global _conversation_flusher
+    _conversation_stop.set()
+    flusher, _conversation_flusher = _conversation_flusher, None
+    if flusher is not None:
+        flusher.join()
+    return flush_conversations()
+
+def reset_conversation_cache():
+    """Forget cached states without writing them back (tests and benchmarks)."""
+    with _conversations_lock:
+        _conversations.clear()
+
+# Full-text search
+# users_fts / receipts_fts (migration 7) are external-content FTS5 indexes kept
+# in sync by triggers. Results are ranked by bm25 and paginated by page number.
+SEARCH_KINDS = ("receipts", "users")
+SEARCH_PAGE_SIZE = 20
+# Trigram matching needs at least this many characters per term
+MIN_USER_TERM_LENGTH = 3
+
+def _fts_query(text, prefix):
+    """Turn free text into a safe FTS5 query: every term quoted (and prefix-matched if asked), ANDed."""
+    terms = []
+    for term in text.split():
+        quoted = '"' + term.replace('"', '""') + '"'
+        terms.append(quoted + "*" if prefix else quoted)
+    return " ".join(terms)
+
+def _postgres_search_sql(kind, text, status):
+    # GIN expression indexes from migration 7; users match by word prefix rather than trigram substring
+    query = db_backends.tsquery(text, prefix=True)
+    if not query:
+        return None, None
+    if kind == "users":
+        document = db_backends.POSTGRES_USERS_DOCUMENT
+        sql = (f"SELECT u.* FROM users u, to_tsquery('simple', ?) q WHERE {document} @@ q "
+               f"ORDER BY ts_rank({document}, q) DESC, u.id DESC LIMIT ? OFFSET ?")
+        return sql, [query]
+    document = db_backends.POSTGRES_RECEIPTS_DOCUMENT
+    sql = (f"SELECT r.* FROM receipts r, to_tsquery('simple', ?) q WHERE {document} @@ q"
+           f"{' AND r.status = ?' if status else ''} "
+           f"ORDER BY ts_rank({document}, q) DESC, r.id DESC LIMIT ? OFFSET ?")
+    return sql, [query, status] if status else [query]
+
+def search(query, kind="receipts", page=1, limit=SEARCH_PAGE_SIZE, status=None):
+    """Ranked full-text search over receipts (description) or users (name, email).
+
+    Returns {"items": [...], "page": n, "has_next": bool}.
+    """
+    if kind not in SEARCH_KINDS:
+        raise ValueError(f"invalid search kind: {kind!r}")
+    page = max(1, int(page or 1))
+    limit = max(1, min(int(limit or SEARCH_PAGE_SIZE), MAX_PAGE_SIZE))
+    text = (query or "").strip()
+    if kind == "users":
+        text = " ".join(t for t in text.split() if len(t) >= MIN_USER_TERM_LENGTH)
+    if not text:
+        return {"items": [], "page": page, "has_next": False}
+
+    if get_backend().name == "postgres":
+        sql, params = _postgres_search_sql(kind, text, status)
+        if sql is None:
+            return {"items": [], "page": page, "has_next": False}
+    elif kind == "users":
+        sql = ("SELECT u.* FROM users_fts JOIN users u ON u.id = users_fts.rowid "
+               "WHERE users_fts MATCH ? ORDER BY users_fts.rank LIMIT ? OFFSET ?")
+        params = [_fts_query(text, prefix=False)]
+    else:
+        sql = ("SELECT r.* FROM receipts_fts JOIN receipts r ON r.id = receipts_fts.rowid "
+               "WHERE receipts_fts MATCH ?{status} ORDER BY receipts_fts.rank LIMIT ? OFFSET ?")
+        params = [_fts_query(text, prefix=True)]
+        sql = sql.format(status=" AND r.status = ?" if status else "")
+        if status:
+            params.append(status)
+    params += [limit + 1, (page - 1) * limit]
+    with connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return {"items": [row_to_dict(r) for r in rows[:limit]], "page": page, "has_next": len(rows) > limit}
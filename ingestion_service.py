@@ -0,0 +1,121 @@
+"""
+Receipt ingestion pipeline for the bot: stream the Telegram file to disk while
+hashing it, commit it into storage_service, then record it with
+db_service.create_receipt. Handlers schedule ingest_receipt() as a background
+task so the user is acknowledged immediately.
+
+Receipts are recorded as pending with amount 0 and the caption as their
+description; the amount is left for the admin who reviews the receipt.
+Blocking file and DB calls run on the executor given to set_executor() (the
+bot's bounded DB executor), so ingestion shares its DB_EXECUTOR_WORKERS
+threads with the handlers rather than growing a pool of its own.
+"""
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import Executor
+from typing import Any, AsyncIterator, Callable, Optional
+
+import httpx
+
+import db_service
+import storage_service
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# Bot API getFile only serves files up to 20 MB
+MAX_RECEIPT_BYTES = int(os.getenv("MAX_RECEIPT_BYTES", str(20 * 1024 * 1024)))
+# Downloads running at once; further receipts wait their turn
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+
+_semaphore: Optional[asyncio.Semaphore] = None
+_http_client: Optional[httpx.AsyncClient] = None
+_executor: Optional[Executor] = None
+
+
+def set_http_client(client: Optional[httpx.AsyncClient]) -> None:
+    """Use `client` for file downloads (e.g. one with a local transport for offline runs)."""
+    global _http_client
+    _http_client = client
+
+
+def set_executor(executor: Optional[Executor]) -> None:
+    """Run blocking file and DB calls on `executor` (None: the event loop's default executor)."""
+    global _executor
+    _executor = executor
+
+
+async def _run_blocking(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0))
+    return _http_client
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(INGEST_CONCURRENCY)
+    return _semaphore
+
+
+async def stream_telegram_file(bot, file_id: str) -> AsyncIterator[bytes]:
+    """Yield the content of a Telegram file in CHUNK_SIZE pieces."""
+    tg_file = await bot.get_file(file_id)
+    file_path = tg_file.file_path or ""
+    if file_path.startswith(("http://", "https://")):
+        async with _get_http_client().stream("GET", file_path) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                yield chunk
+    else:
+        # local Bot API server mode: the file is already on this machine
+        with open(file_path, "rb") as fh:
+            while True:
+                chunk = await _run_blocking(fh.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+
+async def ingest_receipt(bot, user_id: int, file_id: str, caption: Optional[str] = None,
+                         chat_id: Optional[int] = None) -> int:
+    """
+    Download, store and record one receipt. Returns the new receipt id.
+    Sends a confirmation to `chat_id` when given.
+    """
+    async with _get_semaphore():
+        writer = await _run_blocking(storage_service.UploadWriter)
+        try:
+            async for chunk in stream_telegram_file(bot, file_id):
+                if writer.size + len(chunk) > MAX_RECEIPT_BYTES:
+                    raise ValueError(f"receipt file exceeds {MAX_RECEIPT_BYTES} bytes")
+                await _run_blocking(writer.write, chunk)
+            file_ref = await _run_blocking(writer.commit)
+        except BaseException:
+            await _run_blocking(writer.abort)
+            raise
+
+    try:
+        receipt_id = await _run_blocking(
+            db_service.create_receipt, user_id, 0.0, "pending", caption, file_ref=file_ref
+        )
+    except Exception:
+        # commit() took a reference for the receipt; give it back so the blob can be collected.
+        # (Not on cancellation: the insert may still finish in its thread.)
+        try:
+            await _run_blocking(storage_service.release, file_ref)
+        except Exception:
+            logger.exception("Could not release %s after failing to record it", file_ref)
+        raise
+    logger.info("Recorded receipt %s for user %s (%s, %d bytes)", receipt_id, user_id, file_ref, writer.size)
+    if chat_id is not None:
+        await bot.send_message(chat_id, f"Receipt #{receipt_id} saved. We'll review it shortly.")
+    return receipt_id
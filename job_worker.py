@@ -0,0 +1,158 @@
+"""
+Worker that drains the db_service job queue.
+
+Each of --concurrency slots claims one job at a time, runs its handler on a
+thread and marks it done, or requeues it with exponential backoff until the
+job's attempts are used up. While a handler runs, its lease is extended every
+third of JOB_LEASE, so only the jobs of a worker that died become visible
+again. Run one or more next to the bot and the admin app:
+
+    python job_worker.py --concurrency 4
+
+Handlers take the decoded payload and return a JSON-serializable result.
+They may run more than once for the same job and must be idempotent.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import socket
+import uuid
+from typing import Callable, Dict
+
+import db_service
+
+logger = logging.getLogger(__name__)
+
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "2"))
+JOB_LEASE = int(os.getenv("JOB_LEASE", "60"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+JOB_BACKOFF = float(os.getenv("JOB_BACKOFF", "5"))
+
+# Job kinds
+SET_RECEIPT_STATUSES = "receipts.set_status"
+RECONCILE_BALANCES = "balances.reconcile"
+
+HANDLERS: Dict[str, Callable[[Dict], object]] = {}
+
+
+def handler(kind: str):
+    """Register the decorated function as the handler of jobs of `kind`."""
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+@handler(SET_RECEIPT_STATUSES)
+def set_receipt_statuses(payload: Dict) -> Dict:
+    """{"status": s, "ids": [...]} or {"status": s, "filter": {"status": ..., "user_id": ..., "max_id": ...}};
+    one transaction. `max_id` is required, so receipts created after the job was queued are left alone."""
+    status = payload["status"]
+    expected = None
+    if "ids" in payload:
+        ids = payload["ids"]
+    else:
+        filters = {k: v for k, v in payload.get("filter", {}).items() if v is not None}
+        if filters.get("max_id") is None:
+            raise ValueError("refusing to change receipts created after the job was queued: the filter has no max_id")
+        if len(filters) == 1:
+            raise ValueError("refusing to change every receipt: the filter is empty")
+        ids = db_service.get_receipt_ids(**filters)
+        # and receipts that left the filtered status meanwhile
+        expected = filters.get("status")
+    changed = db_service.set_receipt_statuses(((receipt_id, status) for receipt_id in ids), expected=expected)
+    return {"matched": len(ids), "changed": changed}
+
+
+@handler(RECONCILE_BALANCES)
+def reconcile_balances(payload: Dict) -> Dict:
+    return {"users": db_service.reconcile_balances()}
+
+
+class UnknownJobKind(Exception):
+    pass
+
+
+class JobWorker:
+    def __init__(self, concurrency: int = JOB_CONCURRENCY, lease: int = JOB_LEASE,
+                 poll_interval: float = JOB_POLL_INTERVAL, backoff: float = JOB_BACKOFF, handlers=None):
+        self.concurrency = concurrency
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.backoff = backoff
+        self.handlers = HANDLERS if handlers is None else handlers
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.stats = {"done": 0, "retried": 0, "failed": 0}
+
+    async def _keep_lease(self, job_id: int) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            if not await asyncio.to_thread(db_service.extend_job_lease, job_id, self.owner, self.lease):
+                logger.warning("Lost the lease of job %s", job_id)
+                return
+
+    def _handle(self, job: Dict):
+        func = self.handlers.get(job["kind"])
+        if func is None:
+            raise UnknownJobKind(f"no handler for job kind {job['kind']!r}")
+        return func(job["payload"])
+
+    async def run_job(self, job: Dict) -> None:
+        keeper = asyncio.create_task(self._keep_lease(job["id"]))
+        try:
+            result = await asyncio.to_thread(self._handle, job)
+        except Exception as e:
+            # exponential backoff with full jitter
+            delay = random.uniform(0, self.backoff * (2 ** (job["attempts"] - 1)))
+            status = await asyncio.to_thread(db_service.fail_job, job["id"], self.owner, repr(e), delay,
+                                             not isinstance(e, UnknownJobKind))
+            logger.warning("Job %s (%s) attempt %d failed: %r%s", job["id"], job["kind"], job["attempts"], e,
+                           "; retrying" if status == "queued" else "")
+            self.stats["retried" if status == "queued" else "failed"] += 1
+            return
+        finally:
+            keeper.cancel()
+        if await asyncio.to_thread(db_service.complete_job, job["id"], self.owner, result):
+            logger.info("Job %s (%s) done: %s", job["id"], job["kind"], result)
+            self.stats["done"] += 1
+
+    async def _slot(self, once: bool) -> None:
+        while True:
+            jobs = await asyncio.to_thread(db_service.claim_jobs, self.owner, 1, self.lease)
+            if not jobs:
+                if once:
+                    return
+                await asyncio.sleep(self.poll_interval * random.uniform(0.5, 1.5))
+                continue
+            await self.run_job(jobs[0])
+
+    async def run(self, once: bool = False) -> Dict:
+        """Run jobs until cancelled. With once=True, return when no job is visible."""
+        await asyncio.gather(*(self._slot(once) for _ in range(self.concurrency)))
+        return self.stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=JOB_CONCURRENCY)
+    parser.add_argument("--lease", type=int, default=JOB_LEASE, help="seconds a claimed job stays invisible")
+    parser.add_argument("--poll-interval", type=float, default=JOB_POLL_INTERVAL)
+    parser.add_argument("--once", action="store_true", help="exit once the queue is empty")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    db_service.init_db()
+    worker = JobWorker(concurrency=args.concurrency, lease=args.lease, poll_interval=args.poll_interval)
+    try:
+        stats = asyncio.run(worker.run(once=args.once))
+        logger.info("done=%(done)d retried=%(retried)d failed=%(failed)d", stats)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db_service.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,35 @@
 import os
+import asyncio
+import functools
 import logging
-from typing import Optional
+import signal
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
-    Updater,
+    Application,
+    ApplicationBuilder,
+    ApplicationHandlerStop,
+    BaseUpdateProcessor,
+    TypeHandler,
     CommandHandler,
     MessageHandler,
-    Filters,
-    CallbackContext,
+    ContextTypes,
     CallbackQueryHandler,
+    filters,
 )
 
+import config
+import db_service
+import ingestion_service
+import metrics
+from rate_limiter import Coalescer, RateLimiter, retry_after_seconds
+
 # Configure logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -23,8 +41,165 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN")
 if not BOT_TOKEN:
     logger.warning("Environment variable BOT_TOKEN not set. The bot will not run without a token.")
 
+# How many updates may be handled at once, and how many threads run blocking DB calls.
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "256"))
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", "8"))
+
+_db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+ingestion_service.set_executor(_db_executor)
+
+
+async def run_db(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """
+    Run a blocking db_service call on the bounded DB executor so it never stalls the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates concurrently (up to concurrency_limit at once) while keeping
+    updates from the same user strictly in arrival order.
+
+    The base class's semaphore is taken before do_process_update() runs, so it
+    is made effectively unbounded and the real limit is a second semaphore
+    taken only once the update holds its user's lock: updates queued behind
+    the same user wait without occupying a slot, and one busy user cannot
+    starve the others.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        super().__init__(2 ** 30)
+        self.concurrency_limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # user id -> [lock, number of updates holding or waiting for it]; dropped when idle
+        self._user_locks: Dict[int, list] = {}
+
+    @staticmethod
+    def _ordering_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._ordering_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# Throttling in front of the handlers: each user may send RATE_LIMIT_USER_PER_SEC
+# updates per second (bursts up to RATE_LIMIT_USER_BURST) and the bot as a whole
+# handles RATE_LIMIT_GLOBAL_PER_SEC, staying under Telegram's outgoing limits.
+RATE_LIMIT_USER_PER_SEC = float(os.environ.get("RATE_LIMIT_USER_PER_SEC", "1"))
+RATE_LIMIT_USER_BURST = float(os.environ.get("RATE_LIMIT_USER_BURST", "5"))
+RATE_LIMIT_GLOBAL_PER_SEC = float(os.environ.get("RATE_LIMIT_GLOBAL_PER_SEC", "25"))
+RATE_LIMIT_GLOBAL_BURST = float(os.environ.get("RATE_LIMIT_GLOBAL_BURST", "30"))
+RATE_LIMIT_IDLE_TTL = float(os.environ.get("RATE_LIMIT_IDLE_TTL", "300"))
+# Updates that would have to wait longer than this are dropped instead
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", "2"))
+# Repeated presses of the same button on the same message within this window are ignored
+CALLBACK_COALESCE_WINDOW = float(os.environ.get("CALLBACK_COALESCE_WINDOW", "2"))
+# A chat whose messages are dropped is told so at most once per this many seconds
+RATE_LIMIT_NOTICE_WINDOW = float(os.environ.get("RATE_LIMIT_NOTICE_WINDOW", "10"))
+RATE_LIMIT_NOTICE = "Too many requests, please try again in a moment."
+
+rate_limiter = RateLimiter(
+    RATE_LIMIT_USER_PER_SEC, RATE_LIMIT_USER_BURST, RATE_LIMIT_GLOBAL_PER_SEC, RATE_LIMIT_GLOBAL_BURST,
+    idle_ttl=RATE_LIMIT_IDLE_TTL,
+)
+callback_coalescer = Coalescer(CALLBACK_COALESCE_WINDOW)
+rate_limit_notices = Coalescer(RATE_LIMIT_NOTICE_WINDOW)
+
+
+# Handler latency, observed from when a handler starts until it returns (the
+# background part of receipt ingestion is not included).
+HANDLER_SECONDS = metrics.Histogram(
+    "bot_handler_duration_seconds", "Time spent in each bot handler.", ("handler",)
+)
+HANDLER_ERRORS = metrics.Counter("bot_handler_errors_total", "Errors reported to the error handler.", ("error",))
+
+
+def _timed(name: str):
+    return metrics.timed(HANDLER_SECONDS, handler=name)
+
+
+async def throttle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Runs before every handler (group -1). Drops duplicate button presses and
+    updates over the rate limits by raising ApplicationHandlerStop. Dropped
+    button presses are still answered so the client stops showing a spinner,
+    and a chat whose messages (e.g. receipts) are dropped is told to resend them.
+    """
+    query = update.callback_query
+    if query:
+        target = (query.message.chat.id, query.message.message_id) if query.message else query.inline_message_id
+        if callback_coalescer.seen((target, query.data)):
+            logger.debug("Coalesced duplicate callback %r from user %s", query.data, query.from_user.id)
+            await _answer_dropped(query)
+            raise ApplicationHandlerStop
+
+    user = update.effective_user
+    if not await rate_limiter.acquire(user.id if user else None, max_wait=RATE_LIMIT_MAX_WAIT):
+        logger.debug("Rate limited update %s from user %s", update.update_id, user.id if user else None)
+        if query:
+            await _answer_dropped(query, RATE_LIMIT_NOTICE)
+        elif update.effective_message and not rate_limit_notices.seen(update.effective_chat.id):
+            try:
+                await update.effective_message.reply_text(RATE_LIMIT_NOTICE)
+            except TelegramError as e:
+                logger.debug("Could not send the rate limit notice to chat %s: %s", update.effective_chat.id, e)
+        raise ApplicationHandlerStop
+
+
+async def _answer_dropped(query, text=None) -> None:
+    try:
+        await query.answer(text)
+    except TelegramError as e:
+        # e.g. the query is already too old to answer; nothing else to do with it
+        logger.debug("Could not answer dropped callback %s: %s", query.id, e)
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Slows everything down when Telegram answers with a flood wait; logs other errors.
+    """
+    HANDLER_ERRORS.inc(error=type(context.error).__name__)
+    if isinstance(context.error, RetryAfter):
+        seconds = retry_after_seconds(context.error)
+        logger.warning("Flood wait from Telegram: backing off for %.0fs", seconds)
+        rate_limiter.penalize(seconds)
+        return
+    logger.error("Exception while handling an update", exc_info=context.error)
+
 
-def start(update: Update, context: CallbackContext) -> None:
+@_timed("start")
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Interactive /start handler.
     Sends a personalized welcome message with the user's name and id and shows an inline keyboard
@@ -32,7 +207,7 @@ def start(update: Update, context: CallbackContext) -> None:
     """
     user = update.effective_user
     if not user:
-        update.message.reply_text("Hello — I couldn't determine your user info.")
+        await update.message.reply_text("Hello — I couldn't determine your user info.")
         return
 
     name = user.first_name or user.full_name or user.username or "there"
@@ -54,61 +229,179 @@ def start(update: Update, context: CallbackContext) -> None:
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    update.message.reply_text(welcome_text, reply_markup=reply_markup)
+    await update.message.reply_text(welcome_text, reply_markup=reply_markup)
+
+
+# In-process LRU cache in front of the balances ledger. Entries are dropped
+# explicitly when this process changes a balance; the TTL bounds staleness for
+# changes made by other processes (e.g. the admin panel).
+BALANCE_CACHE_SIZE = int(os.environ.get("BALANCE_CACHE_SIZE", "10000"))
+BALANCE_CACHE_TTL = float(os.environ.get("BALANCE_CACHE_TTL", "30"))
+_balance_cache: "OrderedDict[int, tuple]" = OrderedDict()
+_balance_cache_lock = threading.Lock()
+
+
+def invalidate_balance(user_ids: Optional[Iterable[int]] = None) -> None:
+    """
+    Drop cached balances for the given users, or the whole cache if user_ids is None.
+    """
+    with _balance_cache_lock:
+        if user_ids is None:
+            _balance_cache.clear()
+            return
+        for user_id in user_ids:
+            _balance_cache.pop(user_id, None)
+
+
+db_service.add_balance_listener(invalidate_balance)
 
 
-def _get_balance_for_user(user_id: int) -> str:
+async def _get_balance_for_user(user_id: int) -> str:
     """
-    Placeholder function to retrieve the user's balance.
-    Replace with real logic (DB/API) as needed.
+    Return the user's formatted balance, served from the LRU cache when fresh.
+    Only a cache miss goes to the DB executor.
     """
-    # For example purposes, return a dummy balance
-    # In a real implementation you would query your database or service here
-    balance_amount = 42.0
+    now = time.monotonic()
+    with _balance_cache_lock:
+        cached = _balance_cache.get(user_id)
+        if cached is not None and cached[1] > now:
+            _balance_cache.move_to_end(user_id)
+            return f"{cached[0]:.2f} credits"
+
+    balance_amount = await run_db(db_service.get_balance, user_id)
+
+    with _balance_cache_lock:
+        _balance_cache[user_id] = (balance_amount, now + BALANCE_CACHE_TTL)
+        _balance_cache.move_to_end(user_id)
+        while len(_balance_cache) > BALANCE_CACHE_SIZE:
+            _balance_cache.popitem(last=False)
     return f"{balance_amount:.2f} credits"
 
 
-def balance(update: Update, context: CallbackContext) -> None:
+@_timed("balance")
+async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Command handler for /balance — sends the user's balance.
     """
     user = update.effective_user
     user_id = user.id if user else None
     if user_id is None:
-        update.message.reply_text("Could not determine your user ID to fetch the balance.")
+        await update.message.reply_text("Could not determine your user ID to fetch the balance.")
         return
 
-    bal = _get_balance_for_user(user_id)
-    update.message.reply_text(f"Your current balance is: {bal}")
+    bal = await _get_balance_for_user(user_id)
+    await update.message.reply_text(f"Your current balance is: {bal}")
 
 
-def handle_receipt(update: Update, context: CallbackContext) -> None:
+async def _ingest_in_background(context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_id: int, **kwargs: Any) -> None:
+    try:
+        await ingestion_service.ingest_receipt(context.bot, user_id, chat_id=chat_id, **kwargs)
+    except Exception:
+        logger.exception("Failed to ingest receipt for user %s", user_id)
+        await context.bot.send_message(chat_id, "Sorry, we couldn't save your receipt. Please send it again.")
+
+
+@_timed("handle_receipt")
+async def handle_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handler for receipts or uploaded payment proofs.
-    This is a simple placeholder that acknowledges the receipt.
+    Acknowledges right away and downloads, stores and records the file in a background task.
     """
-    # In many bots, receipts may be images or documents — we just acknowledge here
-    update.message.reply_text("Thanks — we received your receipt. We'll process it and update your balance shortly.")
+    message = update.message
+    user = update.effective_user
+    # photos arrive in several sizes; the last one is the largest
+    attachment = message.document or message.photo[-1]
+    file_id, file_size = attachment.file_id, attachment.file_size
 
+    if user and await _attach_to_sick_leave(update, user.id, file_id):
+        return
 
-def credit_command(update: Update, context: CallbackContext) -> None:
+    if file_size and file_size > ingestion_service.MAX_RECEIPT_BYTES:
+        limit_mb = ingestion_service.MAX_RECEIPT_BYTES // (1024 * 1024)
+        await message.reply_text(f"This file is too large. Please send a receipt under {limit_mb} MB.")
+        return
+
+    if user:
+        context.application.create_task(
+            _ingest_in_background(context, user.id, message.chat_id, file_id=file_id, caption=message.caption),
+            update=update,
+        )
+    await message.reply_text("Thanks — we received your receipt. We'll process it and update your balance shortly.")
+
+
+# Sick leave requests: the "req_sick" button starts the flow, the user's next
+# text message is the explanation and the next photo/document the medical
+# note, after which the request waits for HR review. Each step is kept with
+# db_service.set_conversation(), which survives restarts and is shared by all
+# bot processes; see db_service's conversation state section.
+SICK_LEAVE_FLOW = "sick_leave"
+
+
+async def _attach_to_sick_leave(update: Update, user_id: int, file_id: str) -> bool:
+    """
+    Take the photo/document as the medical note if the user's sick leave request is waiting for one.
+    """
+    state = await run_db(db_service.get_conversation, user_id)
+    if not state or state["flow"] != SICK_LEAVE_FLOW or state["step"] != "attachment":
+        return False
+    await run_db(db_service.set_conversation, user_id, SICK_LEAVE_FLOW, "review", {**state["data"], "file_id": file_id})
+    await update.message.reply_text(
+        "Thanks — your sick leave request and medical note were sent to HR. They will review it and reply here."
+    )
+    return True
+
+
+@_timed("sick_leave_message")
+async def sick_leave_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handler for plain text: the explanation step of a sick leave request. Ignored outside the flow.
+    """
+    user = update.effective_user
+    if not user:
+        return
+    state = await run_db(db_service.get_conversation, user.id)
+    if not state or state["flow"] != SICK_LEAVE_FLOW or state["step"] != "message":
+        return
+    await run_db(db_service.set_conversation, user.id, SICK_LEAVE_FLOW, "attachment",
+                 {**state["data"], "message": update.message.text})
+    await update.message.reply_text("Got it. Now attach your medical note or receipt as a photo or document.")
+
+
+@_timed("cancel")
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handler for /cancel — abandons the sick leave request in progress, if any.
+    """
+    user = update.effective_user
+    state = await run_db(db_service.get_conversation, user.id) if user else None
+    if not state:
+        await update.message.reply_text("Nothing to cancel.")
+        return
+    await run_db(db_service.clear_conversation, user.id)
+    await update.message.reply_text("Cancelled. Use /start to see available options.")
+
+
+@_timed("credit_command")
+async def credit_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handler for /credit command (example).
     """
     # Placeholder: guide user how to credit their account
-    update.message.reply_text(
+    await update.message.reply_text(
         "To credit your account, please send a receipt via this chat or use the Charge via WhatsApp button from /start."
     )
 
 
-def unknown(update: Update, context: CallbackContext) -> None:
+@_timed("unknown")
+async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handler for unknown commands.
     """
-    update.message.reply_text("Sorry, I didn't understand that command. Use /start to see available options.")
+    await update.message.reply_text("Sorry, I didn't understand that command. Use /start to see available options.")
 
 
-def button_callback(update: Update, context: CallbackContext) -> None:
+@_timed("button_callback")
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     CallbackQueryHandler to handle button presses from the inline keyboard.
     Supports: req_sick, balance, help, charge_whatsapp
@@ -118,7 +411,7 @@ def button_callback(update: Update, context: CallbackContext) -> None:
         return
 
     # Acknowledge the callback (this removes the loading state on the client)
-    query.answer()
+    await query.answer()
 
     data = query.data
     user = query.from_user
@@ -126,21 +419,24 @@ def button_callback(update: Update, context: CallbackContext) -> None:
 
     if data == "balance":
         if user_id is None:
-            query.edit_message_text("Could not determine your user ID to fetch the balance.")
+            await query.edit_message_text("Could not determine your user ID to fetch the balance.")
             return
-        bal = _get_balance_for_user(user_id)
-        query.edit_message_text(f"Your current balance is: {bal}")
+        bal = await _get_balance_for_user(user_id)
+        await query.edit_message_text(f"Your current balance is: {bal}")
 
     elif data == "req_sick":
-        # Simple instructions to request sick leave
+        if user_id is None:
+            await query.edit_message_text("Could not determine your user ID to start a sick leave request.")
+            return
+        await run_db(db_service.set_conversation, user_id, SICK_LEAVE_FLOW, "message")
         text = (
             "To request sick leave:\n"
             "1. Send a brief message explaining your situation.\n"
             "2. Attach any medical note or receipt as a photo/document.\n"
             "3. Our HR team will review and reply with confirmation.\n\n"
-            "You can attach the medical note now in this chat."
+            "Send your message now, or /cancel to stop."
         )
-        query.edit_message_text(text)
+        await query.edit_message_text(text)
 
     elif data == "help":
         text = (
@@ -148,9 +444,10 @@ def button_callback(update: Update, context: CallbackContext) -> None:
             "/start - Show welcome and actions\n"
             "/balance - Show your current balance\n"
             "/credit - Get instructions to credit your account\n"
+            "/cancel - Stop a sick leave request in progress\n"
             "Or press the buttons shown in /start for quick actions."
         )
-        query.edit_message_text(text)
+        await query.edit_message_text(text)
 
     elif data == "charge_whatsapp":
         # Provide a WhatsApp link — replace the phone number with the real one if you have it
@@ -161,10 +458,77 @@ def button_callback(update: Update, context: CallbackContext) -> None:
             f"{wa_link}\n\n"
             "Make sure to include your user ID when you contact support so we can apply the credit quickly."
         )
-        query.edit_message_text(text)
+        await query.edit_message_text(text)
 
     else:
-        query.edit_message_text("Unknown action. Please use /start to see available options.")
+        await query.edit_message_text("Unknown action. Please use /start to see available options.")
+
+
+def register_handlers(application: Application) -> None:
+    """
+    Register all bot handlers on the application.
+    """
+    # Rate limiting runs before every other handler
+    application.add_handler(TypeHandler(Update, throttle), group=-1)
+    application.add_error_handler(error_handler)
+
+    # Register command handlers
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("balance", balance))
+    application.add_handler(CommandHandler("credit", credit_command))
+    application.add_handler(CommandHandler("cancel", cancel))
+
+    # Register callback query handler for inline buttons
+    application.add_handler(CallbackQueryHandler(button_callback))
+
+    # Register a handler for receipts (photos/documents) — simple acknowledgment
+    application.add_handler(MessageHandler(filters.PHOTO | filters.Document.ALL, handle_receipt))
+
+    # Plain text is only expected inside the sick leave flow
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, sick_leave_message))
+
+    # Unknown commands
+    application.add_handler(MessageHandler(filters.COMMAND, unknown))
+
+
+async def _post_shutdown(application: Application) -> None:
+    _db_executor.shutdown(wait=True)
+    db_service.close_conversations()
+    db_service.close_pool()
+
+
+def build_application(token: str, request=None) -> Application:
+    """
+    Build the Application with per-user ordered concurrent update processing and a
+    bounded update queue. `request` replaces the HTTP backend (e.g. an offline fake).
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .update_queue(asyncio.Queue(maxsize=config.UPDATE_QUEUE_SIZE))
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_shutdown(_post_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
+    register_handlers(application)
+    return application
+
+
+def webhook_kwargs() -> Dict[str, Any]:
+    """
+    Keyword arguments for Application.run_webhook / Updater.start_webhook from config.
+    """
+    url_path = config.WEBHOOK_PATH.strip("/")
+    webhook_url = f"{config.WEBHOOK_URL.rstrip('/')}/{url_path}" if config.WEBHOOK_URL else None
+    return {
+        "listen": config.WEBHOOK_LISTEN,
+        "port": config.WEBHOOK_PORT,
+        "url_path": url_path,
+        "webhook_url": webhook_url,
+        "secret_token": config.WEBHOOK_SECRET_TOKEN,
+    }
 
 
 def main() -> None:
@@ -175,27 +539,31 @@ def main() -> None:
         logger.error("No BOT_TOKEN provided; exiting.")
         return
 
-    updater = Updater(BOT_TOKEN, use_context=True)
-    dp = updater.dispatcher
-
-    # Register command handlers
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("balance", balance))
-    dp.add_handler(CommandHandler("credit", credit_command))
+    if config.BOT_MODE not in ("polling", "webhook"):
+        logger.error("Unknown BOT_MODE %r; use 'polling' or 'webhook'.", config.BOT_MODE)
+        return
+    if config.BOT_MODE == "webhook" and not config.WEBHOOK_SECRET_TOKEN:
+        logger.error("WEBHOOK_SECRET_TOKEN must be set in webhook mode; exiting.")
+        return
 
-    # Register callback query handler for inline buttons
-    dp.add_handler(CallbackQueryHandler(button_callback))
+    db_service.init_db()
 
-    # Register a handler for receipts (photos/documents) — simple acknowledgment
-    dp.add_handler(MessageHandler(Filters.photo | Filters.document, handle_receipt))
+    if config.METRICS_PORT:
+        metrics.start_http_server(config.METRICS_PORT, config.METRICS_HOST, token=config.METRICS_TOKEN)
+    if hasattr(signal, "SIGUSR2"):
+        # `kill -USR2 <pid>` switches metrics and query tracing on or off
+        signal.signal(signal.SIGUSR2, lambda signum, frame: metrics.set_enabled(not metrics.enabled()))
 
-    # Unknown commands
-    dp.add_handler(MessageHandler(Filters.command, unknown))
+    application = build_application(BOT_TOKEN)
 
-    # Start the Bot
-    updater.start_polling()
-    logger.info("Bot started. Listening for updates...")
-    updater.idle()
+    # Start the Bot. On SIGINT/SIGTERM the server stops accepting updates and the
+    # application drains everything already queued before shutting down.
+    if config.BOT_MODE == "webhook":
+        logger.info("Bot started in webhook mode on %s:%s.", config.WEBHOOK_LISTEN, config.WEBHOOK_PORT)
+        application.run_webhook(**webhook_kwargs())
+    else:
+        logger.info("Bot started. Listening for updates...")
+        application.run_polling()
 
 
 if __name__ == "__main__":
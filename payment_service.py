@@ -1,4 +1,3 @@
-"""
 import asyncio
 
 async def verify_kuraimi_payment(amount: int, receipt_file_path: str) -> bool:
@@ -10,4 +9,3 @@ async def verify_kuraimi_payment(amount: int, receipt_file_path: str) -> bool:
     await asyncio.sleep(1)  # simulate network latency
     # TODO: integrate with real Kuraimi API
     return True
-"""
@@ -0,0 +1,166 @@
+"""
+Token-bucket rate limiting for outgoing Telegram traffic.
+
+RateLimiter combines one bucket per key (user/chat) with a global bucket,
+backs off multiplicatively when Telegram answers with a flood wait
+(RetryAfter) and recovers additively afterwards. Per-key state is kept in LRU
+order and evicted once idle, so memory is O(active keys).
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def deficit(self, now: float, n: float = 1.0) -> float:
+        """Seconds until `n` tokens are available (0.0 if they are now)."""
+        self.refill(now)
+        if self.tokens >= n:
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    check(key) takes one token from the key's bucket and the global bucket, or
+    takes nothing and returns how long to wait. A key of None only uses the
+    global bucket.
+    """
+
+    def __init__(self, per_key_rate: float, per_key_burst: float, global_rate: float, global_burst: float,
+                 idle_ttl: float = 300.0, min_global_rate: Optional[float] = None, recovery_rate: float = 0.5,
+                 clock: Callable[[], float] = time.monotonic):
+        self.per_key_rate = per_key_rate
+        self.per_key_burst = per_key_burst
+        self.global_rate = global_rate
+        self.min_global_rate = min_global_rate or max(global_rate / 8, 0.1)
+        # tokens/sec regained per second after a flood-wait backoff
+        self.recovery_rate = recovery_rate
+        self.idle_ttl = idle_ttl
+        self._clock = clock
+        now = clock()
+        self._global = TokenBucket(global_rate, global_burst, now)
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self._paused_until = 0.0
+        self._recovered_at = now
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _evict_idle(self, now: float) -> None:
+        # Buckets are kept in LRU order, so only the head can be idle. A bucket
+        # idle for idle_ttl has refilled completely and is equivalent to a new one.
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if now - bucket.updated < self.idle_ttl:
+                break
+            del self._buckets[key]
+
+    def _recover(self, now: float) -> None:
+        if now <= self._recovered_at:
+            return
+        if self._global.rate < self.global_rate:
+            self._global.rate = min(self.global_rate,
+                                    self._global.rate + (now - self._recovered_at) * self.recovery_rate)
+        self._recovered_at = now
+
+    def check(self, key: Optional[Hashable] = None) -> float:
+        now = self._clock()
+        self._evict_idle(now)
+        self._recover(now)
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        bucket = None
+        wait = 0.0
+        if key is not None:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.per_key_rate, self.per_key_burst, now)
+            else:
+                self._buckets.move_to_end(key)
+            wait = bucket.deficit(now)
+        wait = max(wait, self._global.deficit(now))
+        if wait:
+            return wait
+        if bucket is not None:
+            bucket.tokens -= 1
+        self._global.tokens -= 1
+        return 0.0
+
+    async def acquire(self, key: Optional[Hashable] = None, max_wait: Optional[float] = None) -> bool:
+        """Wait until a token is available. Returns False instead if that would take longer than max_wait."""
+        while True:
+            delay = self.check(key)
+            if not delay:
+                return True
+            if max_wait is not None and delay > max_wait:
+                return False
+            await asyncio.sleep(delay)
+
+    def penalize(self, retry_after: float, key: Optional[Hashable] = None) -> None:
+        """
+        React to a flood wait: pause `key` (or all traffic when key is None) for
+        retry_after seconds, and halve the global rate when the flood is global.
+        """
+        now = self._clock()
+        if key is not None:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.per_key_rate, self.per_key_burst, now)
+            # negative tokens delay the key until it has refilled past zero
+            bucket.refill(now)
+            bucket.tokens = min(bucket.tokens, 0.0) - retry_after * bucket.rate
+            return
+        self._paused_until = max(self._paused_until, now + retry_after)
+        self._global.rate = max(self.min_global_rate, self._global.rate / 2)
+        self._global.tokens = min(self._global.tokens, 0.0)
+        self._recovered_at = now + retry_after
+
+
+class Coalescer:
+    """
+    Remembers keys for `window` seconds; seen(key) is True for repeats within
+    the window. Entries expire in insertion order, so memory is bounded by the
+    number of distinct keys per window.
+    """
+
+    def __init__(self, window: float, clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self._clock = clock
+        self._seen: "OrderedDict[Hashable, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def seen(self, key: Hashable) -> bool:
+        now = self._clock()
+        while self._seen:
+            oldest_key, first_seen = next(iter(self._seen.items()))
+            if now - first_seen < self.window:
+                break
+            del self._seen[oldest_key]
+        if key in self._seen:
+            return True
+        self._seen[key] = now
+        return False
+
+
+def retry_after_seconds(error) -> float:
+    """Seconds from a telegram.error.RetryAfter (int or timedelta depending on the library version)."""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
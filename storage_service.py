@@ -1,30 +1,334 @@
 import os
+import hashlib
+import shutil
+import tempfile
+import time
 from pathlib import Path
 import logging
 
+import db_service
+
 logger = logging.getLogger(__name__)
 
 UPLOADS_DIR = Path("uploads")
 UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
 
+# "local" (sharded files under UPLOADS_DIR) or "s3" (any S3-compatible endpoint,
+# e.g. a local MinIO stand-in via S3_ENDPOINT_URL). The s3 backend needs boto3.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").strip().lower()
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_PREFIX = os.getenv("S3_PREFIX", "uploads/")
+# Seconds a blob without references is kept before collect_garbage() deletes it
+BLOB_GC_GRACE = int(os.getenv("BLOB_GC_GRACE", "3600"))
+# How long a new reference waits for a sweep that is deleting the same blob
+BLOB_GC_WAIT = float(os.getenv("BLOB_GC_WAIT", "30"))
+
+# Stored files are referenced as "cas:<sha256 hex>". References without the
+# prefix are legacy paths of files saved before content addressing.
+REF_PREFIX = "cas:"
+
+def _sharded_key(digest: str) -> str:
+    """Fan out by the first two byte pairs: abcd... -> ab/cd/abcd... (O(1) per directory)."""
+    return f"{digest[:2]}/{digest[2:4]}/{digest}"
+
+def make_ref(digest: str) -> str:
+    return f"{REF_PREFIX}{digest}"
+
+def parse_ref(ref: str):
+    """Return the digest of a content-addressed ref, or None for a legacy path."""
+    if ref and ref.startswith(REF_PREFIX):
+        return ref[len(REF_PREFIX):]
+    return None
+
+class StorageBackend:
+    """Where content-addressed blobs live. Keys are sharded paths from _sharded_key()."""
+
+    def incoming_dir(self) -> Path:
+        """Directory for partially written uploads (ideally on the same filesystem as the store)."""
+        return Path(tempfile.gettempdir())
+
+    def put(self, key: str, src_path: Path) -> None:
+        """Store the finished file at src_path under key, consuming src_path."""
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def open(self, key: str):
+        """Open the blob for binary reading."""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def local_path(self, key: str):
+        """Filesystem path of the blob, or None if the backend is not on local disk."""
+        return None
+
+    def url(self, key: str, base_url: str = None) -> str:
+        raise NotImplementedError
+
+class LocalBackend(StorageBackend):
+    def __init__(self, root: Path = None):
+        self._root = Path(root) if root else None
+
+    @property
+    def root(self) -> Path:
+        return self._root or UPLOADS_DIR
+
+    def incoming_dir(self) -> Path:
+        # Same filesystem as the store, so put() is an atomic rename.
+        incoming = self.root / ".incoming"
+        incoming.mkdir(parents=True, exist_ok=True)
+        return incoming
+
+    def local_path(self, key: str) -> Path:
+        return self.root / key
+
+    def put(self, key: str, src_path: Path) -> None:
+        dest = self.local_path(key)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        # shutil.move renames when possible and falls back to copy+delete across filesystems
+        shutil.move(str(src_path), str(dest))
+
+    def exists(self, key: str) -> bool:
+        return self.local_path(key).exists()
+
+    def open(self, key: str):
+        return open(self.local_path(key), "rb")
+
+    def delete(self, key: str) -> None:
+        self.local_path(key).unlink(missing_ok=True)
+
+    def url(self, key: str, base_url: str = None) -> str:
+        if base_url:
+            return f"{base_url.rstrip('/')}/{key}"
+        return str(self.local_path(key))
+
+class S3Backend(StorageBackend):
+    def __init__(self, bucket: str, endpoint_url: str = None, prefix: str = ""):
+        try:
+            import boto3
+        except ImportError as e:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires boto3 (pip install boto3)") from e
+        if not bucket:
+            raise ValueError("S3_BUCKET is required for the s3 storage backend")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def put(self, key: str, src_path: Path) -> None:
+        self.client.upload_file(str(src_path), self.bucket, self._object_key(key))
+        Path(src_path).unlink(missing_ok=True)
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except ClientError:
+            return False
+
+    def open(self, key: str):
+        return self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))["Body"]
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+    def url(self, key: str, base_url: str = None) -> str:
+        if base_url:
+            return f"{base_url.rstrip('/')}/{self._object_key(key)}"
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": self._object_key(key)}, ExpiresIn=3600
+        )
+
+_backend = None
+
+def get_backend() -> StorageBackend:
+    global _backend
+    if _backend is None:
+        if STORAGE_BACKEND == "s3":
+            _backend = S3Backend(S3_BUCKET, endpoint_url=S3_ENDPOINT_URL, prefix=S3_PREFIX)
+        elif STORAGE_BACKEND == "local":
+            _backend = LocalBackend()
+        else:
+            raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
+    return _backend
+
+def set_backend(backend: StorageBackend) -> None:
+    global _backend
+    _backend = backend
+
+def _retain_stored(digest: str, size: int) -> bool:
+    """Add a reference to an already stored copy of `digest`; False if there is none.
+
+    If a garbage-collection sweep is deleting the copy, wait until it is gone.
+    """
+    deadline = time.monotonic() + BLOB_GC_WAIT
+    while db_service.retain_blob(digest, size, create=False) is None:
+        blob = db_service.get_blob(digest)
+        if blob is None:
+            return False
+        if blob["refcount"] == db_service.BLOB_CLAIMED:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"blob {digest} is still being deleted")
+            time.sleep(0.05)
+    return True
+
+def _store(src_path: Path, digest: str, size: int) -> str:
+    """Add one reference to the blob `digest`, storing src_path only if no copy is stored yet.
+
+    The file is uploaded before its first reference is recorded, outside any
+    transaction, so writers never wait on storage I/O and a failed upload
+    leaves no reference behind. Two concurrent first uploads of the same
+    content just write the same object twice.
+    """
+    if _retain_stored(digest, size):
+        Path(src_path).unlink(missing_ok=True)
+        logger.info(f"Deduplicated upload {digest} ({size} bytes)")
+        return make_ref(digest)
+    get_backend().put(_sharded_key(digest), src_path)
+    if db_service.retain_blob(digest, size) is None:
+        # another copy was stored, released and claimed by a sweep while ours uploaded
+        raise RuntimeError(f"blob {digest} was garbage-collected while being stored; store it again")
+    logger.info(f"Stored {digest} ({size} bytes)")
+    return make_ref(digest)
+
+def release(ref: str) -> None:
+    """Drop one reference to a stored file. Files without references are deleted by collect_garbage()."""
+    digest = parse_ref(ref)
+    if digest is not None:
+        db_service.release_blob(digest)
+
+def collect_garbage(grace: int = BLOB_GC_GRACE, batch_size: int = 100) -> dict:
+    """Delete the files (and thumbnails) of blobs released more than `grace` seconds ago.
+
+    Each blob is claimed in a short transaction, its files are deleted outside
+    any transaction, and only then is its row dropped; a blob whose files could
+    not be deleted is given back for the next sweep.
+    Returns {"deleted": n, "failed": n}.
+    """
+    backend = get_backend()
+    stats = {"deleted": 0, "failed": 0}
+    while True:
+        digests = db_service.claim_released_blobs(grace, batch_size)
+        failed = 0
+        for digest in digests:
+            try:
+                for key in db_service.forget_thumbnails(digest):
+                    backend.delete(key)
+                backend.delete(_sharded_key(digest))
+            except Exception:
+                logger.exception(f"Could not delete blob {digest}; will retry")
+                db_service.unclaim_blob(digest)
+                failed += 1
+                continue
+            db_service.drop_blob(digest)
+            stats["deleted"] += 1
+        stats["failed"] += failed
+        # a batch that only failed would be claimed again right away
+        if len(digests) < batch_size or failed == len(digests):
+            return stats
+
+def derived_key(ref_or_digest: str, suffix: str) -> str:
+    """Storage key for a file derived from a stored blob (e.g. a thumbnail), kept next to the original."""
+    digest = parse_ref(ref_or_digest) or ref_or_digest
+    return f"{_sharded_key(digest)}{suffix}"
+
+class UploadWriter:
+    """Incrementally write an upload to a temp file while hashing it (SHA-256).
+
+    Call write() for each chunk, then commit() to add it to the content-addressed
+    store (deduplicated by digest), or abort() to discard it. Used as a context
+    manager it aborts automatically if the block raises before commit().
+    """
+
+    def __init__(self):
+        fd, tmp_path = tempfile.mkstemp(dir=get_backend().incoming_dir(), suffix=".part")
+        self.tmp_path = Path(tmp_path)
+        self._fh = os.fdopen(fd, "wb")
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.ref = None
+
+    @property
+    def sha256(self) -> str:
+        return self._hash.hexdigest()
+
+    def write(self, chunk: bytes) -> None:
+        self._fh.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> str:
+        """Flush, fsync and store the file. Returns its "cas:<sha256>" reference."""
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._fh.close()
+        self.ref = _store(self.tmp_path, self.sha256, self.size)
+        return self.ref
+
+    def abort(self) -> None:
+        if not self._fh.closed:
+            self._fh.close()
+        if self.ref is None:
+            self.tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None or self.ref is None:
+            self.abort()
+        return False
+
+def save_stream(chunks) -> str:
+    """Store an iterable of byte chunks without holding it in memory. Returns its reference."""
+    with UploadWriter() as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+        return writer.commit()
+
 def save_local(file_path: str, target_filename: str = None) -> str:
-    """Given a downloaded file path (already saved by telegram client) move/rename it into uploads and return relative path."""
+    """Move a downloaded file (already saved by telegram client) into the store and return its reference.
+
+    target_filename is accepted for compatibility; stored files are named by content.
+    """
     src = Path(file_path)
     if not src.exists():
         raise FileNotFoundError(f"File {file_path} not found")
 
-    if not target_filename:
-        target_filename = src.name
+    file_hash = hashlib.sha256()
+    size = 0
+    with open(src, "rb") as fh:
+        for chunk in iter(lambda: fh.read(64 * 1024), b""):
+            file_hash.update(chunk)
+            size += len(chunk)
+    return _store(src, file_hash.hexdigest(), size)
+
+def open_file(ref: str):
+    """Open a stored file (content-addressed or legacy path) for binary reading."""
+    digest = parse_ref(ref)
+    if digest is None:
+        return open(ref, "rb")
+    return get_backend().open(_sharded_key(digest))
 
-    dest = UPLOADS_DIR / target_filename
-    # If same path, do nothing
-    if src.resolve() != dest.resolve():
-        src.rename(dest)
-    logger.info(f"Saved file to {dest}")
-    return str(dest)
+def local_path(ref: str):
+    """Filesystem path of a stored file, or None when the backend is remote."""
+    digest = parse_ref(ref)
+    if digest is None:
+        return Path(ref)
+    return get_backend().local_path(_sharded_key(digest))
 
 def get_public_url(path: str, base_url: str = None) -> str:
     """Return a public URL for the stored file if base_url provided, otherwise local path."""
+    digest = parse_ref(path)
+    if digest is not None:
+        return get_backend().url(_sharded_key(digest), base_url)
     if base_url:
         return f"{base_url.rstrip('/')}/{Path(path).name}"
     return path
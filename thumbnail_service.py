@@ -0,0 +1,205 @@
+"""
+Lazily generated, cached thumbnails of stored receipt images.
+
+A thumbnail is rendered the first time it is requested and stored through
+storage_service next to its original (<original key>.thumb<size>.<fmt>), so
+every later request is a plain file read. Each one is recorded in the
+db_service thumbnail index; once their total size passes
+THUMBNAIL_CACHE_MAX_BYTES the least recently used ones are deleted. Access
+times are only written back every THUMBNAIL_TOUCH_INTERVAL seconds per
+thumbnail, so serving a cached thumbnail is a read.
+
+pregenerate() renders thumbnails for every stored blob on a process pool, so
+the Pillow work of a bulk run never competes with web workers:
+
+    flask generate-thumbnails --workers 4
+
+Pillow is optional; without it available() is False and no thumbnails are made.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import closing, contextmanager
+from pathlib import Path
+
+import db_service
+import storage_service
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # optional dependency
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+SIZES = tuple(int(size) for size in os.getenv("THUMBNAIL_SIZES", "160,480").split(","))
+QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "80"))
+CACHE_MAX_BYTES = int(os.getenv("THUMBNAIL_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+TOUCH_INTERVAL = int(os.getenv("THUMBNAIL_TOUCH_INTERVAL", "3600"))
+WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "0")) or os.cpu_count() or 1
+# URL extension -> (Pillow format, MIME type)
+FORMATS = {"webp": ("WEBP", "image/webp"), "jpg": ("JPEG", "image/jpeg")}
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def formats():
+    """Output formats this Pillow build can write, preferred first."""
+    if Image is None:
+        return []
+    return [fmt for fmt in FORMATS if fmt != "webp" or features.check("webp")]
+
+
+def thumbnail_key(digest: str, size: int, fmt: str) -> str:
+    return storage_service.derived_key(digest, f".thumb{size}.{fmt}")
+
+
+def render(src_path, dest_path, size: int, fmt: str) -> int:
+    """Fit the image at src_path into size x size, save it as `fmt` at dest_path and return its byte size."""
+    with Image.open(src_path) as image:
+        # JPEG decodes straight to a nearby smaller scale, skipping most of the work
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(dest_path, FORMATS[fmt][0], quality=QUALITY)
+    return os.path.getsize(dest_path)
+
+
+@contextmanager
+def _original_path(digest: str):
+    """Local path of the original blob, downloading it to a temp file for remote backends."""
+    backend = storage_service.get_backend()
+    key = storage_service.derived_key(digest, "")
+    path = backend.local_path(key)
+    if path is not None:
+        if not Path(path).exists():
+            raise FileNotFoundError(f"blob {digest} is not stored")
+        yield path
+        return
+    fd, tmp = tempfile.mkstemp(dir=backend.incoming_dir(), suffix=".orig")
+    try:
+        with os.fdopen(fd, "wb") as out, closing(backend.open(key)) as src:
+            shutil.copyfileobj(src, out)
+        yield tmp
+    finally:
+        Path(tmp).unlink(missing_ok=True)
+
+
+def _new_output(fmt: str) -> str:
+    fd, tmp = tempfile.mkstemp(dir=storage_service.get_backend().incoming_dir(), suffix=f".{fmt}")
+    os.close(fd)
+    return tmp
+
+
+def _store(digest: str, size: int, fmt: str, tmp: str, nbytes: int) -> str:
+    key = thumbnail_key(digest, size, fmt)
+    backend = storage_service.get_backend()
+    backend.put(key, Path(tmp))
+    db_service.record_thumbnail(key, digest, nbytes)
+    logger.debug("Stored thumbnail %s (%d bytes)", key, nbytes)
+    for evicted in db_service.evict_thumbnails(CACHE_MAX_BYTES):
+        backend.delete(evicted)
+    return key
+
+
+def ensure_thumbnail(digest: str, size: int, fmt: str) -> str:
+    """Storage key of the size/fmt thumbnail of blob `digest`, rendering it on first use.
+
+    Raises FileNotFoundError when the blob is missing or is not an image Pillow can read.
+    """
+    if Image is None:
+        raise RuntimeError("thumbnails need Pillow (pip install Pillow)")
+    if size not in SIZES or fmt not in formats():
+        raise ValueError(f"unsupported thumbnail {size}/{fmt}")
+    key = thumbnail_key(digest, size, fmt)
+    backend = storage_service.get_backend()
+    entry = db_service.get_thumbnail(key)
+    if entry is not None and backend.exists(key):
+        if entry["accessed_ts"] < time.time() - TOUCH_INTERVAL:
+            db_service.touch_thumbnail(key)
+        return key
+    tmp = _new_output(fmt)
+    try:
+        with _original_path(digest) as src:
+            nbytes = render(src, tmp, size, fmt)
+    except OSError as e:  # includes PIL.UnidentifiedImageError
+        Path(tmp).unlink(missing_ok=True)
+        raise FileNotFoundError(f"no thumbnail for blob {digest}: {e}") from e
+    return _store(digest, size, fmt, tmp, nbytes)
+
+
+def _render_job(src, dest, size, fmt):
+    # runs in a pool process: Pillow only, no database or storage access
+    try:
+        return render(src, dest, size, fmt)
+    except OSError:
+        Path(dest).unlink(missing_ok=True)
+        return None
+
+
+def pregenerate(sizes=None, fmts=None, workers=WORKERS, digests=None, progress=None):
+    """Render every missing thumbnail of every stored blob (or of `digests`) on `workers` processes.
+
+    Originals are read and results stored by this process; pool processes only
+    run Pillow. Returns {"generated": n, "skipped": n, "failed": n}.
+    """
+    if Image is None:
+        raise RuntimeError("thumbnails need Pillow (pip install Pillow)")
+    sizes = list(sizes or SIZES)
+    fmts = list(fmts or formats())
+    backend = storage_service.get_backend()
+    stats = {"generated": 0, "skipped": 0, "failed": 0}
+    pending = {}  # future -> (digest, size, fmt, original path, output path)
+    downloads = {}  # downloaded original of a remote blob -> jobs still reading it
+
+    def collect(return_when):
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            digest, size, fmt, src, tmp = pending.pop(future)
+            if src in downloads:
+                downloads[src] -= 1
+                if not downloads[src]:
+                    del downloads[src]
+                    Path(src).unlink(missing_ok=True)
+            nbytes = future.result()
+            if nbytes is None:
+                stats["failed"] += 1
+                continue
+            _store(digest, size, fmt, tmp, nbytes)
+            stats["generated"] += 1
+        if progress:
+            progress(stats)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for digest in digests if digests is not None else db_service.iter_blob_digests():
+            todo = [(size, fmt) for size in sizes for fmt in fmts
+                    if db_service.get_thumbnail(thumbnail_key(digest, size, fmt)) is None]
+            stats["skipped"] += len(sizes) * len(fmts) - len(todo)
+            if not todo:
+                continue
+            key = storage_service.derived_key(digest, "")
+            src = backend.local_path(key)
+            if src is None:
+                src = _new_output("orig")
+                with open(src, "wb") as out, closing(backend.open(key)) as blob:
+                    shutil.copyfileobj(blob, out)
+                downloads[src] = len(todo)
+            elif not Path(src).exists():
+                stats["failed"] += len(todo)
+                continue
+            for size, fmt in todo:
+                tmp = _new_output(fmt)
+                pending[pool.submit(_render_job, str(src), tmp, size, fmt)] = (digest, size, fmt, src, tmp)
+            # bound the number of queued jobs (and of downloaded originals)
+            while len(pending) >= workers * 4:
+                collect(FIRST_COMPLETED)
+        if pending:
+            collect(ALL_COMPLETED)
+    return stats
@@ -0,0 +1,205 @@
+"""
+Batch payment-verification worker.
+
+Pulls pending receipts in id order, verifies them concurrently with an async
+verifier(amount, file_path) -> bool, and writes approved/rejected transitions
+back in batched transactions. A receipt an admin decided on while it was being
+verified keeps the admin's status. Receipts whose verification keeps failing
+stay pending and are retried on the next pass. Run a single instance:
+
+    python verification_worker.py --verifier mypackage.kuraimi:verify --concurrency 64 --once
+
+payment_service.verify_kuraimi_payment is a stub that approves everything, so
+the worker refuses to run with it.
+"""
+import argparse
+import asyncio
+import importlib
+import logging
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+import db_service
+import payment_service
+import storage_service
+
+logger = logging.getLogger(__name__)
+
+Verifier = Callable[[float, str], Awaitable[bool]]
+
+VERIFY_CONCURRENCY = int(os.getenv("VERIFY_CONCURRENCY", "32"))
+VERIFY_BATCH_SIZE = int(os.getenv("VERIFY_BATCH_SIZE", "500"))
+VERIFY_TIMEOUT = float(os.getenv("VERIFY_TIMEOUT", "15"))
+VERIFY_RETRIES = int(os.getenv("VERIFY_RETRIES", "3"))
+VERIFY_BACKOFF = float(os.getenv("VERIFY_BACKOFF", "0.5"))
+
+_STOP = object()
+
+
+class VerificationWorker:
+    """
+    Pipeline of one fetcher, `concurrency` verifier tasks and one writer, joined
+    by bounded queues so memory stays proportional to batch_size.
+    """
+
+    def __init__(self, verifier: Verifier,
+                 concurrency: int = VERIFY_CONCURRENCY, batch_size: int = VERIFY_BATCH_SIZE,
+                 timeout: float = VERIFY_TIMEOUT, retries: int = VERIFY_RETRIES, backoff: float = VERIFY_BACKOFF,
+                 flush_interval: float = 1.0, report_interval: float = 10.0):
+        self.verifier = verifier
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.flush_interval = flush_interval
+        self.report_interval = report_interval
+        # superseded: verified, but an admin had changed the receipt's status first
+        self.stats = {"verified": 0, "approved": 0, "rejected": 0, "failed": 0, "superseded": 0}
+        self._in_flight = set()
+        self._started = None
+
+    async def _verify(self, receipt: Dict) -> Optional[str]:
+        """Verify one receipt with timeout and retries; None if every attempt failed."""
+        path = storage_service.local_path(receipt["file_ref"]) if receipt.get("file_ref") else None
+        for attempt in range(self.retries + 1):
+            try:
+                ok = await asyncio.wait_for(self.verifier(receipt["amount"], str(path or "")), self.timeout)
+                return "approved" if ok else "rejected"
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.warning("Verification of receipt %s failed after %d attempts: %r",
+                                   receipt["id"], attempt + 1, e)
+                    return None
+                # exponential backoff with full jitter
+                await asyncio.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    async def _fetcher(self, todo: asyncio.Queue, once: bool, poll_interval: float) -> None:
+        after_id = 0
+        while True:
+            batch = await asyncio.to_thread(db_service.get_pending_receipts, after_id, self.batch_size)
+            batch = [r for r in batch if r["id"] not in self._in_flight]
+            if not batch:
+                if once:
+                    break
+                # start over from the oldest so receipts that failed earlier are retried
+                after_id = 0
+                await asyncio.sleep(poll_interval)
+                continue
+            for receipt in batch:
+                self._in_flight.add(receipt["id"])
+                await todo.put(receipt)
+            after_id = batch[-1]["id"]
+        for _ in range(self.concurrency):
+            await todo.put(_STOP)
+
+    async def _verifier_task(self, todo: asyncio.Queue, results: asyncio.Queue) -> None:
+        while True:
+            receipt = await todo.get()
+            if receipt is _STOP:
+                await results.put(_STOP)
+                return
+            await results.put((receipt["id"], await self._verify(receipt)))
+
+    async def _flush(self, pending: Dict[int, Optional[str]]) -> None:
+        changes = {rid: status for rid, status in pending.items() if status is not None}
+        if changes:
+            changed = await asyncio.to_thread(db_service.set_receipt_statuses, changes.items(), expected="pending")
+            self.stats["superseded"] += len(changes) - changed
+        for rid, status in pending.items():
+            self._in_flight.discard(rid)
+            self.stats["verified" if status else "failed"] += 1
+            if status:
+                self.stats[status] += 1
+        pending.clear()
+
+    async def _writer(self, results: asyncio.Queue) -> None:
+        pending: Dict[int, Optional[str]] = {}
+        stopped = 0
+        last_flush = last_report = time.monotonic()
+        while stopped < self.concurrency:
+            try:
+                item = await asyncio.wait_for(results.get(), self.flush_interval)
+            except asyncio.TimeoutError:
+                item = None
+            if item is _STOP:
+                stopped += 1
+            elif item is not None:
+                pending[item[0]] = item[1]
+            now = time.monotonic()
+            if pending and (len(pending) >= self.batch_size or now - last_flush >= self.flush_interval):
+                await self._flush(pending)
+                last_flush = now
+            if now - last_report >= self.report_interval:
+                await self.report()
+                last_report = now
+        await self._flush(pending)
+
+    async def report(self) -> Dict:
+        """Log and return throughput so far and the current pending queue depth."""
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        done = self.stats["verified"] + self.stats["failed"]
+        pending = await asyncio.to_thread(db_service.get_counter, "receipts:pending")
+        report = dict(self.stats, elapsed=elapsed, per_sec=done / elapsed if elapsed else 0.0, pending=pending)
+        logger.info("verified=%(verified)d approved=%(approved)d rejected=%(rejected)d failed=%(failed)d "
+                    "superseded=%(superseded)d %(per_sec).1f/s pending=%(pending)d", report)
+        return report
+
+    async def run(self, once: bool = False, poll_interval: float = 5.0) -> Dict:
+        """Process pending receipts. With once=True, stop after one pass over the backlog."""
+        self._started = time.monotonic()
+        todo: asyncio.Queue = asyncio.Queue(maxsize=self.batch_size * 2)
+        results: asyncio.Queue = asyncio.Queue(maxsize=self.batch_size * 2)
+        await asyncio.gather(
+            self._fetcher(todo, once, poll_interval),
+            self._writer(results),
+            *(self._verifier_task(todo, results) for _ in range(self.concurrency)),
+        )
+        return await self.report()
+
+
+def load_verifier(spec: str) -> Verifier:
+    """Import the verifier named by "module:function"."""
+    module_name, _, attr = spec.partition(":")
+    if not module_name or not attr:
+        raise ValueError(f"verifier must be given as module:function, not {spec!r}")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verifier", default=os.getenv("VERIFY_FUNCTION"),
+                        help="module:function of the async verifier (default: VERIFY_FUNCTION)")
+    parser.add_argument("--concurrency", type=int, default=VERIFY_CONCURRENCY)
+    parser.add_argument("--batch-size", type=int, default=VERIFY_BATCH_SIZE)
+    parser.add_argument("--timeout", type=float, default=VERIFY_TIMEOUT, help="seconds per verification call")
+    parser.add_argument("--retries", type=int, default=VERIFY_RETRIES)
+    parser.add_argument("--once", action="store_true", help="exit after one pass over the pending backlog")
+    parser.add_argument("--poll-interval", type=float, default=5.0)
+    args = parser.parse_args()
+    if not args.verifier:
+        parser.error("--verifier (or VERIFY_FUNCTION) is required")
+    try:
+        verifier = load_verifier(args.verifier)
+    except (ImportError, AttributeError, ValueError) as e:
+        parser.error(f"cannot load verifier {args.verifier!r}: {e}")
+    if verifier is payment_service.verify_kuraimi_payment:
+        parser.error("payment_service.verify_kuraimi_payment is a stub that approves every receipt; "
+                     "pass a real verifier")
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    db_service.init_db()
+    worker = VerificationWorker(verifier, concurrency=args.concurrency, batch_size=args.batch_size,
+                                timeout=args.timeout, retries=args.retries)
+    try:
+        asyncio.run(worker.run(once=args.once, poll_interval=args.poll_interval))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db_service.close_pool()
+
+
+if __name__ == "__main__":
+    main()